@@ -0,0 +1,290 @@
+import socket
+import struct
+import threading
+import socketserver
+import itertools
+
+from paho.mqtt.client import topic_matches_sub
+from typing import Dict, List, Tuple
+
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, \
+    UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+SUBSCRIPTION_IDENTIFIER = 0x0B
+SUBSCRIPTION_IDENTIFIER_AVAILABLE = 0x29
+
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        if value:
+            byte |= 0x80
+        out.append(byte)
+        if not value:
+            return bytes(out)
+
+
+def _decode_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    multiplier = 1
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, pos
+        multiplier *= 128
+
+
+def _encode_str(value: bytes) -> bytes:
+    return struct.pack("!H", len(value)) + value
+
+
+def _decode_str(buf: bytes, pos: int) -> Tuple[bytes, int]:
+    length, = struct.unpack_from("!H", buf, pos)
+    pos += 2
+    return buf[pos:pos + length], pos + length
+
+
+def _packet(packet_type: int, body: bytes, flags: int = 0) -> bytes:
+    return bytes([packet_type << 4 | flags]) + _encode_varint(len(body)) + body
+
+
+class _Session:
+
+    def __init__(self, broker: "StandInBroker", sock: socket.socket):
+        self.broker = broker
+        self.sock = sock
+        self.version = 5
+        self.client_id = b""
+        # Filter: (qos, subscription identifier)
+        self.subscriptions: Dict[bytes, Tuple[int, int]] = {}
+        self._write_lock = threading.Lock()
+        self._mids = itertools.cycle(range(1, 65536))
+
+    def write(self, data: bytes):
+        with self._write_lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+    def deliver(self, topic: bytes, payload: bytes, qos: int, properties: bytes, identifiers: List[int] = ()):
+        body = _encode_str(topic)
+        if qos:
+            body += struct.pack("!H", next(self._mids))
+        if self.version == 5:
+            for identifier in identifiers if self.broker.subscription_identifiers else ():
+                properties += bytes([SUBSCRIPTION_IDENTIFIER]) + _encode_varint(identifier)
+            body += _encode_varint(len(properties)) + properties
+        self.write(_packet(PUBLISH, body + payload, qos << 1))
+
+    def _read_exact(self, n: int) -> bytes:
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("Client closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def read_packet(self) -> Tuple[int, int, bytes]:
+        first = self._read_exact(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self._read_exact(1)[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return first >> 4, first & 0x0F, self._read_exact(length)
+
+    def _skip_properties(self, body: bytes, pos: int) -> Tuple[bytes, int]:
+        if self.version != 5:
+            return b"", pos
+        length, pos = _decode_varint(body, pos)
+        return body[pos:pos + length], pos + length
+
+    def handle(self):
+        while True:
+            packet_type, flags, body = self.read_packet()
+            if packet_type == CONNECT:
+                _, pos = _decode_str(body, 0)
+                self.version = body[pos]
+                pos += 4
+                _, pos = self._skip_properties(body, pos)
+                self.client_id, pos = _decode_str(body, pos)
+                # Tells v5 clients whether the subscription identifiers are echoed
+                properties = b"" if self.broker.subscription_identifiers \
+                    else bytes([SUBSCRIPTION_IDENTIFIER_AVAILABLE, 0])
+                connack = b"\x00\x00" + (_encode_varint(len(properties)) + properties if self.version == 5 else b"")
+                self.write(_packet(CONNACK, connack))
+            elif packet_type == PUBLISH:
+                qos = (flags >> 1) & 0x03
+                topic, pos = _decode_str(body, 0)
+                mid = b""
+                if qos:
+                    mid = body[pos:pos + 2]
+                    pos += 2
+                properties, pos = self._skip_properties(body, pos)
+                self.broker.route(topic, body[pos:], qos, properties)
+                if qos == 1:
+                    self.write(_packet(PUBACK, mid))
+                elif qos == 2:
+                    self.write(_packet(PUBREC, mid))
+            elif packet_type == PUBREL:
+                self.write(_packet(PUBCOMP, body[:2]))
+            elif packet_type == PUBREC:
+                self.write(_packet(PUBREL, body[:2], 0x02))
+            elif packet_type == SUBSCRIBE:
+                mid = body[:2]
+                properties, pos = self._skip_properties(body, 2)
+                # The only property a SUBSCRIBE has besides user properties, which aren't sent by the library
+                identifier = _decode_varint(properties, 1)[0] if properties[:1] == bytes([SUBSCRIPTION_IDENTIFIER]) \
+                    else 0
+                codes = bytearray()
+                while pos < len(body):
+                    topic, pos = _decode_str(body, pos)
+                    qos = body[pos] & 0x03
+                    pos += 1
+                    self.broker.subscribe(self, topic, qos, identifier)
+                    codes.append(qos)
+                props = b"\x00" if self.version == 5 else b""
+                self.write(_packet(SUBACK, mid + props + bytes(codes)))
+            elif packet_type == UNSUBSCRIBE:
+                mid = body[:2]
+                _, pos = self._skip_properties(body, 2)
+                codes = bytearray()
+                while pos < len(body):
+                    topic, pos = _decode_str(body, pos)
+                    self.broker.unsubscribe(self, topic)
+                    codes.append(0)
+                if self.version == 5:
+                    self.write(_packet(UNSUBACK, mid + b"\x00" + bytes(codes)))
+                else:
+                    self.write(_packet(UNSUBACK, mid))
+            elif packet_type == PINGREQ:
+                self.write(_packet(PINGRESP, b""))
+            elif packet_type == DISCONNECT:
+                return
+
+
+class StandInBroker:
+    """
+    Minimal in-process MQTT v5 / v3.1.1 broker, enough to run the library offline.
+    Supports QoS 0-2 forwarding, wildcards, $share subscriptions and subscription
+    identifiers. No retained messages, no persistent sessions, no authentication.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, subscription_identifiers: bool = True):
+        """
+        :param subscription_identifiers: Echo the subscription identifiers, they're optional in MQTT v5
+        """
+        self.host = host
+        self.port = port
+        self.subscription_identifiers = subscription_identifiers
+        self.messages_routed = 0
+        self._sessions: List[_Session] = []
+        self._share_cursors: Dict[Tuple[bytes, bytes], int] = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def start(self) -> "StandInBroker":
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                session = _Session(broker, self.request)
+                with broker._lock:
+                    broker._sessions.append(session)
+                try:
+                    session.handle()
+                except (ConnectionError, OSError, IndexError, struct.error):
+                    pass
+                finally:
+                    with broker._lock:
+                        broker._sessions.remove(session)
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops accepting connections and drops every connected client"""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self.disconnect_all()
+        self._server = None
+
+    def disconnect_all(self):
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def subscribe(self, session: _Session, topic: bytes, qos: int, identifier: int = 0):
+        with self._lock:
+            session.subscriptions[topic] = (qos, identifier)
+
+    def unsubscribe(self, session: _Session, topic: bytes):
+        with self._lock:
+            session.subscriptions.pop(topic, None)
+
+    def route(self, topic: bytes, payload: bytes, qos: int, properties: bytes):
+        str_topic = topic.decode("utf-8")
+        targets = []
+        shared: Dict[Tuple[bytes, bytes], List[Tuple[_Session, int, List[int]]]] = {}
+        with self._lock:
+            self.messages_routed += 1
+            for session in self._sessions:
+                granted = None
+                identifiers = []
+                for sub, (sub_qos, identifier) in session.subscriptions.items():
+                    if sub.startswith(b"$share/"):
+                        _, group, sub_filter = sub.split(b"/", 2)
+                        if topic_matches_sub(sub_filter.decode("utf-8"), str_topic):
+                            shared.setdefault((group, sub_filter), []).append(
+                                (session, sub_qos, [identifier] if identifier else []))
+                    elif topic_matches_sub(sub.decode("utf-8"), str_topic):
+                        granted = max(sub_qos, granted or 0)
+                        if identifier:
+                            identifiers.append(identifier)
+                if granted is not None:
+                    targets.append((session, granted, identifiers))
+            for key, members in shared.items():
+                cursor = self._share_cursors.get(key, 0)
+                targets.append(members[cursor % len(members)])
+                self._share_cursors[key] = cursor + 1
+        for session, sub_qos, identifiers in targets:
+            session.deliver(topic, payload, min(qos, sub_qos), properties, identifiers)
+
+
+def serve(connection):
+    """
+    Runs a broker until the connection is closed, to keep it out of the measured process
+    :param connection: multiprocessing connection the port is sent through
+    """
+    broker = StandInBroker().start()
+    connection.send(broker.port)
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    broker.stop()
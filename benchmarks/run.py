@@ -0,0 +1,254 @@
+"""
+Offline benchmarks of MqttClient against the stand-in broker.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json  # exits with 1 on regressions
+
+The broker runs in a child process so the CPU time measured is the one of the
+sender and the endpoints.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+
+from cryptography.fernet import Fernet
+from typing import List, Dict, Callable
+
+from src.MqttLibPy.client import MqttClient
+from src.MqttLibPy.serializer import Serializer
+from .broker import serve
+
+
+SCENARIOS = ["json", "json_secure", "file", "file_secure", "file_chunked", "file_chunked_secure"]
+SIZES = [1000, 64 * 1000, 1000 * 1000]
+ROW = {"id": 0, "name": "Product", "category": "Office supplies", "price": 10.5, "sent_at": 0}
+
+
+def _rows(size: int) -> List[dict]:
+    row_size = len(json.dumps(ROW)) + 2
+    return [dict(ROW, id=n) for n in range(max(1, size // row_size))]
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+class Benchmark:
+
+    def __init__(self, port: int, messages: int, wire_format: str = "json", timeout: float = 60):
+        self.port = port
+        self.messages = messages
+        self.wire_format = wire_format
+        self.timeout = timeout
+        self.key = Fernet.generate_key()
+        self.directory = tempfile.mkdtemp(prefix="mqtt-benchmark-")
+
+    def _clients(self, route: str, secure: bool, is_file: bool, on_message: Callable):
+        receiver = MqttClient("127.0.0.1", self.port, encryption_key=self.key, transfer_dir=self.directory)
+        sender = MqttClient("127.0.0.1", self.port, encryption_key=self.key, wire_format=self.wire_format,
+                            publish_timeout=self.timeout)
+
+        @receiver.endpoint(route, force_json=not is_file, is_file=is_file, secure=secure)
+        def endpoint(client, user_data, message):
+            on_message(message)
+
+        threading.Thread(target=receiver.listen, daemon=True).start()
+        return receiver, sender
+
+    def run(self, scenario: str, size: int, memory: bool = False) -> dict:
+        """
+        Sends `messages` messages of about `size` bytes and waits for all of them to be handled
+        """
+        secure = scenario.endswith("_secure")
+        is_file = scenario.startswith("file")
+        chunked = scenario.startswith("file_chunked")
+        route = f"benchmark/{scenario}/{size}"
+
+        latencies = []
+        received = threading.Event()
+
+        def on_message(message):
+            if is_file:
+                sent_at = message['data']['sent_at']
+            else:
+                sent_at = message[0]['sent_at']
+            latencies.append(time.perf_counter() - sent_at)
+            if len(latencies) == self.messages:
+                received.set()
+
+        receiver, sender = self._clients(route, secure, is_file, on_message)
+        # Lets the receiver subscribe
+        time.sleep(0.3)
+
+        rows = _rows(size)
+        path = os.path.join(self.directory, "payload.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+
+        def send():
+            sent_at = time.perf_counter()
+            if chunked:
+                sender.send_file_chunked(route, path, {"sent_at": sent_at}, secure=secure,
+                                         chunk_size=max(size // 4, 1))
+                return None
+            if is_file:
+                return sender.send_file(route, path, {"sent_at": sent_at}, secure=secure, blocking=False)
+            rows[0]["sent_at"] = sent_at
+            return sender.send_message_serialized(rows, route, valid_json=True, secure=secure, blocking=False)
+
+        if memory:
+            tracemalloc.start()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        handles = [send() for _ in range(self.messages)]
+        for handle in handles:
+            if handle is not None and not handle.wait(self.timeout):
+                raise TimeoutError(f"{scenario} publish wasn't acknowledged in {self.timeout}s")
+        published = time.perf_counter() - start
+        received.wait(self.timeout)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        peak = None
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        sender.close()
+        receiver.client.disconnect()
+        receiver.close()
+        os.remove(path)
+
+        return {
+            "scenario": scenario,
+            "secure": secure,
+            "wire_format": self.wire_format,
+            "payload_bytes": size,
+            "messages": self.messages,
+            "received": len(latencies),
+            "publish_rate": self.messages / published,
+            "delivery_rate": len(latencies) / elapsed,
+            "throughput_bytes": len(latencies) * size / elapsed,
+            "latency_ms": {
+                "p50": _ms(_percentile(latencies, 0.5)),
+                "p90": _ms(_percentile(latencies, 0.9)),
+                "p99": _ms(_percentile(latencies, 0.99)),
+                "max": _ms(max(latencies, default=None))
+            },
+            "cpu_ms_per_message": 1000 * cpu / self.messages,
+            "peak_memory_bytes": peak
+        }
+
+
+def _ms(seconds: float):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def _messages(size: int, budget: int, minimum: int = 5, maximum: int = 2000) -> int:
+    return max(minimum, min(maximum, budget // size))
+
+
+def run(scenarios: List[str], sizes: List[int], budget: int, wire_format: str = "json",
+        memory: bool = True) -> dict:
+    """
+    :param budget: Bytes sent per scenario and size, it sets the number of messages
+    :param memory: Repeat every run with tracemalloc to measure the peak memory, it slows the runs down
+    """
+    context = multiprocessing.get_context("spawn")
+    parent, child = context.Pipe()
+    broker = context.Process(target=serve, args=(child,), daemon=True)
+    broker.start()
+    port = parent.recv()
+
+    results = []
+    try:
+        for scenario in scenarios:
+            for size in sizes:
+                benchmark = Benchmark(port, _messages(size, budget), wire_format)
+                result = benchmark.run(scenario, size)
+                if memory:
+                    result["peak_memory_bytes"] = benchmark.run(scenario, size, memory=True)["peak_memory_bytes"]
+                shutil.rmtree(benchmark.directory, ignore_errors=True)
+                results.append(result)
+                print(f"{scenario:>20} {size:>9}B {result['publish_rate']:>9.1f} msg/s "
+                      f"p99 {result['latency_ms']['p99']}ms", file=sys.stderr)
+    finally:
+        parent.send(None)
+        broker.join(5)
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "max_message_length": Serializer._MAX_MESSAGE_LENGTH_BYTES,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        },
+        "results": results
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    :param tolerance: Allowed relative slowdown, 0.2 allows 20% less throughput or 20% more latency
+    :return: Description of every regression
+    """
+    def key(result: dict):
+        return result["scenario"], result["wire_format"], result["payload_bytes"]
+
+    previous: Dict[tuple, dict] = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        if result["publish_rate"] < old["publish_rate"] * (1 - tolerance):
+            regressions.append(f"{key(result)} publish rate {old['publish_rate']:.1f} -> {result['publish_rate']:.1f}")
+        old_p99, p99 = old["latency_ms"]["p99"], result["latency_ms"]["p99"]
+        if old_p99 is not None and p99 is not None and p99 > old_p99 * (1 + tolerance):
+            regressions.append(f"{key(result)} p99 latency {old_p99}ms -> {p99}ms")
+        if result["received"] < result["messages"]:
+            regressions.append(f"{key(result)} lost {result['messages'] - result['received']} messages")
+    return regressions
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES, help="Payload sizes in bytes")
+    parser.add_argument("--budget", type=int, default=5 * 1000 * 1000, help="Bytes sent per scenario and size")
+    parser.add_argument("--wire-format", choices=["json", "binary"], default="json")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc runs")
+    parser.add_argument("--output", help="File to write the results to, defaults to stdout")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = run(args.scenarios, args.sizes, args.budget, args.wire_format, memory=not args.no_memory)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
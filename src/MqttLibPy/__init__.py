@@ -1 +1 @@
-from . import serializer, client
+from . import serializer, client, publisher, transfer, reassembly, keycache, dispatcher, aio, crypto, envelope, compression, metrics, batcher, router, spool, supervisor, rpc, jsoncodec
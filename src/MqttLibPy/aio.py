@@ -0,0 +1,271 @@
+import asyncio
+import threading
+import traceback
+
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS
+
+from typing import Union, List
+
+from .client import MqttClient
+from .publisher import PublisherPool, PublishHandle, no_delay
+from .transfer import FileTransfer, CHUNK_SIZE
+
+
+class AsyncMqttClient(MqttClient):
+    """
+    asyncio flavour of MqttClient. The paho socket is driven by the event loop, a single
+    connection is shared to listen and to publish, the send methods are awaitable and
+    endpoints can be `async def` functions (sync functions are still supported).
+
+    It must be used from the thread running the event loop.
+    """
+
+    def __init__(self, hostname: str, port: int, *args, connect_timeout: float = 10, **kwargs):
+        """
+        Takes the same arguments as MqttClient, pool_size is ignored since the connection is shared
+        :param connect_timeout: Seconds to wait for the broker to accept the connection
+        """
+        super().__init__(hostname, port, *args, **kwargs)
+        self.connect_timeout = connect_timeout
+
+        self.loop = None
+        self._loop_thread = None
+        self._connected = None
+        self._closed = None
+        self._closing = False
+        self._misc = None
+
+        subscribe = self.client.on_connect
+
+        def _on_connect(client: Client, user_data, flags, rc, properties=None):
+            subscribe(client, user_data, flags, rc, properties)
+            if rc == 0:
+                self._connected.set()
+            else:
+                self.logger.error(f"Connection to {self.hostname}:{self.port} refused: {rc}")
+
+        self.client.on_connect = _on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _publisher_pool(self, pool_size: int) -> PublisherPool:
+        # Publishes through the connection driven by the event loop
+        return PublisherPool(self.hostname, self.port, max_inflight=self.max_inflight, client=self.client)
+
+    def _in_loop(self, callback, *args):
+        if threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client: Client, _, sock):
+        no_delay(client, _, sock)
+        self._in_loop(self._watch, sock)
+
+    def _watch(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        if self._misc is None or self._misc.done():
+            self._misc = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client: Client, _, sock):
+        self._in_loop(self.loop.remove_reader, sock)
+        self._in_loop(self.loop.remove_writer, sock)
+
+    def _on_socket_register_write(self, client: Client, _, sock):
+        self._in_loop(self.loop.add_writer, sock, self.client.loop_write)
+
+    def _on_socket_unregister_write(self, client: Client, _, sock):
+        self._in_loop(self.loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        # Keepalives and retries, stops once the connection is lost
+        while self.client.loop_misc() == MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _on_disconnect(self, client: Client, _, rc, properties=None):
+        self._connected.clear()
+        if not self._closing:
+            self.logger.warning(f"Disconnected from {self.hostname}:{self.port} ({rc}), reconnecting")
+            self._in_loop(self.loop.create_task, self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        while not self._closing:
+            await asyncio.sleep(delay)
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                return
+            except OSError as e:
+                self.logger.warning(f"Reconnection to {self.hostname}:{self.port} failed: {e}")
+                delay = min(delay * 2, 30)
+
+    async def connect(self):
+        """
+        Connects the shared connection, it's called by listen and by the first send
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+            self._connected = asyncio.Event()
+            self._closed = asyncio.Event()
+            self.logger.info(f"Connecting to {self.hostname}:{self.port}")
+            # connect blocks on the TCP handshake, the socket callbacks hop back to the loop
+            await self.loop.run_in_executor(None, self.client.connect, self.hostname, self.port)
+        try:
+            await asyncio.wait_for(self._connected.wait(), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Could not connect to {self.hostname}:{self.port} in {self.connect_timeout}s")
+
+    async def listen(self):
+        """
+        Connects and handles messages until close is called
+        """
+        await self.connect()
+        await self._closed.wait()
+
+    async def drain(self, timeout: float = 10):
+        """
+        Stops receiving messages, lets the endpoints finish the ones already received and closes the client
+        :param timeout: Seconds to wait for the broker to confirm the routes were unsubscribed
+        """
+        filters = self.router.subscriptions() + [topic_filter for group in self.router.groups
+                                                 for topic_filter in self._shared_filters(group)]
+        if filters and self.loop is not None and self.client.is_connected():
+            unsubscribed = asyncio.Event()
+            self.client.on_unsubscribe = lambda *args: self._in_loop(unsubscribed.set)
+            self.client.unsubscribe(filters)
+            # Messages delivered before the UNSUBACK are handled by the time it arrives
+            try:
+                await asyncio.wait_for(unsubscribed.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(f"The broker did not acknowledge the unsubscribe in {timeout}s")
+        await self.close()
+
+    async def close(self):
+        """Disconnects and waits for the dispatched callbacks to finish"""
+        self._closing = True
+        self._metrics_stop.set()
+        if self.loop is None:
+            self._close_spool()
+            return
+        if self.batcher is not None:
+            await self.loop.run_in_executor(None, self.batcher.close)
+        await self.loop.run_in_executor(None, self._close_spool)
+        self.client.disconnect()
+        self.publishers.close()
+        for dispatcher in self.dispatchers:
+            await self.loop.run_in_executor(None, dispatcher.stop)
+        self.requests.close()
+        self.transfers.close()
+        self._closed.set()
+
+    async def _sent(self, handle: PublishHandle, topic: str) -> PublishHandle:
+        future = self.loop.create_future()
+
+        def resolve(completed: PublishHandle):
+            if future.done():
+                return
+            if completed.exception() is not None:
+                future.set_exception(completed.exception())
+            else:
+                future.set_result(completed)
+
+        handle.add_done_callback(lambda completed: self._in_loop(resolve, completed))
+        try:
+            return await asyncio.wait_for(future, self.publish_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"The broker did not acknowledge the message sent to {topic} "
+                               f"in {self.publish_timeout}s")
+
+    async def send_message(self, topic: str, payload: dict) -> PublishHandle:
+        await self.connect()
+        return await self._sent(super().send_message(topic, payload, blocking=False), topic)
+
+    async def send_message_serialized(self, message: Union[List[dict], str], route,
+                                      encodeb64: bool = False, valid_json=False, error=False, secure=False,
+                                      first_fit_decreasing=False, wire_format: str = None) -> PublishHandle:
+        await self.connect()
+        handle = super().send_message_serialized(message, route, encodeb64, valid_json, error, secure,
+                                                 blocking=False, first_fit_decreasing=first_fit_decreasing,
+                                                 wire_format=wire_format)
+        return await self._sent(handle, route)
+
+    async def request(self, route: str, message: Union[List[dict], str], timeout: float = None, secure=False,
+                      wire_format: str = None):
+        """
+        Same as MqttClient.request, waits for the response and returns it
+        """
+        await self.connect()
+        timeout = timeout if timeout is not None else self.request_timeout
+        if not self.requests.acquire(0) and \
+                not await self.loop.run_in_executor(None, self.requests.acquire, timeout):
+            raise TimeoutError(f"{self.requests.max_pending} requests are still waiting for their response")
+        return await asyncio.wrap_future(self._request(route, message, timeout, secure, wire_format))
+
+    async def send_bytes(self, message: bytes, route: str, filename: str = '', metadata: dict = None,
+                         secure=False, wire_format: str = None) -> PublishHandle:
+        await self.connect()
+        handle = super().send_bytes(message, route, filename, metadata, secure, blocking=False,
+                                    wire_format=wire_format)
+        return await self._sent(handle, route)
+
+    async def send_file(self, route: str, filepath: str, metadata: dict = None, secure=False,
+                        wire_format: str = None) -> PublishHandle:
+        def read():
+            with open(filepath, "rb") as f:
+                return f.read()
+
+        await self.connect()
+        file_bytes = await self.loop.run_in_executor(None, read)
+        file_name = filepath.split("/")[-1]
+        self.logger.info(f"Sending {file_name} of length {len(file_bytes)}")
+        return await self.send_bytes(file_bytes, route, file_name, metadata, secure=secure, wire_format=wire_format)
+
+    async def send_file_chunked(self, route: str, filepath: str, metadata: dict = None, secure=False,
+                                chunk_size: int = CHUNK_SIZE, wire_format: str = None) -> FileTransfer:
+        return await self.resume_file(self._file_transfer(route, filepath, metadata, secure, chunk_size,
+                                                          wire_format))
+
+    async def resume_file(self, transfer: FileTransfer) -> FileTransfer:
+        await self.connect()
+        try:
+            for handle in self._transfer_steps(transfer):
+                await self._sent(handle, transfer.route)
+        except Exception as e:
+            e.transfer = transfer
+            raise
+        return transfer
+
+    def endpoint(self, route: str, *args, **kwargs):
+        """
+        Same as MqttClient.endpoint, `async def` callbacks are scheduled on the event loop
+        """
+        register = super().endpoint(route, *args, **kwargs)
+
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                return register(self._scheduled(func, route))
+            return register(func)
+
+        return decorator
+
+    def _scheduled(self, func, route: str):
+        def log_errors(future):
+            if not future.cancelled() and future.exception() is not None:
+                error = future.exception()
+                self.logger.error(f"Error in async endpoint {route} {error}")
+                self.logger.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+        def schedule(*args):
+            if threading.get_ident() == self._loop_thread:
+                future = self.loop.create_task(func(*args))
+            else:
+                # Called from a dispatcher worker
+                future = asyncio.run_coroutine_threadsafe(func(*args), self.loop)
+            future.add_done_callback(log_errors)
+            return future
+
+        return schedule
@@ -0,0 +1,138 @@
+import time
+import threading
+
+from collections import OrderedDict
+from logging import getLogger
+from paho.mqtt.client import MQTTMessage
+from typing import Callable, List
+
+from .publisher import PublishHandle
+from .jsoncodec import dumps, loads
+
+
+# User property of batch messages, its value is the number of messages in the batch
+BATCH_PROPERTY = "batch"
+
+
+class _Batch:
+    __slots__ = ("payloads", "size", "deadline", "handle")
+
+    def __init__(self, deadline: float):
+        self.payloads = []
+        self.size = 2  # "[]"
+        self.deadline = deadline
+        self.handle = PublishHandle()
+
+
+class Batcher:
+    """
+    Coalesces the messages sent to the same topic. A batch is published `linger`
+    seconds after its first message, or as soon as it reaches `max_bytes` or
+    `max_messages`. Batches of a topic are published in order.
+    """
+
+    def __init__(self, publish: Callable[[str, List[bytes]], PublishHandle], linger: float = 0.005,
+                 max_bytes: int = 64 * 1000, max_messages: int = 1000):
+        """
+        :param publish: Publishes the encoded messages of a batch
+        """
+        self.publish = publish
+        self.linger = linger
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+
+        self._batches = OrderedDict()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.logger = getLogger("Mqtt Batcher")
+
+    @property
+    def pending(self) -> int:
+        return sum(len(batch.payloads) for batch in self._batches.values())
+
+    def add(self, topic: str, payload: bytes) -> PublishHandle:
+        """
+        :return: Handle of the batch the message was added to
+        """
+        with self._condition:
+            if self._closed:
+                raise Exception("The batcher is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._linger, name="mqtt-batcher", daemon=True)
+                self._thread.start()
+
+            batch = self._batches.get(topic)
+            if batch is not None and batch.size + 2 + len(payload) > self.max_bytes:
+                self._flush(topic)
+                batch = None
+            if batch is None:
+                batch = self._batches[topic] = _Batch(time.monotonic() + self.linger)
+                if len(self._batches) == 1:
+                    self._condition.notify()
+
+            batch.payloads.append(payload)
+            batch.size += len(payload) + (2 if len(batch.payloads) > 1 else 0)
+            if batch.size >= self.max_bytes or len(batch.payloads) >= self.max_messages:
+                self._flush(topic)
+            return batch.handle
+
+    def flush(self, topic: str = None):
+        """
+        Publishes the pending batch of a topic without waiting for it to linger, or every batch if topic is None
+        """
+        with self._condition:
+            for pending in ([topic] if topic is not None else list(self._batches)):
+                if pending in self._batches:
+                    self._flush(pending)
+
+    def close(self):
+        """Publishes every pending batch and stops lingering"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.flush()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _flush(self, topic: str):
+        # Called with the lock held, so batches of the same topic can't be published out of order
+        batch = self._batches.pop(topic)
+        try:
+            handle = self.publish(topic, batch.payloads)
+        except Exception as e:
+            self.logger.error(f"Could not publish a batch of {len(batch.payloads)} messages to {topic} {e}")
+            batch.handle._complete(e)
+            return
+        handle.add_done_callback(lambda published: batch.handle._complete(published.exception()))
+
+    def _linger(self):
+        with self._condition:
+            while not self._closed:
+                if not self._batches:
+                    self._condition.wait()
+                    continue
+                topic, batch = next(iter(self._batches.items()))
+                delay = batch.deadline - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                self._flush(topic)
+
+
+def is_batch(message: MQTTMessage) -> bool:
+    user_properties = getattr(getattr(message, "properties", None), "UserProperty", None)
+    return bool(user_properties) and any(name == BATCH_PROPERTY for name, _ in user_properties)
+
+
+def unbatch(message: MQTTMessage) -> List[MQTTMessage]:
+    """
+    :return: A message for each message of the batch, as if they had been sent one by one
+    """
+    messages = []
+    for item in loads(message.payload)["data"]:
+        unbatched = MQTTMessage(message.mid, message.topic.encode("utf-8"))
+        unbatched.payload = dumps(item)
+        unbatched.qos = message.qos
+        messages.append(unbatched)
+    return messages
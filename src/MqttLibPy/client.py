@@ -1,28 +1,140 @@
-import json
+import time
+import zlib
+import base64
 import hashlib
+import threading
 import traceback
 
+from collections import deque
+from concurrent.futures import Future
+from uuid import uuid4
+
 from psycopg2 import InterfaceError
 
-from paho.mqtt.publish import single
-from paho.mqtt.client import MQTTv5, Client, MQTTMessage
-from cryptography.fernet import Fernet
+from paho.mqtt.client import MQTTv5, Client, MQTTMessage, topic_matches_sub
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
 
 from logging import getLogger
-from typing import Union, List
+from typing import Union, List, Iterator, Dict
 
 from .serializer import Serializer
+from .publisher import PublisherPool, PublishHandle, no_delay
+from .transfer import FileTransfer, IncomingFile, IncomingTransfers, TransferStore, CHUNK_SIZE, STREAM_CIPHER, \
+    chunk_headers, stream_associated_data
+from .reassembly import ReassemblyBuffer
+from .keycache import KeyCache
+from .dispatcher import Dispatcher, BLOCK
+from .crypto import AeadCipher, StreamCipher
+from .envelope import JSON, BINARY, is_envelope, encode_envelope, decode_envelope, envelope_transfer_id
+from .compression import Codec, register_codec, get_codec, MAX_DECOMPRESSED_SIZE
+from .batcher import Batcher, BATCH_PROPERTY, is_batch, unbatch
+from .router import TopicRouter, topic_wildcards
+from .spool import Spool, Item, DROP_OLDEST
+from .rpc import PendingRequests, REPLY_TOPIC
+from .jsoncodec import dumps, loads, decode_header
+from .metrics import MetricsExporter, NOOP, MESSAGES_SENT, BYTES_SENT, MESSAGES_RECEIVED, BYTES_RECEIVED, \
+    FRAGMENTS_RECEIVED, ERRORS, DECRYPT_FAILURES, DESERIALIZE_SECONDS, DECRYPT_SECONDS, HANDLER_SECONDS, \
+    PENDING_FILES, PENDING_FILE_BYTES, PENDING_FILE_DISK_BYTES, PENDING_TRANSFERS, REASSEMBLY_PENDING, \
+    REASSEMBLY_BYTES, PUBLISH_QUEUE_DEPTH, DISPATCHER_QUEUED, DISPATCHER_DROPPED, SPOOL_PENDING, SPOOL_BYTES, \
+    SPOOL_DROPPED, PENDING_REQUESTS
+
+
+FILE_AAD = b"file"
+FILE_CIPHER_PROPERTY = ("cipher", "aesgcm")
+COMPRESSION_PROPERTY = "compression"
+# Topic a worker receives the halves of its files on, when they're delivered to another worker of the group
+WORKER_INBOX = "mqttlibpy/workers/{group}/{index}"
+FORWARDED_PROPERTY = "forwarded_topic"
+
+
+class _TimedCipher:
+    """Measures the decryption of binary envelopes"""
+
+    def __init__(self, client: "MqttClient", cipher: AeadCipher, route: str):
+        self.client = client
+        self.cipher = cipher
+        self.route = route
+
+    def decrypt(self, data: bytes, associated_data: bytes = None) -> bytes:
+        return self.client._decrypt(self.route, self.cipher.decrypt, data, associated_data)
 
 
 class MqttClient:
 
     def __init__(self, hostname: str, port: int, prefix: str = "", suffix: str = "", uuid="",
                  encryption_key: bytes = '',
-                 encryption_callback=None, qos=2):
+                 encryption_callback=None, qos=2, pool_size: int = 1, max_inflight: int = 20,
+                 publish_timeout: float = None, transfer_dir: str = None,
+                 reassembly_budget: int = 64 * 1000 * 1000, reassembly_timeout: float = 60,
+                 key_cache_size: int = 1024, key_cache_ttl: float = 300, key_cache_key=None,
+                 wire_format: str = JSON, compression: Union[Codec, Dict[str, Codec]] = None,
+                 compression_threshold: int = 1024, file_budget: int = 64 * 1000 * 1000, file_timeout: float = 60,
+                 file_spill_size: int = 1000 * 1000, metrics: MetricsExporter = NOOP,
+                 metrics_interval: float = 10, linger_ms: float = None, batch_bytes: int = 64 * 1000,
+                 batch_messages: int = 1000, route_cache_size: int = 4096, spool_dir: str = None,
+                 spool_max_bytes: int = 1000 * 1000 * 1000, spool_policy: str = DROP_OLDEST,
+                 spool_rate: float = None, spool_fsync: bool = False, request_timeout: float = 30,
+                 max_pending_requests: int = 100, transfer_timeout: float = 300, max_transfers: int = 100,
+                 max_decompressed_size: int = MAX_DECOMPRESSED_SIZE):
+        """
+        :param pool_size: Number of persistent connections used to publish
+        :param max_inflight: Max number of unacknowledged QoS > 0 messages per connection
+        :param publish_timeout: Seconds a blocking send waits for the broker acknowledgement, None waits forever
+        :param transfer_dir: Directory where incoming chunked files are written, defaults to the system temp dir
+        :param reassembly_budget: Max bytes held by incomplete multi part messages
+        :param reassembly_timeout: Seconds an incomplete multi part message waits for its next fragment
+        :param key_cache_size: Max number of keys returned by the encryption callbacks kept in memory
+        :param key_cache_ttl: Seconds a key returned by an encryption callback is cached, None caches it forever
+        :param key_cache_key: Maps a topic to the cache entry of its key (e.g. its tenant), defaults to the topic
+        :param wire_format: Default format of the messages sent, "json" or "binary". Receivers understand both
+        :param compression: Codec used to compress the messages sent, or a dict of topic filters (wildcards
+        allowed) to codecs to compress only some routes. Receivers decompress any registered codec
+        :param compression_threshold: Messages smaller than this many bytes aren't compressed
+        :param file_budget: Max bytes held in memory by files waiting for their metadata
+        :param file_timeout: Seconds a file waits for its metadata (or metadata for its file)
+        :param file_spill_size: Files this big wait for their metadata on disk, in transfer_dir
+        :param metrics: Receives per route counters and latencies, and the size of the buffers and queues.
+        The default one discards them
+        :param metrics_interval: Seconds between reports of the buffers and queues, None only reports them
+        when report_metrics is called
+        :param linger_ms: Enables batching, small json messages sent to the same route within this many
+        milliseconds are published together. Endpoints unpack batches transparently
+        :param batch_bytes: A batch is published as soon as it reaches this size
+        :param batch_messages: A batch is published as soon as it holds this many messages
+        :param route_cache_size: Number of topics whose matching endpoints are kept in memory
+        :param spool_dir: Enables the spool, messages sent while the broker is unreachable are written to this
+        directory and published in order once the connection is back, even after a restart. Chunked files
+        aren't spooled, they're resumed with resume_file
+        :param spool_max_bytes: Max disk usage of the spool
+        :param spool_policy: What to do when the spool is full, "drop_oldest" or "drop_newest"
+        :param spool_rate: Max messages per second published from the spool, None doesn't limit them
+        :param spool_fsync: Flush every spooled message to the disk, survives power losses but it's slower
+        :param request_timeout: Seconds a request waits for its response by default
+        :param max_pending_requests: Max number of requests waiting for a response, request waits for one of
+        them to complete beyond that
+        :param transfer_timeout: Seconds an incoming chunked file waits for its next chunk before it's discarded
+        :param max_transfers: Max number of chunked files received at the same time, the least recently updated
+        is discarded beyond that
+        :param max_decompressed_size: Compressed messages and files bigger than this once decompressed are rejected.
+        Chunks are limited to their chunk size
+        """
         self.prefix = prefix
         self.suffix = suffix
         self.uuid = uuid
         self.qos = qos
+        self.publish_timeout = publish_timeout
+        self.max_inflight = max_inflight
+        self.transfer_dir = transfer_dir
+        self.wire_format = wire_format
+        self.metrics = metrics
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.max_decompressed_size = max_decompressed_size
+        for codec in (compression.values() if isinstance(compression, dict) else [compression] if compression else []):
+            register_codec(codec)
 
         self.hostname = hostname
         self.port = port
@@ -31,189 +143,897 @@ class MqttClient:
             self.encryption_callback = encryption_callback
         else:
             self.encryption_callback = None
+        self.key_cache_size = key_cache_size
+        self.key_cache_ttl = key_cache_ttl
+        self.key_cache_key = key_cache_key
+        self._fernet = Fernet(encryption_key) if encryption_key else None
+        self._cipher = AeadCipher(encryption_key) if encryption_key else None
+        self.keys = KeyCache(encryption_callback, key_cache_size, key_cache_ttl, key_cache_key)
+        self._endpoint_keys = []
+        self.dispatchers = []
 
         self.routes = []
-        self.files = {}
+        self.router = TopicRouter(route_cache_size)
+        self.files = TransferStore(file_budget, file_timeout, spill_size=file_spill_size, directory=transfer_dir)
+        self.transfers = IncomingTransfers(transfer_timeout, max_transfers, transfer_dir)
+        self.reassembly = ReassemblyBuffer(reassembly_budget, reassembly_timeout)
+        self.request_timeout = request_timeout
+        self.requests = PendingRequests(max_pending_requests, metrics)
+        # Responses to the requests of this client, subscribed on the first request
+        self.reply_topic = REPLY_TOPIC.format(client_id=uuid4().hex)
+        self._replies_subscribed = False
+
+        # Index of this process and number of processes, when the client is run by a Supervisor
+        self.worker = None
+        # Whether the broker tells which subscription a message is delivered for, see _delivery_group
+        self._subscription_identifiers = True
 
         self.client = Client("", userdata=None, protocol=MQTTv5)
 
-        def _on_connect(client: Client, _, __, ___, ____):
-            for route in self.routes:
-                client.subscribe(route)
+        def _on_connect(client: Client, _, __, ___, properties=None):
+            self._subscription_identifiers = getattr(properties, "SubscriptionIdentifierAvailable", 1) != 0
+            if self.router.groups and not self._subscription_identifiers:
+                self.logger.warning(f"{self.hostname}:{self.port} doesn't support subscription identifiers, "
+                                    f"messages matching both plain and share_group routes are only handled "
+                                    f"by the plain ones")
+            # A single SUBSCRIBE per group, without the filters covered by wider ones
+            subscriptions = self.router.subscriptions()
+            if self.worker is not None:
+                subscriptions += [self._inbox(group, self.worker[0]) for group in self.router.groups]
+            if subscriptions:
+                client.subscribe([(topic_filter, 0) for topic_filter in subscriptions])
+            for identifier, group in enumerate(self.router.groups, 1):
+                # Tells which subscription a message is delivered for when a plain one matches it too
+                properties = Properties(PacketTypes.SUBSCRIBE)
+                properties.SubscriptionIdentifier = identifier
+                client.subscribe([(topic_filter, 0) for topic_filter in self._shared_filters(group)],
+                                 properties=properties)
+            for publisher in self.publishers.publishers:
+                if publisher.client is client:
+                    # The connection is shared with a publisher, e.g. by AsyncMqttClient
+                    publisher.resubscribe()
 
         self.client.on_connect = _on_connect
+        self.client.on_message = self._on_message
+        self.client.on_socket_open = no_delay
+
+        self.publishers = self._publisher_pool(pool_size)
 
         self.logger = getLogger("Mqtt Client")
 
-    def send_message(self, topic: str, payload: dict):
-        print(f'Sending message to {topic}')
-        json_payload = json.dumps(payload)
+        self.spool = None
+        self.spool_rate = spool_rate
+        self._spool_stop = threading.Event()
+        self._spool_thread = None
+        if spool_dir is not None:
+            self.spool = Spool(spool_dir, spool_max_bytes, policy=spool_policy, fsync=spool_fsync)
+            self._spool_thread = threading.Thread(target=self._drain_spool, name="mqtt-spool", daemon=True)
+            self._spool_thread.start()
+
+        self.batcher = None
+        if linger_ms is not None:
+            self.batcher = Batcher(self._send_batch, linger_ms / 1000, batch_bytes, batch_messages)
+
+        self._metrics_stop = threading.Event()
+        if metrics.enabled and metrics_interval:
+            threading.Thread(target=self._report_metrics_loop, args=(metrics_interval,),
+                             name="mqtt-metrics", daemon=True).start()
+
+    def _publisher_pool(self, pool_size: int) -> PublisherPool:
+        """
+        Builds the connections used to publish, before anything (e.g. the spool) starts publishing
+        """
+        return PublisherPool(self.hostname, self.port, pool_size, self.max_inflight)
+
+    def send_message(self, topic: str, payload: dict, blocking=None, handle: PublishHandle = None) -> PublishHandle:
+        """
+        :param blocking: Wait for the broker to acknowledge the message, defaults to not waiting in linger mode
+        :param handle: Existing handle to attach this publish to
+        :return: Handle that completes when the message is acknowledged
+        """
+        if self.batcher is not None:
+            return self._batch(topic, Serializer.encode_packet(payload), blocking, handle)
+        return self._send_packet(topic, payload, blocking=blocking is not False, handle=handle)
 
-        self._send_string(topic, json_payload)
+    def _batch(self, topic: str, payload: bytes, blocking=None, handle: PublishHandle = None) -> PublishHandle:
+        batch_handle = self.batcher.add(topic, payload)
+        if handle is not None:
+            batch_handle.add_done_callback(lambda published: handle._complete(published.exception()))
+        else:
+            handle = batch_handle
+        if blocking:
+            self.publishers.for_topic(topic).connect()
+            self.batcher.flush(topic)
+            self._wait(handle, topic)
+        return handle
+
+    def _send_batch(self, topic: str, payloads: List[bytes]) -> PublishHandle:
+        self.logger.debug(f"Sending a batch of {len(payloads)} messages to {topic}")
+        payload = Serializer.encode_packet(Serializer(self.uuid).serialize_batch(payloads))
+        handle = self._publish(topic, [(topic, payload, [(BATCH_PROPERTY, str(len(payloads)))])])
+        self._count_sent(topic, len(payload))
+        return handle
+
+    def flush(self, topic: str = None):
+        """
+        Publishes the messages waiting in linger mode without waiting for their batch to fill up
+        :param topic: Only flush the batch of this topic
+        """
+        if self.batcher is not None:
+            self.batcher.flush(topic)
+
+    def _send_packet(self, topic: str, payload: dict, blocking=True, handle: PublishHandle = None) -> PublishHandle:
+        self.logger.debug(f'Sending message to {topic}')
+        json_payload = Serializer.encode_packet(payload)
+
+        return self._send_string(topic, json_payload, blocking=blocking, handle=handle)
 
     def send_message_serialized(self, message: Union[List[dict], str], route,
-                                encodeb64: bool = False, valid_json=False, error=False, secure=False):
+                                encodeb64: bool = False, valid_json=False, error=False, secure=False,
+                                blocking=None, first_fit_decreasing=False, wire_format: str = None) -> PublishHandle:
         """
         :param message: List of dicts or string to send.
         :param route: topic to send message to
         :param encodeb64: Not implemented
         :param valid_json: Indicates "message" is a valid parsable json (list[dict])
         :param error: Indicates this is an error message
+        :param blocking: Wait until every fragment is acknowledged, otherwise the returned handle can be waited on.
+        Defaults to not waiting in linger mode
+        :param first_fit_decreasing: Pack json objects in as few fragments as possible, objects in
+        different fragments may arrive out of order
+        :param wire_format: "json" or "binary", defaults to the client's wire format
+        """
+        binary = (wire_format or self.wire_format) == BINARY
+        # Binary envelopes encrypt the whole body themselves
+        json_messages = self._serializer(route, secure and not binary).serialize(message, encodeb64, valid_json, is_error=error, encrypt=secure and not binary, pre_encoded=True, first_fit_decreasing=first_fit_decreasing)
+        cipher = self._get_cipher(route) if secure and binary else None
+
+        if self.batcher is not None:
+            if len(json_messages) == 1 and not binary:
+                return self._batch(route, Serializer.encode_packet(json_messages[0]), blocking)
+            # Keeps the order of the messages sent to the route
+            self.batcher.flush(route)
+        blocking = blocking if blocking is not None else self.batcher is None
+
+        encode = (lambda packet: encode_envelope(packet, cipher)) if binary else Serializer.encode_packet
+        payloads = [encode(serialized_message) for serialized_message in json_messages]
+        self.logger.debug(f'Sending message to {route}')
+        # Fragments are published, or spooled, together
+        handle = self._publish(route, [(route, payload, None) for payload in payloads], blocking=blocking)
+        self._count_sent(route, sum(map(len, payloads)), len(payloads))
+        if blocking:
+            self._wait(handle, route)
+        return handle
+
+    def request(self, route: str, message: Union[List[dict], str], timeout: float = None, secure=False,
+                wire_format: str = None) -> Future:
+        """
+        Sends a request to an endpoint, whatever the endpoint returns is sent back as the response.
+        Requests are published right away, they aren't batched nor spooled
+        :param message: List of dicts (json) or string
+        :param timeout: Seconds to wait for the response, defaults to request_timeout. It also bounds the wait
+        for a free slot when max_pending_requests are already waiting
+        :return: Future of the response, it fails with TimeoutError if none arrives in time and with
+        the error of the endpoint if it raised
+        """
+        timeout = timeout if timeout is not None else self.request_timeout
+        if not self.requests.acquire(timeout):
+            raise TimeoutError(f"{self.requests.max_pending} requests are still waiting for their response")
+        return self._request(route, message, timeout, secure, wire_format)
+
+    def _request(self, route: str, message: Union[List[dict], str], timeout: float, secure=False,
+                 wire_format: str = None) -> Future:
+        try:
+            payloads = self._encode_packets(message, route, secure, (wire_format or self.wire_format) == BINARY,
+                                            valid_json=isinstance(message, list))
+        except Exception:
+            self.requests.release()
+            raise
+        correlation, future = self.requests.add(route, timeout, secure)
+        # Sent after the reply subscription through the same connection, so the broker handles it first
+        publisher = self.publishers.for_topic(self.reply_topic)
+        if not self._replies_subscribed:
+            self._replies_subscribed = True
+            publisher.subscribe(self.reply_topic, self._on_reply, self.qos)
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ResponseTopic = self.reply_topic
+        properties.CorrelationData = correlation
+        handle = PublishHandle(len(payloads))
+        for payload in payloads:
+            publisher.publish(route, payload, qos=self.qos, properties=properties, handle=handle)
+        self._count_sent(route, sum(map(len, payloads)), len(payloads))
+
+        def published(handle: PublishHandle):
+            if handle.exception() is not None:
+                self.requests.resolve(correlation, error=handle.exception())
+
+        handle.add_done_callback(published)
+        return future
+
+    def _on_reply(self, client: Client, user_data, message: MQTTMessage):
+        correlation = getattr(message.properties, "CorrelationData", None)
+        request = self.requests.get(correlation)
+        if request is None:
+            self.logger.debug("Discarding a response to an unknown or expired request")
+            return
+        try:
+            # Encrypted with the key of the route the request was sent to
+            packet = self._decode_packet(message, request.secure, route=request.route, key_topic=request.route)
+            data = Serializer.assemble(packet, packet['data'], self.reassembly, len(message.payload),
+                                       key=correlation)
+        except Exception as e:
+            self.requests.resolve(correlation, error=e)
+            return
+        if data is None:
+            # Waiting for the rest of the fragments
+            return
+        if packet['error']:
+            self.requests.resolve(correlation, error=Exception(f"Request to {request.route} failed: {data}"))
+        else:
+            self.requests.resolve(correlation, data)
+
+    def _encode_packets(self, message: Union[List[dict], str], topic: str, secure: bool, binary: bool,
+                        endpoint_keys: KeyCache = None, **options) -> List[bytes]:
         """
-        json_messages = Serializer(self.uuid, self.encryption_key or self.encryption_callback and self.encryption_callback(route)).serialize(message, encodeb64, valid_json, is_error=error, encrypt=secure)
+        Serializes a message in either wire format, encrypted with the key of the topic
+        :param options: Passed to Serializer.serialize
+        """
+        packets = self._serializer(topic, secure and not binary, endpoint_keys).serialize(
+            message, encrypt=secure and not binary, pre_encoded=True, **options)
+        if not binary:
+            return [Serializer.encode_packet(packet) for packet in packets]
+        cipher = self._get_cipher(topic, endpoint_keys) if secure else None
+        return [encode_envelope(packet, cipher) for packet in packets]
+
+    def _responder(self, func, message: MQTTMessage, secure: bool, endpoint_keys: KeyCache, route: str):
+        """
+        Wraps the callback of an endpoint so what it returns, or raises, is sent back when the message is a request
+        """
+        reply_topic = getattr(message.properties, "ResponseTopic", None)
+        if not reply_topic:
+            return func
+        correlation = getattr(message.properties, "CorrelationData", None)
+
+        def respond(result, error: bool = False):
+            try:
+                self._respond(reply_topic, correlation, result, error, message.topic, secure, endpoint_keys, route)
+            except Exception as e:
+                self.logger.error(f"Could not respond to the request received on {message.topic}: {e}")
+
+        def finished(future):
+            if future.cancelled():
+                respond("The endpoint was cancelled", error=True)
+            elif future.exception() is not None:
+                respond(str(future.exception()), error=True)
+            else:
+                respond(future.result())
+
+        def call(*args):
+            try:
+                result = func(*args)
+            except Exception as e:
+                respond(str(e), error=True)
+                raise
+            if hasattr(result, 'add_done_callback'):
+                # The callback was scheduled (e.g. a coroutine), responds once it finishes
+                result.add_done_callback(finished)
+            else:
+                respond(result)
+            return result
+
+        return call
 
-        for serialized_message in json_messages:
-            self.send_message(route, serialized_message)
+    def _respond(self, reply_topic: str, correlation: bytes, result, error: bool, topic: str, secure: bool,
+                 endpoint_keys: KeyCache, route: str):
+        """
+        :param topic: Topic the request was received on, the response is encrypted with its key
+        """
+        if result is None:
+            result = ""
+        elif isinstance(result, dict):
+            result = [result]
+        elif not isinstance(result, (list, str)):
+            result, error = f"Unsupported response type {type(result).__name__}", True
+        payloads = self._encode_packets(result, topic, secure, self.wire_format == BINARY, endpoint_keys,
+                                        valid_json=isinstance(result, list), is_error=error)
+        properties = Properties(PacketTypes.PUBLISH)
+        if correlation is not None:
+            properties.CorrelationData = correlation
+        publisher = self.publishers.for_topic(reply_topic)
+        handle = PublishHandle(len(payloads))
+        for payload in payloads:
+            publisher.publish(reply_topic, payload, qos=self.qos, properties=properties, handle=handle)
+        self._count_sent(route, sum(map(len, payloads)), len(payloads))
+
+    def _send_string(self, topic: str, payload: Union[str, bytes], blocking=True,
+                     handle: PublishHandle = None) -> PublishHandle:
+        self.logger.debug(f"Sending string to {topic}")
+        handle = self._publish(topic, [(topic, payload, None)], handle, blocking)
+        self._count_sent(topic, len(payload))
+        if blocking:
+            self._wait(handle, topic)
+        return handle
+
+    def _publish(self, route: str, items: List[Item], handle: PublishHandle = None,
+                 blocking: bool = False) -> PublishHandle:
+        """
+        Publishes messages through the connection of the route. They're spooled instead while the connection
+        is down or older messages are still spooled, the handle then completes once they're on disk
+        :param items: Topic, payload and user properties of each message
+        :param blocking: Wait for the first connection to the broker, otherwise the messages are queued
+        """
+        if handle is None:
+            handle = PublishHandle(len(items))
+        publisher = self.publishers.for_topic(route)
+        publisher.connect(wait=blocking)
+        if self.spool is not None:
+            if self.spool.pending or not publisher.connected:
+                try:
+                    self.spool.append(route, self.qos, items)
+                except Exception as e:
+                    handle._complete(e)
+                    return handle
+                for _ in items:
+                    handle._complete()
+                return handle
+        for topic, payload, user_properties in items:
+            publisher.publish(topic, payload, qos=self.qos, properties=self._properties(user_properties),
+                              handle=handle)
+        return handle
 
-    def _send_string(self, topic: str, payload: Union[str, bytes]):
-        print(f"Sending string to {topic}")
-        single(topic, payload, hostname=self.hostname, port=self.port, protocol=MQTTv5, qos=self.qos)
+    @staticmethod
+    def _properties(user_properties: List[tuple] = None) -> Union[None, Properties]:
+        if not user_properties:
+            return None
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = user_properties
+        return properties
 
-    def send_bytes(self, message: bytes, route: str, filename: str = '', metadata: dict = None, secure=False):
+    def _drain_spool(self):
+        """
+        Publishes the spooled messages in order once the connection is back, at most spool_rate per second.
+        A record is forgotten once the broker acknowledges every message in it and the ones before it
+        """
+        inflight = deque()
+        next_publish = time.monotonic()
+        while not self._spool_stop.is_set():
+            while inflight and inflight[0][0].done():
+                handle, record = inflight.popleft()
+                if handle.exception() is None:
+                    self.spool.commit(record)
+                    continue
+                self.logger.warning(f"Could not publish spooled messages to {record.route}, "
+                                    f"retrying: {handle.exception()}")
+                # Publishes them again, in order
+                inflight.clear()
+                self.spool.rewind()
+                self._spool_stop.wait(1)
+            if len(inflight) >= self.max_inflight:
+                self._wait_quietly(inflight[0][0], 1)
+                continue
+            if not self._connected_publishers():
+                self._spool_stop.wait(1)
+                continue
+
+            record = self.spool.read(0.01 if inflight else 1)
+            if record is None or self._spool_stop.is_set():
+                continue
+            if self.spool_rate:
+                delay = next_publish - time.monotonic()
+                if delay > 0:
+                    self._spool_stop.wait(delay)
+                next_publish = max(next_publish, time.monotonic()) + len(record.items) / self.spool_rate
+            publisher = self.publishers.for_topic(record.route)
+            handle = PublishHandle(len(record.items))
+            for topic, payload, user_properties in record.items:
+                publisher.publish(topic, payload, qos=record.qos, properties=self._properties(user_properties),
+                                  handle=handle)
+            inflight.append((handle, record))
+
+    def _close_spool(self):
+        if self.spool is None:
+            return
+        self._spool_stop.set()
+        self.spool.wake()
+        self._spool_thread.join()
+        self.spool.close()
+
+    def _connected_publishers(self) -> bool:
+        for publisher in self.publishers.publishers:
+            publisher.connect()
+        return all(publisher.connected for publisher in self.publishers.publishers)
+
+    @staticmethod
+    def _wait_quietly(handle: PublishHandle, timeout: float):
+        try:
+            handle.wait(timeout)
+        except Exception:
+            # Handled by whoever checks the handle
+            pass
+
+    def _wait(self, handle: PublishHandle, topic: str):
+        if not handle.wait(self.publish_timeout):
+            raise TimeoutError(f"The broker did not acknowledge the message sent to {topic} "
+                               f"in {self.publish_timeout}s")
+
+    def send_bytes(self, message: bytes, route: str, filename: str = '', metadata: dict = None, secure=False,
+                   blocking=True, wire_format: str = None) -> PublishHandle:
+        """
+        :param wire_format: "json" or "binary", defaults to the client's wire format. Binary transfers encrypt
+        the file with AES-GCM instead of Fernet, so it isn't base64 encoded
+        """
         if metadata is None:
             metadata = {}
+        binary = (wire_format or self.wire_format) == BINARY
 
         # Mandar la metadata por route y el archivo por route/
-        serialized_message = (Serializer(self.uuid, self.encryption_key or self.encryption_callback and self.encryption_callback(route))
-                              .serialize(message, filename=filename, metadata=metadata, encrypt=secure))
+        serializer = self._serializer(route, secure and not binary)
+        serialized_message = serializer.serialize(message, filename=filename, metadata=metadata,
+                                                  encrypt=secure and not binary)
+        # The digest in the metadata is the one of the uncompressed file
+        message, compressed = serializer.compress_bytes(message)
 
+        # Metadata and body go through the same connection, and are spooled together
+        items = []
         for msg in serialized_message:
-            if secure and (self.encryption_key or self.encryption_callback):
+            user_properties = [("transfer_id", msg["transfer_id"])]
+            if compressed:
+                user_properties.append((COMPRESSION_PROPERTY, serializer.codec.name))
+            if secure and binary:
+                cipher = self._get_cipher(route)
+                message = cipher.encrypt(message, FILE_AAD)
+                user_properties.append(FILE_CIPHER_PROPERTY)
+                header = encode_envelope(msg, cipher)
+            elif secure and (self.encryption_key or self.encryption_callback):
                 message = self._get_fernet(route).encrypt(message)
+                header = Serializer.encode_packet(msg)
             elif secure:
                 raise Exception("No encryption key was provided to the client in order to send an encrypted message")
+            else:
+                header = encode_envelope(msg) if binary else Serializer.encode_packet(msg)
 
-            self.send_message(route, msg)
-            self._send_string(f"{route}/file", message)
+            items.append((route, header, None))
+            items.append((f"{route}/file", message, user_properties))
+            self._count_sent(route, len(header) + len(message), 2)
+        self.logger.debug(f'Sending message to {route}')
+        handle = self._publish(route, items, blocking=blocking)
+        if blocking:
+            self._wait(handle, route)
+        return handle
 
-    def send_file(self, route: str, filepath: str, metadata: dict = None, secure=False):
+    def send_file(self, route: str, filepath: str, metadata: dict = None, secure=False,
+                  blocking=True, wire_format: str = None) -> PublishHandle:
         if metadata is None:
             metadata = {}
         with open(filepath, "rb") as f:
             file_name = f.name.split("/")[-1]
             file_bytes = f.read()
-        print(f"Sending {file_name} of length {len(file_bytes)}")
-        self.send_bytes(file_bytes, route, file_name, metadata, secure=secure)
+        self.logger.debug(f"Sending {file_name} of length {len(file_bytes)}")
+        return self.send_bytes(file_bytes, route, file_name, metadata, secure=secure, blocking=blocking,
+                               wire_format=wire_format)
 
-    def register_route(self, route, callback, pure_route=False):
-        if not pure_route:
-            topic = f'{self.prefix}{route}{self.suffix}'
-        else:
-            topic = route
+    def send_file_chunked(self, route: str, filepath: str, metadata: dict = None, secure=False,
+                          chunk_size: int = CHUNK_SIZE, wire_format: str = None) -> FileTransfer:
+        """
+        Streams a file of any size in numbered chunks to {route}/file. Memory usage is bounded by
+        chunk_size * max_inflight. If the transfer is interrupted, pass the returned transfer
+        (also available as the exception's `transfer` attribute) to resume_file.
+        :param chunk_size: Size in bytes of each chunk
+        :param wire_format: "json" or "binary", defaults to the client's wire format. Binary transfers are
+        encrypted as a single AES-GCM stream instead of a Fernet token per chunk
+        :return: The transfer state
+        """
+        return self.resume_file(self._file_transfer(route, filepath, metadata, secure, chunk_size, wire_format))
+
+    def _file_transfer(self, route: str, filepath: str, metadata: dict, secure: bool, chunk_size: int,
+                       wire_format: str = None) -> FileTransfer:
+        if secure and not (self.encryption_key or self.encryption_callback):
+            raise Exception("No encryption key was provided to the client in order to send an encrypted message")
+        return FileTransfer(route, filepath, chunk_size, metadata, secure,
+                            streaming=(wire_format or self.wire_format) == BINARY)
+
+    def resume_file(self, transfer: FileTransfer) -> FileTransfer:
+        """
+        Sends the chunks of a transfer that weren't acknowledged by the broker yet
+        """
+        try:
+            for handle in self._transfer_steps(transfer):
+                self._wait(handle, transfer.route)
+        except Exception as e:
+            e.transfer = transfer
+            raise
+        return transfer
+
+    def _transfer_steps(self, transfer: FileTransfer) -> Iterator[PublishHandle]:
+        """
+        Publishes a transfer, yielding the handles that must complete before it goes on. The
+        caller waits for each handle, so the same steps work for blocking and async senders.
+        """
+        route = transfer.route
+        publisher = self.publishers.for_topic(route)
+        # Every step is waited for anyway
+        publisher.connect()
+        fernet = self._get_fernet(route) if transfer.secure and transfer.salt is None else None
+        stream = None
+        if transfer.secure and transfer.salt is not None:
+            stream = StreamCipher(self._get_key(route), transfer.salt,
+                                  stream_associated_data(transfer.transfer_id, transfer.total_chunks))
+        serializer = self._serializer(route, False)
+
+        if not transfer.metadata_sent:
+            header = (self._serializer(route, transfer.secure)
+                      .serialize_file_header(transfer.filename, transfer.transfer_id, transfer.size,
+                                             transfer.total_chunks, transfer.chunk_size, transfer.metadata,
+                                             encrypt=transfer.secure))
+            self.logger.info(f"Sending {transfer.filename} of length {transfer.size} "
+                             f"in {transfer.total_chunks} chunks")
+            header = dumps(header)
+            self._count_sent(route, len(header))
+            yield publisher.publish(route, header, qos=self.qos)
+            transfer.metadata_sent = True
+
+        inflight = deque()
+        for index, chunk in transfer.chunks(transfer.acked):
+            properties = transfer.chunk_properties(index)
+            chunk, compressed = serializer.compress_bytes(chunk)
+            if compressed:
+                properties.UserProperty = (COMPRESSION_PROPERTY, serializer.codec.name)
+            if fernet:
+                chunk = fernet.encrypt(chunk)
+            elif stream:
+                chunk = stream.encrypt(index, chunk, index == transfer.total_chunks - 1)
+            inflight.append(publisher.publish(f"{route}/file", chunk, qos=self.qos, properties=properties))
+            self._count_sent(route, len(chunk))
+            # Bounded window, a chunk is only read once an older one is acknowledged
+            if len(inflight) >= self.max_inflight:
+                yield inflight.popleft()
+                transfer.acked += 1
+        while inflight:
+            yield inflight.popleft()
+            transfer.acked += 1
+
+    def register_route(self, route, callback, pure_route=False, with_wildcards=False, share_group: str = None):
+        """
+        :param with_wildcards: The callback takes the topic levels matched by the wildcards of the route
+        as a fourth argument
+        :param share_group: Subscribe through the $share/{share_group}/ shared subscription
+        """
+        topic = self._topic_filter(route, pure_route)
 
         self.routes.append(topic)
-        print(f"Listening to topic: {topic}")
-        self.client.message_callback_add(topic, callback)
+        self.logger.info(f"Listening to topic: {topic}" + (f" in group {share_group}" if share_group else ""))
+        self.router.add(topic, callback, with_wildcards, share_group)
+
+    def _topic_filter(self, route: str, pure_route=False) -> str:
+        return route if pure_route else f'{self.prefix}{route}{self.suffix}'
+
+    def _shared_filters(self, group: str) -> List[str]:
+        return [f"$share/{group}/{topic_filter}" for topic_filter in self.router.subscriptions(group)]
+
+    @staticmethod
+    def _inbox(group: str, index: int) -> str:
+        return WORKER_INBOX.format(group=group, index=index)
+
+    def _on_message(self, client: Client, user_data, message: MQTTMessage):
+        groups = self.router.groups
+        group = None
+        if groups and self.worker is not None and message.topic.startswith(WORKER_INBOX.split("{")[0]):
+            group = self._forwarded_group(message)
+            if group is None:
+                return
+        elif groups:
+            group = self._delivery_group(message, groups)
+        matches = self.router.match(message.topic)
+        if group is not None or len({route.group for route, _ in matches}) > 1:
+            # Plain and shared routes both match, each subscription delivers its own copy. The identifier
+            # tells the shared copies apart, copies without one are handled by the plain routes
+            matches = [match for match in matches if match[0].group == group]
+        if not matches:
+            self.logger.debug(f"No endpoint listens to {message.topic}")
+        for route, segments in matches:
+            if route.with_wildcards:
+                route.callback(client, user_data, message, segments)
+            else:
+                route.callback(client, user_data, message)
+
+    @staticmethod
+    def _delivery_group(message: MQTTMessage, groups: List[str]) -> Union[None, str]:
+        """
+        :return: Shared subscription group the message was delivered for, None for the plain subscriptions
+        """
+        identifiers = getattr(message.properties, "SubscriptionIdentifier", None)
+        if identifiers and 0 < identifiers[0] <= len(groups):
+            return groups[identifiers[0] - 1]
+        return None
+
+    def _forwarded_group(self, message: MQTTMessage) -> Union[None, str]:
+        """
+        Restores the topic of a message forwarded by another worker
+        :return: Shared subscription group the message was delivered for, None if it wasn't forwarded by a worker
+        """
+        user_properties = dict(getattr(message.properties, "UserProperty", None) or [])
+        levels = message.topic.split("/")
+        topic = user_properties.get(FORWARDED_PROPERTY)
+        if topic is None or len(levels) != 4:
+            self.logger.warning(f"Dropped a message sent to the worker inbox {message.topic} without its topic")
+            return None
+        message._topic = topic.encode("utf-8")
+        return levels[2]
+
+    def _forward(self, message: MQTTMessage, group: str, metadata: bool) -> bool:
+        """
+        Sends the half of a file (metadata, body or chunk) delivered through a shared subscription to the
+        worker that owns its transfer, so the halves of a file are handled by the same process. The owner
+        is picked by the transfer id, bodies sent without one are handled by whoever receives them
+        :return: Whether the message was forwarded
+        """
+        if self.worker is None or self.worker[1] < 2:
+            return False
+        user_properties = list(getattr(message.properties, "UserProperty", None) or [])
+        transfer_id = dict(user_properties).get("transfer_id")
+        if transfer_id is None and metadata:
+            try:
+                if is_envelope(message.payload):
+                    transfer_id = envelope_transfer_id(message.payload)
+                else:
+                    # The body of the metadata isn't needed to pick the owner
+                    packet = decode_header(message.payload)
+                    transfer_id = packet.get("transfer_id") or packet.get("md5_hash")
+            except Exception:
+                # Reported by the endpoint
+                return False
+        if not transfer_id:
+            return False
+        owner = zlib.crc32(transfer_id.encode("utf-8")) % self.worker[1]
+        if owner == self.worker[0]:
+            return False
+
+        topic = self._inbox(group, owner)
+        user_properties.append((FORWARDED_PROPERTY, message.topic))
+        handle = self.publishers.for_topic(topic).publish(topic, message.payload, qos=self.qos,
+                                                          properties=self._properties(user_properties))
+
+        def forwarded(handle: PublishHandle):
+            if handle.exception() is not None:
+                self.logger.error(f"Could not forward {message.topic} to worker {owner}: {handle.exception()}")
+
+        handle.add_done_callback(forwarded)
+        return True
 
     def listen(self):
-        print(f"Connecting to {self.hostname}:{self.port}")
+        self.logger.info(f"Connecting to {self.hostname}:{self.port}")
         self.client.connect(self.hostname, self.port)
         self.client.loop_forever()
 
-    def endpoint(self, route: str, force_json=False, is_file=False, secure=False, endpoint_encryption_callback=None, pure_route=False):
+    def drain(self, timeout: float = 10):
+        """
+        Stops receiving messages, lets the endpoints finish the ones already received and closes the client,
+        e.g. before a worker exits. The network loop must be running in another thread
+        :param timeout: Seconds to wait for the broker to confirm the routes were unsubscribed
+        """
+        filters = self.router.subscriptions() + [topic_filter for group in self.router.groups
+                                                 for topic_filter in self._shared_filters(group)]
+        if filters and self.client.is_connected():
+            unsubscribed = threading.Event()
+            self.client.on_unsubscribe = lambda *args: unsubscribed.set()
+            self.client.unsubscribe(filters)
+            # Messages delivered before the UNSUBACK are handled by the time it arrives
+            if not unsubscribed.wait(timeout):
+                self.logger.warning(f"The broker did not acknowledge the unsubscribe in {timeout}s")
+        self.client.disconnect()
+        self.close()
+
+    def close(self):
+        """
+        Disconnects the publisher connections and waits for the dispatched callbacks to finish. Messages
+        still in the spool are published the next time a client opens it
+        """
+        self._metrics_stop.set()
+        if self.batcher is not None:
+            self.batcher.close()
+        self._close_spool()
+        self.publishers.close()
+        for dispatcher in self.dispatchers:
+            dispatcher.stop()
+        self.requests.close()
+        self.transfers.close()
+
+    def endpoint(self, route: str, force_json=False, is_file=False, secure=False, endpoint_encryption_callback=None, pure_route=False,
+                 concurrency: int = None, ordering_key=None, queue_size: int = 1000, backpressure: str = BLOCK,
+                 batch=False, wildcards=False, share_group: str = None):
         """
         :param route: part of the route to listen to, the final route will be of the form {prefix}{route}{suffix}
-        :param force_json: The message payload is in json format, and will be passed to the callback as a dict
+        :param force_json: The message payload is in json format, and will be passed to the callback as a dict.
+        Multi part messages are reassembled and passed to the callback once complete
         :param is_file: Indicates if the type of payload is a bytes object
         :param secure: Whether to decrypt payloads with the provided key or not
         :param endpoint_encryption_callback: Custom encryption callback for this specific endpoint
+        :param concurrency: Run the callback on this many worker threads instead of the network thread.
+        Messages are decoded on the network thread and handed to the workers
+        :param ordering_key: function(topic, data) returning the key messages are ordered by, defaults to the topic.
+        Messages with the same key are handled in order by the same worker
+        :param queue_size: Max number of messages waiting on each worker
+        :param backpressure: What to do when a worker queue is full: "block", "drop_newest" or "drop_oldest"
+        :param batch: Call the callback once per batch with the list of its messages instead of once per message.
+        Messages that weren't batched by the sender are passed in a list of one
+        :param wildcards: Pass the topic levels matched by the wildcards of the route (e.g. the company in
+        company/+/orders) to the callback as a fourth argument, and to endpoint_encryption_callback as a second
+        one. The keys returned by endpoint_encryption_callback are then cached per levels instead of per topic
+        :param share_group: Subscribe through a shared subscription, each message is delivered to a single client
+        of the group, e.g. one of the workers of a Supervisor. The metadata and body of a file are handled by
+        the same worker
+
+        The value returned by json and raw endpoints is sent back when the message is a request (see request):
+        a list of dicts or a dict as json, a string as text and None as an empty text. Exceptions are sent back
+        as errors
         :return:
         """
+        endpoint_keys = None
+        if endpoint_encryption_callback:
+            topic_filter = self._topic_filter(route, pure_route)
+            segments = (lambda topic: topic_wildcards(topic_filter, topic)) if wildcards else None
+            endpoint_keys = KeyCache(endpoint_encryption_callback, self.key_cache_size, self.key_cache_ttl,
+                                     self.key_cache_key, wildcards=segments)
+            self._endpoint_keys.append(endpoint_keys)
+
+        dispatcher = None
+        if concurrency:
+            dispatcher = Dispatcher(concurrency, queue_size, backpressure, name=route, metrics=self.metrics)
+            self.dispatchers.append(dispatcher)
+
+        def run(topic: str, data, callback, *args):
+            if self.metrics.enabled:
+                args = (route, callback) + args
+                callback = self._timed
+            if dispatcher is None:
+                return callback(*args)
+            key = ordering_key(topic, data) if ordering_key else topic
+            dispatcher.submit(key, callback, *args)
+
         def decorator(func):
-            def wrapper_json(client: Client, _, message: MQTTMessage):
+            def decode_json(message: MQTTMessage, packet: dict = None):
+                parsed_message = self._decode_packet(message, secure, endpoint_keys, route, packet)
+                if parsed_message.get('total_fragments', 1) > 1 and self.metrics.enabled:
+                    self.metrics.increment(FRAGMENTS_RECEIVED, route)
+                return Serializer.assemble(parsed_message, parsed_message['data'], self.reassembly,
+                                           len(message.payload), key=message.topic)
+
+            def wrapper_json(client: Client, _, message: MQTTMessage, segments: List[str] = None):
+                handler = self._responder(self._with_wildcards(func, segments), message, secure, endpoint_keys,
+                                          route)
+                start = self._count_received(route, message)
                 try:
-                    parsed_message = json.loads(message.payload)
-                    encryption_key = (self.encryption_key or self.encryption_callback
-                                      and self.encryption_callback(message.topic))
-                    if endpoint_encryption_callback:
-                        encryption_key = endpoint_encryption_callback(message.topic)
-                    if secure:
-                        parsed_message['data'] = (Serializer(self.uuid, encryption_key)
-                                                  .decrypt_str(parsed_message['data']))
-                        parsed_message['data'] = json.loads(parsed_message['data'])
-                    return func(client, _, parsed_message['data'])
+                    if is_batch(message):
+                        items = [decode_json(message, packet) for packet in loads(message.payload)['data']]
+                        items = [data for data in items if data is not None]
+                    else:
+                        data = decode_json(message)
+                        # None while waiting for the rest of the fragments
+                        items = [data] if data is not None else []
+                    if start is not None:
+                        self.metrics.observe(DESERIALIZE_SECONDS, route, time.perf_counter() - start)
+                    if batch:
+                        return run(message.topic, items, handler, client, _, items) if items else None
+                    for data in items:
+                        run(message.topic, data, handler, client, _, data)
                 except InterfaceError as e:
+                    self.metrics.increment(ERRORS, route)
                     self.logger.error(f"Error in json endpoint {route}")
                     self.logger.error(e)
                     tb = traceback.format_exc()
                     self.logger.error(tb)
                     raise InterfaceError("Database error, re initializing cursor")
                 except Exception as e:
+                    self.metrics.increment(ERRORS, route)
                     self.logger.error(f"Error in json endpoint {route}")
                     self.logger.error(e)
                     tb = traceback.format_exc()
                     self.logger.error(tb)
 
-            def wrapper_files(client: Client, user_data, message):
+            def wrapper_files(client: Client, user_data, message, segments: List[str] = None):
+                if share_group is not None and self._forward(message, share_group, metadata=False):
+                    return
+                handler = self._with_wildcards(func, segments)
+                self._count_received(route, message)
                 try:
-                    if secure:
-                        file_bytes = self._get_fernet(message.topic).decrypt(message.payload)
+                    headers = chunk_headers(message.properties)
+                    if headers is not None:
+                        return self._receive_chunk(run, handler, client, user_data, message, headers, secure,
+                                                   endpoint_keys, route)
+                    user_properties = dict(getattr(message.properties, "UserProperty", None) or [])
+                    if secure and user_properties.get(FILE_CIPHER_PROPERTY[0]) == FILE_CIPHER_PROPERTY[1]:
+                        file_bytes = self._decrypt(route, self._get_cipher(message.topic, endpoint_keys).decrypt,
+                                                   message.payload, FILE_AAD)
+                    elif secure:
+                        file_bytes = self._decrypt(route, self._get_fernet(message.topic, endpoint_keys).decrypt,
+                                                   message.payload)
                     else:
                         file_bytes = message.payload
-                    md5_hash = hashlib.md5(file_bytes).hexdigest()
-                    if md5_hash in self.files:
-                        self.files[md5_hash]['bytes'] = file_bytes
-                    else:
-                        # File arrived before the metadata, this shouldn't happen
-                        self.logger.warning(f"File arrived before metadata. Hash: {md5_hash}")
-                        self.files[md5_hash] = {}
-                        self.files[md5_hash]['bytes'] = file_bytes
-                        return
-
-                    func(client, user_data, self.files[md5_hash])
-
-                    # Cleanup
-                    del self.files[md5_hash]
+                    if COMPRESSION_PROPERTY in user_properties:
+                        file_bytes = get_codec(user_properties[COMPRESSION_PROPERTY]).decompress(
+                            file_bytes, self.max_decompressed_size)
+                    # Older senders don't send a transfer id, their files are paired by digest
+                    transfer_id = user_properties.get('transfer_id') or hashlib.md5(file_bytes).hexdigest()
+                    file = self.files.add_body(transfer_id, file_bytes)
+                    if file is not None:
+                        self._complete_file(run, handler, client, user_data, file, message.topic)
                 except Exception as e:
+                    self.metrics.increment(ERRORS, route)
                     self.logger.error(f"Error in file endpoint {route}")
                     self.logger.error(e)
                     tb = traceback.format_exc()
                     self.logger.error(tb)
 
-            def wrapper_files_metadata(client: Client, user_data, message):
+            def wrapper_files_metadata(client: Client, user_data, message, segments: List[str] = None):
+                if share_group is not None and self._forward(message, share_group, metadata=True):
+                    return
+                handler = self._with_wildcards(func, segments)
+                start = self._count_received(route, message)
                 try:
-                    parsed_message = json.loads(message.payload)
-                    if secure:
-                        bytes_json = self._get_fernet(message.topic).decrypt(parsed_message['data'].encode('utf-8'))
-                        string_json = bytes_json.decode('utf-8')
-                        parsed_message['data'] = json.loads(string_json)
+                    parsed_message = self._decode_packet(message, secure, endpoint_keys, route)
+                    if start is not None:
+                        self.metrics.observe(DESERIALIZE_SECONDS, route, time.perf_counter() - start)
 
                     if not isinstance(parsed_message['data'], dict):
-                        parsed_message['data'] = json.loads(parsed_message['data'])
+                        parsed_message['data'] = loads(parsed_message['data'])
 
                     if parsed_message['type'] != 'file':
                         self.logger.warning(
                             f"A message of type {parsed_message['type']} was received on a file endpoint")
                         return
 
-                    if parsed_message['md5_hash'] in self.files:
-                        # Metadata arrived late
-                        self.files[parsed_message['md5_hash']]['md5_hash'] = parsed_message['md5_hash']
-                        self.files[parsed_message['md5_hash']]['filename'] = parsed_message['data']['filename']
-                        self.files[parsed_message['md5_hash']]['from'] = parsed_message['from']
-                        self.files[parsed_message['md5_hash']]['data'] = parsed_message['data']
-                        func(client, user_data, self.files[parsed_message['md5_hash']])
-                        del self.files[parsed_message['md5_hash']]
-                    else:
-                        self.files[parsed_message['md5_hash']] = {
-                            'md5_hash': parsed_message['md5_hash'],
+                    if parsed_message.get('chunked'):
+                        transfer = self._incoming_transfer(parsed_message['transfer_id'],
+                                                           parsed_message['total_chunks'],
+                                                           parsed_message['chunk_size'])
+                        if transfer is None:
+                            return
+                        transfer.metadata = {
+                            'md5_hash': '',
                             'filename': parsed_message['data']['filename'],
                             'from': parsed_message['from'],
-                            'bytes': b'',
-                            'data': parsed_message['data']
+                            'data': parsed_message['data'],
+                            'size': parsed_message['size']
                         }
+                        return self._finish_transfer(run, handler, client, user_data, transfer, message.topic)
+
+                    file = self.files.add_metadata(parsed_message.get('transfer_id') or parsed_message['md5_hash'], {
+                        'md5_hash': parsed_message['md5_hash'],
+                        'filename': parsed_message['data']['filename'],
+                        'from': parsed_message['from'],
+                        'data': parsed_message['data']
+                    })
+                    if file is not None:
+                        # Metadata arrived late
+                        self._complete_file(run, handler, client, user_data, file, message.topic)
                 except Exception as e:
+                    self.metrics.increment(ERRORS, route)
                     self.logger.error(f"Error in metadata endpoint {route} {e}")
                     tb = traceback.format_exc()
                     self.logger.error(tb)
 
             if force_json:
-                self.register_route(route, wrapper_json, pure_route=pure_route)
+                self.register_route(route, wrapper_json, pure_route=pure_route, with_wildcards=wildcards,
+                                    share_group=share_group)
             elif is_file:
-                self.register_route(route, wrapper_files_metadata, pure_route=pure_route)
-                self.register_route(f"{route}/file", wrapper_files, pure_route=pure_route)
+                self.register_route(route, wrapper_files_metadata, pure_route=pure_route, with_wildcards=wildcards,
+                                    share_group=share_group)
+                self.register_route(f"{route}/file", wrapper_files, pure_route=pure_route, with_wildcards=wildcards,
+                                    share_group=share_group)
             else:
-                self.register_route(route, func, pure_route=pure_route)
+                def wrapper_raw(client: Client, user_data, message: MQTTMessage, segments: List[str] = None):
+                    handler = self._responder(self._with_wildcards(func, segments), message, secure,
+                                              endpoint_keys, route)
+                    self._count_received(route, message)
+                    messages = unbatch(message) if is_batch(message) else [message]
+                    if batch:
+                        return run(message.topic, messages, handler, client, user_data, messages)
+                    for item in messages:
+                        run(message.topic, item, handler, client, user_data, item)
+
+                self.register_route(route, wrapper_raw, pure_route=pure_route, with_wildcards=wildcards,
+                                    share_group=share_group)
 
             def inner(*args, **kwargs):
                 pass
@@ -222,6 +1042,226 @@ class MqttClient:
 
         return decorator
 
-    def _get_fernet(self, topic: str) -> Union[None, Fernet]:
-        key = self.encryption_key or self.encryption_callback(topic)
-        return Fernet(key)
+    @staticmethod
+    def _with_wildcards(func, segments: List[str] = None):
+        if segments is None:
+            return func
+        return lambda *args: func(*args, segments)
+
+    def _complete_file(self, run, func, client: Client, user_data, file: dict, topic: str):
+        if file['md5_hash'] and hashlib.md5(file['bytes']).hexdigest() != file['md5_hash']:
+            self.logger.error(f"File {file['filename']} failed the integrity check, discarding it")
+            return
+        run(topic, file, func, client, user_data, file)
+
+    def _incoming_transfer(self, transfer_id: str, total_chunks: int,
+                           chunk_size: int) -> Union[None, IncomingFile]:
+        """
+        :return: None if the transfer already completed, e.g. for chunks redelivered or resent after completion
+        """
+        transfer = self.transfers.get(transfer_id, total_chunks, chunk_size)
+        if transfer is None:
+            self.logger.debug(f"Dropping a message of the chunked file {transfer_id}, it was already received")
+        return transfer
+
+    def _receive_chunk(self, run, func, client: Client, user_data, message: MQTTMessage, headers: dict,
+                       secure: bool, endpoint_keys: KeyCache = None, route: str = None):
+        data = message.payload
+        index, total_chunks = int(headers['chunk']), int(headers['total_chunks'])
+        transfer = self._incoming_transfer(headers['transfer_id'], total_chunks, int(headers['chunk_size']))
+        if transfer is None:
+            return
+        if secure and headers.get('cipher') == STREAM_CIPHER:
+            if transfer.cipher is None:
+                transfer.cipher = StreamCipher(self._get_key(message.topic, endpoint_keys),
+                                               bytes.fromhex(headers['salt']),
+                                               stream_associated_data(transfer.transfer_id, total_chunks))
+            data = self._decrypt(route, transfer.cipher.decrypt, index, data, index == total_chunks - 1)
+        elif secure:
+            data = self._decrypt(route, self._get_fernet(message.topic, endpoint_keys).decrypt, data)
+        if COMPRESSION_PROPERTY in headers:
+            data = get_codec(headers[COMPRESSION_PROPERTY]).decompress(data, transfer.chunk_size)
+        if 'md5_hash' in headers:
+            transfer.md5_hash = headers['md5_hash']
+        transfer.write_chunk(index, data)
+        self._finish_transfer(run, func, client, user_data, transfer, message.topic)
+
+    def _finish_transfer(self, run, func, client: Client, user_data, transfer: IncomingFile, topic: str):
+        """
+        Calls the file endpoint once every chunk and the metadata have arrived. The file is handed
+        to the callback as a path instead of bytes, it's deleted after the callback returns unless moved.
+        """
+        if not transfer.complete:
+            return
+        self.transfers.finish(transfer)
+        if not transfer.verify():
+            self.logger.error(f"Chunked file {transfer.transfer_id} failed the integrity check, discarding it")
+            transfer.discard()
+            return
+        transfer.close()
+        file = dict(transfer.metadata, md5_hash=transfer.md5_hash, bytes=None, path=transfer.path)
+        run(topic, file, self._deliver_file, func, client, user_data, file, transfer)
+
+    @staticmethod
+    def _deliver_file(func, client: Client, user_data, file: dict, transfer: IncomingFile):
+        try:
+            result = func(client, user_data, file)
+        except Exception:
+            transfer.discard()
+            raise
+        if hasattr(result, 'add_done_callback'):
+            # The callback was scheduled (e.g. a coroutine), keep the file until it finishes
+            result.add_done_callback(lambda _: transfer.discard())
+        else:
+            transfer.discard()
+
+    def _decode_packet(self, message: MQTTMessage, secure: bool, endpoint_keys: KeyCache = None,
+                       route: str = None, packet: dict = None, key_topic: str = None) -> dict:
+        """
+        Parses a packet in either wire format. The data of packets received by secure endpoints is decrypted
+        :param route: Route the measurements are labeled with
+        :param packet: Already parsed packet, e.g. one of a batch
+        :param key_topic: Topic whose key decrypts the packet, defaults to the topic of the message
+        """
+        key_topic = key_topic or message.topic
+        if packet is None and is_envelope(message.payload):
+            cipher = self._get_cipher(key_topic, endpoint_keys) if secure else None
+            if cipher is not None and self.metrics.enabled:
+                cipher = _TimedCipher(self, cipher, route)
+            packet = decode_envelope(message.payload, cipher, self.max_decompressed_size)
+            if secure and not packet['encrypted']:
+                raise Exception(f"Unencrypted message received on secure endpoint {message.topic}")
+            return packet
+
+        if packet is None:
+            packet = loads(message.payload)
+        if packet.get('compression'):
+            if secure:
+                compressed = self._decrypt(route, self._get_fernet(key_topic, endpoint_keys).decrypt,
+                                           packet['data'].encode('utf-8'))
+            else:
+                compressed = base64.b64decode(packet['data'])
+            packet['data'] = Serializer.decompress_data(packet, compressed, self.max_decompressed_size)
+        elif secure:
+            fernet = self._get_fernet(key_topic, endpoint_keys)
+            data = self._decrypt(route, fernet.decrypt, packet['data'].encode('utf-8'))
+            # Text isn't json unless it's flagged as such, json is parsed straight from the decrypted bytes
+            packet['data'] = data.decode('utf-8') if packet.get('type') == 'text' and not packet.get('is_valid_json') \
+                else loads(data)
+        return packet
+
+    def _decrypt(self, route: str, decrypt, *args) -> bytes:
+        if not self.metrics.enabled:
+            return decrypt(*args)
+        start = time.perf_counter()
+        try:
+            data = decrypt(*args)
+        except (InvalidToken, InvalidTag):
+            self.metrics.increment(DECRYPT_FAILURES, route)
+            raise
+        self.metrics.observe(DECRYPT_SECONDS, route, time.perf_counter() - start)
+        return data
+
+    def _timed(self, route: str, callback, *args):
+        start = time.perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            self.metrics.observe(HANDLER_SECONDS, route, time.perf_counter() - start)
+
+    def _count_sent(self, route: str, size: int, messages: int = 1):
+        if self.metrics.enabled:
+            self.metrics.increment(MESSAGES_SENT, route, messages)
+            self.metrics.increment(BYTES_SENT, route, size)
+
+    def _count_received(self, route: str, message: MQTTMessage):
+        """
+        :return: When the message started being handled, None when the metrics are disabled
+        """
+        if not self.metrics.enabled:
+            return None
+        self.metrics.increment(MESSAGES_RECEIVED, route)
+        self.metrics.increment(BYTES_RECEIVED, route, len(message.payload))
+        return time.perf_counter()
+
+    def report_metrics(self):
+        """
+        Reports the size of the buffers and queues of the client to the metrics exporter
+        """
+        self.metrics.gauge(PENDING_FILES, self.files.pending)
+        self.metrics.gauge(PENDING_FILE_BYTES, self.files.bytes)
+        self.metrics.gauge(PENDING_FILE_DISK_BYTES, self.files.disk_bytes)
+        self.metrics.gauge(PENDING_TRANSFERS, len(self.transfers))
+        self.metrics.gauge(REASSEMBLY_PENDING, self.reassembly.pending)
+        self.metrics.gauge(REASSEMBLY_BYTES, self.reassembly.bytes)
+        self.metrics.gauge(PUBLISH_QUEUE_DEPTH, self.publishers.inflight)
+        if self.spool is not None:
+            self.metrics.gauge(SPOOL_PENDING, self.spool.pending)
+            self.metrics.gauge(SPOOL_BYTES, self.spool.bytes)
+            self.metrics.gauge(SPOOL_DROPPED, self.spool.dropped)
+        self.metrics.gauge(PENDING_REQUESTS, self.requests.pending)
+        for dispatcher in self.dispatchers:
+            self.metrics.gauge(DISPATCHER_QUEUED, dispatcher.queued, dispatcher.name)
+            self.metrics.gauge(DISPATCHER_DROPPED, dispatcher.dropped, dispatcher.name)
+
+    def _report_metrics_loop(self, interval: float):
+        while not self._metrics_stop.wait(interval):
+            try:
+                self.report_metrics()
+            except Exception as e:
+                self.logger.error(f"Error reporting metrics {e}")
+
+    def _get_key(self, topic: str, endpoint_keys: KeyCache = None) -> bytes:
+        if endpoint_keys is not None:
+            return endpoint_keys.get_key(topic)
+        if self.encryption_key:
+            return self.encryption_key
+        if self.encryption_callback is None:
+            raise Exception("No encryption key was provided to the client in order to encrypt or decrypt a message")
+        return self.keys.get_key(topic)
+
+    def _get_cipher(self, topic: str, endpoint_keys: KeyCache = None) -> AeadCipher:
+        if endpoint_keys is not None:
+            return endpoint_keys.get_cipher(topic)
+        if self._cipher is not None:
+            return self._cipher
+        if self.encryption_callback is None:
+            raise Exception("No encryption key was provided to the client in order to encrypt or decrypt a message")
+        return self.keys.get_cipher(topic)
+
+    def _get_fernet(self, topic: str, endpoint_keys: KeyCache = None) -> Fernet:
+        """
+        :param endpoint_keys: Key cache of an endpoint with its own encryption callback
+        """
+        if endpoint_keys is not None:
+            return endpoint_keys.get_fernet(topic)
+        if self._fernet is not None:
+            return self._fernet
+        if self.encryption_callback is None:
+            raise Exception("No encryption key was provided to the client in order to encrypt or decrypt a message")
+        return self.keys.get_fernet(topic)
+
+    def _serializer(self, topic: str, secure: bool, endpoint_keys: KeyCache = None) -> Serializer:
+        codec = self._codec(topic)
+        if not secure:
+            return Serializer(self.uuid, codec=codec, compression_threshold=self.compression_threshold,
+                              metrics=self.metrics, route=topic)
+        return Serializer(self.uuid, fernet=self._get_fernet(topic, endpoint_keys), codec=codec,
+                          compression_threshold=self.compression_threshold, metrics=self.metrics, route=topic)
+
+    def _codec(self, topic: str) -> Union[None, Codec]:
+        if not isinstance(self.compression, dict):
+            return self.compression
+        for topic_filter, codec in self.compression.items():
+            if topic_matches_sub(topic_filter, topic):
+                return codec
+        return None
+
+    def invalidate_keys(self, topic: str = None):
+        """
+        Forgets cached keys so they're requested again from the encryption callbacks, e.g. after a key rotation
+        :param topic: Any topic using the key to forget, None forgets every key
+        """
+        self.keys.invalidate(topic)
+        for keys in self._endpoint_keys:
+            keys.invalidate(topic)
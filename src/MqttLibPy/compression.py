@@ -0,0 +1,88 @@
+import zlib
+import hashlib
+
+from typing import Dict
+
+
+# Senders pack up to 16 times MAX_MESSAGE_LENGTH bytes of json in a compressed fragment, see
+# Serializer._compressed_limit. Receivers refuse to decompress more, e.g. a decompression bomb
+MAX_DECOMPRESSED_SIZE = 16 * 10 * 1000 * 1000
+
+
+class Codec:
+    """
+    Compression algorithm. Packets carry the name of the codec that compressed
+    them, the receiver looks it up with get_codec so both sides must register it.
+    """
+    name: str = None
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes, max_length: int = None) -> bytes:
+        """
+        :param max_length: Max size of the decompressed data, None doesn't limit it
+        :raises: When the data decompresses to more than max_length bytes
+        """
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+
+    def __init__(self, level: int = 6, zdict: bytes = None, name: str = None):
+        """
+        :param level: 1 (fastest) to 9 (smallest)
+        :param zdict: Shared dictionary, samples of typical payloads (e.g. a few records of a route).
+        Small messages compress much better with it, the receiver needs the same dictionary
+        :param name: Defaults to "zlib", or to "zlib-" and a digest of the dictionary
+        """
+        self.level = level
+        self.zdict = zdict
+        if name is None:
+            name = "zlib" if zdict is None else f"zlib-{hashlib.sha1(zdict).hexdigest()[:12]}"
+        self.name = name
+
+    def compress(self, data: bytes) -> bytes:
+        if self.zdict is None:
+            return zlib.compress(data, self.level)
+        compressor = zlib.compressobj(self.level, zdict=self.zdict)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes, max_length: int = None) -> bytes:
+        if self.zdict is None and max_length is None:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj() if self.zdict is None else zlib.decompressobj(zdict=self.zdict)
+        if max_length is None:
+            return decompressor.decompress(data) + decompressor.flush()
+        # One byte over the limit tells a stream that fits exactly from one that doesn't
+        decompressed = decompressor.decompress(data, max_length + 1)
+        if len(decompressed) > max_length or decompressor.unconsumed_tail:
+            raise Exception(f"Compressed data bigger than {max_length} bytes once decompressed")
+        return decompressed + decompressor.flush()
+
+
+_CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec) -> Codec:
+    """
+    Makes a codec available to decompress received messages, codecs used to send are registered too
+    """
+    registered = _CODECS.get(codec.name)
+    if registered is not None and registered is not codec:
+        # Equivalent codecs (e.g. two zlib codecs with different levels) can share a name
+        if type(registered) is not type(codec) or getattr(registered, "zdict", None) != getattr(codec, "zdict", None):
+            raise Exception(f"A different codec named {codec.name} is already registered")
+        return codec
+    _CODECS[codec.name] = codec
+    return codec
+
+
+def get_codec(name: str) -> Codec:
+    codec = _CODECS.get(name)
+    if codec is None:
+        raise Exception(f"Unknown compression codec {name}, it must be registered with register_codec")
+    return codec
+
+
+ZLIB = register_codec(ZlibCodec())
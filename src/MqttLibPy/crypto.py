@@ -0,0 +1,72 @@
+import os
+import base64
+import struct
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+SALT_SIZE = 16
+# Chunk position and whether it's the last chunk, padded to a nonce
+_STREAM_NONCE = struct.Struct("!7xIB")
+
+
+class AeadCipher:
+    """
+    AES-GCM cipher keyed from the same Fernet keys used by the rest of the library,
+    its output is raw bytes instead of base64 tokens.
+    """
+
+    def __init__(self, key: bytes, purpose: bytes = b"envelope"):
+        """
+        :param key: Fernet key (urlsafe base64 of 32 bytes)
+        :param purpose: Keys derived for different purposes are independent
+        """
+        derived = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                       info=b"MqttLibPy " + purpose).derive(base64.urlsafe_b64decode(key))
+        self._aead = AESGCM(derived)
+
+    def encrypt(self, data: bytes, associated_data: bytes = None) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, associated_data)
+
+    def decrypt(self, data: bytes, associated_data: bytes = None) -> bytes:
+        """
+        :raises cryptography.exceptions.InvalidTag: The data or the associated data were tampered with
+        """
+        view = memoryview(data)
+        return self._aead.decrypt(view[:NONCE_SIZE], view[NONCE_SIZE:], associated_data)
+
+
+class StreamCipher:
+    """
+    Chunked AES-GCM for payloads sent in several messages (the STREAM construction). Each
+    stream derives its own key from a random salt, and the nonce of a chunk is its position
+    plus whether it's the last one, so chunks can't be reordered, moved to another stream or
+    dropped from the end without failing to decrypt. Chunks are encrypted and decrypted on
+    their own, in any order, and the output is raw bytes with a 16 bytes tag per chunk.
+    """
+
+    def __init__(self, key: bytes, salt: bytes = None, associated_data: bytes = None):
+        """
+        :param key: Fernet key (urlsafe base64 of 32 bytes)
+        :param salt: Salt of the stream being decrypted, a new one is generated to encrypt
+        :param associated_data: Authenticated along with every chunk, e.g. the id and length of the stream
+        """
+        self.salt = salt if salt is not None else os.urandom(SALT_SIZE)
+        self.associated_data = associated_data
+        derived = HKDF(algorithm=hashes.SHA256(), length=32, salt=self.salt,
+                       info=b"MqttLibPy stream").derive(base64.urlsafe_b64decode(key))
+        self._aead = AESGCM(derived)
+
+    def encrypt(self, index: int, data: bytes, last: bool) -> bytes:
+        return self._aead.encrypt(_STREAM_NONCE.pack(index, last), data, self.associated_data)
+
+    def decrypt(self, index: int, data: bytes, last: bool) -> bytes:
+        """
+        :raises cryptography.exceptions.InvalidTag: The chunk was tampered with or isn't at this position
+        """
+        return self._aead.decrypt(_STREAM_NONCE.pack(index, last), data, self.associated_data)
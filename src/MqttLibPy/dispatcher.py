@@ -0,0 +1,110 @@
+import queue
+import threading
+import traceback
+
+from logging import getLogger
+from typing import List, Hashable, Callable
+
+from .metrics import MetricsExporter, NOOP, ERRORS
+
+
+BLOCK = "block"
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+
+_STOP = object()
+
+
+class Dispatcher:
+    """
+    Runs endpoint callbacks on a pool of worker threads instead of paho's network
+    thread. Every worker has its own bounded queue and calls with the same ordering
+    key always go to the same worker, so they run in the order they arrived.
+
+    When a queue is full the backpressure policy decides what happens:
+    `block` waits for room (stalling the network thread), `drop_newest` discards
+    the incoming call and `drop_oldest` discards the oldest queued one.
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 1000, backpressure: str = BLOCK, name: str = "",
+                 metrics: MetricsExporter = NOOP):
+        if workers < 1:
+            raise ValueError("A dispatcher needs at least 1 worker")
+        if backpressure not in (BLOCK, DROP_NEWEST, DROP_OLDEST):
+            raise ValueError(f"Unknown backpressure policy {backpressure}")
+        self.workers = workers
+        self.backpressure = backpressure
+        self.name = name
+        self.metrics = metrics
+        self.dropped = 0
+
+        self._queues: List[queue.Queue] = [queue.Queue(queue_size) for _ in range(workers)]
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.logger = getLogger("Mqtt Dispatcher")
+
+    @property
+    def queued(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for n, worker_queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._work, args=(worker_queue,),
+                                          name=f"mqtt-dispatcher-{self.name}-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self, worker_queue: queue.Queue):
+        while True:
+            item = worker_queue.get()
+            if item is _STOP:
+                return
+            callback, args = item
+            try:
+                callback(*args)
+            except Exception as e:
+                self.metrics.increment(ERRORS, self.name)
+                self.logger.error(f"Error in dispatched callback {self.name} {e}")
+                self.logger.error(traceback.format_exc())
+
+    def submit(self, key: Hashable, callback: Callable, *args):
+        """
+        Queues callback(*args) on the worker that owns key
+        """
+        if not self._threads:
+            self._start()
+        worker_queue = self._queues[hash(key) % self.workers]
+        item = (callback, args)
+
+        if self.backpressure == BLOCK:
+            worker_queue.put(item)
+            return
+        while True:
+            try:
+                worker_queue.put_nowait(item)
+                return
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                if self.backpressure == DROP_NEWEST:
+                    self.logger.warning(f"Dispatcher {self.name} queue is full, dropping message")
+                    return
+                try:
+                    worker_queue.get_nowait()
+                    self.logger.warning(f"Dispatcher {self.name} queue is full, dropping oldest message")
+                except queue.Empty:
+                    pass
+
+    def stop(self):
+        """
+        Lets the workers finish every queued call and stops them
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for worker_queue in self._queues[:len(threads)]:
+            worker_queue.put(_STOP)
+        for thread in threads:
+            thread.join()
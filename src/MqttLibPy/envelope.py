@@ -0,0 +1,130 @@
+import struct
+
+from uuid import UUID
+
+from .crypto import AeadCipher
+from .compression import get_codec, MAX_DECOMPRESSED_SIZE
+from .jsoncodec import dumps, loads
+
+
+JSON = "json"
+BINARY = "binary"
+
+# 0xB1 can't start an UTF-8 text, so a binary envelope is never mistaken for a json packet
+MAGIC = b"\xb1M"
+VERSION = 1
+
+_HEADER = struct.Struct("!2sBBHII16s16sB")
+
+_TYPES = ["json", "text", "file"]
+
+FLAG_ENCRYPTED = 1
+FLAG_ERROR = 2
+FLAG_VALID_JSON = 4
+FLAG_LAST = 8
+FLAG_ENCODED = 16
+# The codec name follows the sender id, prefixed by its length
+FLAG_COMPRESSED = 32
+
+
+def is_envelope(payload: bytes) -> bool:
+    return payload[:2] == MAGIC
+
+
+def encode_envelope(packet: dict, cipher: AeadCipher = None) -> bytes:
+    """
+    Encodes a packet made by Serializer.serialize (unencrypted) as a binary envelope:
+    a fixed header, the sender id and the raw body. When a cipher is given the body is
+    encrypted with the header as associated data. Compressed packets keep their data as is.
+    """
+    data = packet["data"]
+    if isinstance(data, (bytes, bytearray)):
+        body = data
+    elif isinstance(data, str):
+        body = data.encode("utf-8")
+    else:
+        body = dumps(data)
+
+    flags = ((FLAG_ENCRYPTED if cipher is not None else 0)
+             | (FLAG_ERROR if packet.get("error") else 0)
+             | (FLAG_VALID_JSON if packet.get("is_valid_json") else 0)
+             | (FLAG_LAST if packet.get("last_fragment", True) else 0)
+             | (FLAG_ENCODED if packet.get("encoded") else 0)
+             | (FLAG_COMPRESSED if packet.get("compression") else 0))
+    sender = (packet.get("from") or "").encode("utf-8")
+    if len(sender) > 255:
+        raise ValueError("Sender id can't be longer than 255 bytes in a binary envelope")
+    digest = bytes.fromhex(packet["md5_hash"]) if packet.get("md5_hash") else bytes(16)
+    message_id = UUID(hex=packet["message_id"]).bytes if packet.get("message_id") else bytes(16)
+
+    header = _HEADER.pack(MAGIC, VERSION, _TYPES.index(packet["type"]), flags,
+                          packet.get("current_fragment", 0), packet.get("total_fragments", 1),
+                          digest, message_id, len(sender)) + sender
+    if packet.get("compression"):
+        codec = packet["compression"].encode("utf-8")
+        header += bytes([len(codec)]) + codec
+    if cipher is not None:
+        body = cipher.encrypt(body, header)
+    return header + body
+
+
+def envelope_transfer_id(payload: bytes) -> str:
+    """
+    :return: Id pairing the metadata of a file with its body, read from the header without decrypting the envelope
+    """
+    _, _, _, _, _, _, digest, message_id, _ = _HEADER.unpack_from(payload)
+    return message_id.hex() if any(message_id) else digest.hex()
+
+
+def decode_envelope(payload: bytes, cipher: AeadCipher = None,
+                    max_decompressed_size: int = MAX_DECOMPRESSED_SIZE) -> dict:
+    """
+    Decodes a binary envelope into the same packet dict a json packet has, with its data
+    already decrypted and parsed
+    :param max_decompressed_size: Envelopes whose body decompresses to more bytes are rejected
+    :raises ValueError: The envelope is encrypted and no cipher was given
+    """
+    view = memoryview(payload)
+    magic, version, message_type, flags, current, total, digest, message_id, sender_length = \
+        _HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ValueError(f"Unsupported envelope version {version}")
+    sender_end = _HEADER.size + sender_length
+    header_length = sender_end
+    compression = ""
+    if flags & FLAG_COMPRESSED:
+        header_length += 1 + view[sender_end]
+        compression = bytes(view[sender_end + 1:header_length]).decode("utf-8")
+    body = view[header_length:]
+
+    if flags & FLAG_ENCRYPTED:
+        if cipher is None:
+            raise ValueError("The envelope is encrypted but no key was provided")
+        body = cipher.decrypt(body, view[:header_length])
+    if compression:
+        body = get_codec(compression).decompress(bytes(body), max_decompressed_size)
+
+    message_type = _TYPES[message_type]
+    if message_type == "text" and not flags & FLAG_VALID_JSON:
+        data = bytes(body).decode("utf-8")
+    else:
+        data = loads(body)
+
+    packet = {
+        "data": data,
+        "message_id": message_id.hex() if any(message_id) else "",
+        "current_fragment": current,
+        "total_fragments": total,
+        "last_fragment": bool(flags & FLAG_LAST),
+        "is_valid_json": bool(flags & FLAG_VALID_JSON),
+        "error": bool(flags & FLAG_ERROR),
+        "type": message_type,
+        "encrypted": bool(flags & FLAG_ENCRYPTED),
+        "encoded": bool(flags & FLAG_ENCODED),
+        "md5_hash": digest.hex() if any(digest) else "",
+        "from": bytes(view[_HEADER.size:sender_end]).decode("utf-8")
+    }
+    if message_type == "file":
+        # The body of a file is paired with its metadata by the message id
+        packet["transfer_id"] = packet["message_id"]
+    return packet
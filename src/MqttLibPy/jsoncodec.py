@@ -0,0 +1,133 @@
+import json
+import math
+
+from enum import Enum
+from uuid import UUID
+from typing import Union
+
+
+_DATA_KEY = b'"data":'
+
+
+class JsonCodec:
+    """
+    Encodes and parses the json of the packets. Works on bytes, parsing accepts bytes, memoryview
+    or str so payloads don't have to be decoded to str first. This one uses the standard library
+    """
+    name: str = "json"
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, default=_default).encode("utf-8")
+
+    def loads(self, data: Union[bytes, bytearray, memoryview, str]):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson backend, several times faster. Both backends write the same json for the same values:
+    what orjson handles differently, e.g. integers over 64 bits, NaN or datetimes, goes through
+    the standard library, which writes or rejects it as usual
+    """
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+                        | orjson.OPT_PASSTHROUGH_SUBCLASS)
+
+    def dumps(self, obj) -> bytes:
+        try:
+            data = self._orjson.dumps(obj, option=self._option)
+        except TypeError:
+            return super().dumps(obj)
+        # orjson writes NaN and infinities as null
+        if b"null" in data and _has_non_finite(obj):
+            return super().dumps(obj)
+        return data
+
+    def loads(self, data: Union[bytes, bytearray, memoryview, str]):
+        try:
+            return self._orjson.loads(data)
+        except ValueError:
+            return super().loads(data)
+
+
+def _default(obj):
+    # Written the way orjson writes them
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, UUID):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _has_non_finite(obj) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+def _default_codec() -> JsonCodec:
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        return JsonCodec()
+
+
+_codec: JsonCodec = _default_codec()
+
+
+def set_json_codec(codec: Union[str, JsonCodec]) -> JsonCodec:
+    """
+    Changes the codec of every client and serializer in the process
+    :param codec: A codec or the name of a built in one, "json" or "orjson"
+    """
+    global _codec
+    if isinstance(codec, str):
+        if codec not in (JsonCodec.name, OrjsonCodec.name):
+            raise Exception(f"Unknown json codec {codec}")
+        codec = OrjsonCodec() if codec == OrjsonCodec.name else JsonCodec()
+    _codec = codec
+    return codec
+
+
+def get_json_codec() -> JsonCodec:
+    return _codec
+
+
+def dumps(obj) -> bytes:
+    return _codec.dumps(obj)
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]):
+    return _codec.loads(data)
+
+
+def decode_header(payload: Union[bytes, memoryview]) -> dict:
+    """
+    Parses the fields of a packet without its data, for callers that only need headers such as
+    the type, md5_hash or from. Relies on data being the last field, as encode_packet writes it,
+    any other packet is parsed in full
+    :return: The packet, it may include the data
+    """
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    index = payload.find(_DATA_KEY)
+    if index > 1:
+        header = payload[:index].rstrip(b", \t\r\n") + b"}"
+        try:
+            packet = loads(header)
+        except ValueError:
+            # The key is nested in another field or part of a string, e.g. "data" isn't the last field
+            packet = None
+        if isinstance(packet, dict) and packet:
+            return packet
+    return loads(payload)
@@ -0,0 +1,108 @@
+import time
+import threading
+
+from cryptography.fernet import Fernet
+
+from collections import OrderedDict
+from typing import Union, Callable, Hashable, List
+
+from .crypto import AeadCipher
+
+
+class _CachedKey:
+    __slots__ = ("key", "fernet", "cipher", "expires")
+
+    def __init__(self, key: bytes, expires: float):
+        self.key = key
+        self.fernet = None
+        self.cipher = None
+        self.expires = expires
+
+
+class KeyCache:
+    """
+    Memoizes the keys returned by an encryption callback and the Fernet and AEAD
+    ciphers built from them. Keys are cached per topic, or per whatever `cache_key` maps a
+    topic to (e.g. the tenant), expire after `ttl` seconds and the least recently
+    used ones are evicted past `max_size`.
+    """
+
+    def __init__(self, callback: Callable[[str], bytes], max_size: int = 1024, ttl: float = 300,
+                 cache_key: Callable[[str], Hashable] = None, wildcards: Callable[[str], List[str]] = None):
+        """
+        :param callback: Returns the key of a topic
+        :param ttl: Seconds a key is trusted before asking the callback again, None never expires
+        :param cache_key: Maps a topic to its cache entry, topics mapped to the same entry share the key
+        :param wildcards: Returns the topic levels matched by the wildcards of the route. They're passed to the
+        callback as a second argument, and keys are cached per levels unless cache_key is given
+        """
+        self.callback = callback
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_key = cache_key
+        self.wildcards = wildcards
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cache_key(self, topic: str, segments: List[str] = None) -> Hashable:
+        if self.cache_key:
+            return self.cache_key(topic)
+        if segments is not None:
+            return tuple(segments)
+        return topic
+
+    def _entry(self, topic: str) -> _CachedKey:
+        segments = self.wildcards(topic) if self.wildcards else None
+        cache_key = self._cache_key(topic, segments)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and (entry.expires is None or entry.expires > now):
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # The callback may be slow (e.g. a database lookup), it's called without holding the lock
+        key = self.callback(topic) if segments is None else self.callback(topic, segments)
+        entry = _CachedKey(key, None if self.ttl is None else now + self.ttl)
+        if key:
+            with self._lock:
+                self._entries[cache_key] = entry
+                self._entries.move_to_end(cache_key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def get_key(self, topic: str) -> Union[None, bytes]:
+        return self._entry(topic).key
+
+    def get_fernet(self, topic: str) -> Fernet:
+        entry = self._entry(topic)
+        if entry.fernet is None:
+            entry.fernet = Fernet(entry.key)
+        return entry.fernet
+
+    def get_cipher(self, topic: str) -> AeadCipher:
+        entry = self._entry(topic)
+        if entry.cipher is None:
+            entry.cipher = AeadCipher(entry.key)
+        return entry.cipher
+
+    def invalidate(self, topic: str = None):
+        """
+        Forgets the key of a topic, e.g. after a key rotation
+        :param topic: Any topic of the entry to forget, None forgets every key
+        """
+        with self._lock:
+            if topic is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self._cache_key(topic, self.wildcards(topic) if self.wildcards else None), None)
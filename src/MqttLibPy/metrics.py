@@ -0,0 +1,144 @@
+import bisect
+import threading
+
+from typing import Dict, Tuple, Union
+
+
+# Counters, labeled with the route
+MESSAGES_SENT = "messages_sent"
+BYTES_SENT = "bytes_sent"
+FRAGMENTS_SENT = "fragments_sent"
+MESSAGES_RECEIVED = "messages_received"
+BYTES_RECEIVED = "bytes_received"
+FRAGMENTS_RECEIVED = "fragments_received"
+ERRORS = "errors"
+DECRYPT_FAILURES = "decrypt_failures"
+
+# Latencies in seconds, labeled with the route
+SERIALIZE_SECONDS = "serialize_seconds"
+DESERIALIZE_SECONDS = "deserialize_seconds"
+DECRYPT_SECONDS = "decrypt_seconds"
+HANDLER_SECONDS = "handler_seconds"
+# Round trip of the requests, from the request being sent to its response arriving
+REQUEST_SECONDS = "request_seconds"
+REQUEST_TIMEOUTS = "request_timeouts"
+
+# Gauges, sampled by MqttClient.report_metrics
+PENDING_FILES = "pending_files"
+PENDING_FILE_BYTES = "pending_file_bytes"
+PENDING_FILE_DISK_BYTES = "pending_file_disk_bytes"
+PENDING_TRANSFERS = "pending_transfers"
+REASSEMBLY_PENDING = "reassembly_pending"
+REASSEMBLY_BYTES = "reassembly_bytes"
+PUBLISH_QUEUE_DEPTH = "publish_queue_depth"
+DISPATCHER_QUEUED = "dispatcher_queued"
+DISPATCHER_DROPPED = "dispatcher_dropped"
+SPOOL_PENDING = "spool_pending"
+SPOOL_BYTES = "spool_bytes"
+SPOOL_DROPPED = "spool_dropped"
+PENDING_REQUESTS = "pending_requests"
+
+
+class MetricsExporter:
+    """
+    Receives the measurements of a client. This base class discards them, subclasses set
+    `enabled` and forward them to a metrics system (statsd, prometheus...).
+
+    Methods are called from the network thread and from the worker threads, they must be
+    thread safe and fast.
+    """
+    enabled = False
+
+    def increment(self, name: str, route: str, value: int = 1):
+        pass
+
+    def observe(self, name: str, route: str, seconds: float):
+        pass
+
+    def gauge(self, name: str, value: float, route: str = None):
+        pass
+
+
+NOOP = MetricsExporter()
+
+
+class Histogram:
+    """
+    Fixed buckets latency histogram
+    """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, percentile: float) -> Union[None, float]:
+        """
+        :return: Upper bound of the bucket the percentile falls in, None without observations
+        """
+        if not self.count:
+            return None
+        target = percentile * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class InMemoryExporter(MetricsExporter):
+    """
+    Keeps every measurement in memory, e.g. to serve them from a health endpoint or
+    to push them periodically to a metrics system
+    """
+    enabled = True
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, str], int] = {}
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.gauges: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, route: str, value: int = 1):
+        key = (name, route)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, route: str, seconds: float):
+        key = (name, route)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name: str, value: float, route: str = None):
+        with self._lock:
+            self.gauges[(name, route)] = value
+
+    def snapshot(self) -> dict:
+        """
+        :return: Json serializable copy of the measurements, grouped by metric and route
+        """
+        result = {"counters": {}, "histograms": {}, "gauges": {}}
+        with self._lock:
+            for (name, route), value in self.counters.items():
+                result["counters"].setdefault(name, {})[route] = value
+            for (name, route), value in self.gauges.items():
+                result["gauges"].setdefault(name, {})[route] = value
+            for (name, route), histogram in self.histograms.items():
+                result["histograms"].setdefault(name, {})[route] = {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "p50": histogram.percentile(0.5),
+                    "p90": histogram.percentile(0.9),
+                    "p99": histogram.percentile(0.99)
+                }
+        return result
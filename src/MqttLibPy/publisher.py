@@ -0,0 +1,276 @@
+import socket
+import threading
+
+from paho.mqtt.client import MQTTv5, Client, MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN, error_string
+
+from logging import getLogger
+from typing import Union, List, Callable
+
+
+def no_delay(client: Client, user_data, sock):
+    """
+    on_socket_open callback disabling Nagle's algorithm, paho writes every packet with a single send so
+    delaying small ones only adds latency, e.g. ~40ms to a request waiting for a delayed ACK
+    """
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class PublishHandle:
+    """
+    Completion handle for one or more publishes. It's done once every publish it
+    tracks has been acknowledged by the broker (or failed).
+    """
+
+    def __init__(self, count: int = 1):
+        self._pending = count
+        self._error = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        if count == 0:
+            self._event.set()
+
+    def _add(self, count: int = 1):
+        with self._lock:
+            self._pending += count
+            self._event.clear()
+
+    def _complete(self, error: Exception = None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            if error is not None:
+                self._error = error
+                self._pending = 0
+            else:
+                self._pending -= 1
+            if self._pending > 0:
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def exception(self) -> Union[None, Exception]:
+        return self._error
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Blocks until every publish has been acknowledged.
+        :param timeout: Seconds to wait, None waits forever
+        :return: False if the timeout expired
+        :raises: The publish error, if any publish failed
+        """
+        if not self._event.wait(timeout):
+            return False
+        if self._error is not None:
+            raise self._error
+        return True
+
+    def add_done_callback(self, callback: Callable[["PublishHandle"], None]):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class Publisher:
+    """
+    Long lived publisher connection. Connects lazily on the first publish and
+    reconnects automatically, QoS > 0 messages published while disconnected are
+    sent once the connection is back.
+
+    It can also publish through a client whose connection and network loop are
+    managed by someone else, in which case it only tracks the acknowledgements.
+    """
+
+    def __init__(self, hostname: str, port: int, max_inflight: int = 20, connect_timeout: float = 10,
+                 keepalive: int = 60, client: Client = None):
+        """
+        :param client: Already managed client to publish through
+        """
+        self.hostname = hostname
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self._connected = threading.Event()
+
+        if client is None:
+            self.client = Client("", userdata=None, protocol=MQTTv5)
+            self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+            self.client.on_connect = self._on_connect
+            self.client.on_disconnect = self._on_disconnect
+            self.client.on_socket_open = no_delay
+            self._started = False
+        else:
+            self.client = client
+            self._started = True
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.on_publish = self._on_publish
+        self._owns_client = client is None
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._published = set()
+        # Filter: qos, renewed on every connection
+        self._subscriptions = {}
+
+        self.logger = getLogger("Mqtt Publisher")
+
+    @property
+    def connected(self) -> bool:
+        if not self._owns_client:
+            return self.client.is_connected()
+        return self._connected.is_set()
+
+    @property
+    def inflight(self) -> int:
+        """Messages published and not acknowledged yet"""
+        return len(self._pending)
+
+    def _on_connect(self, client: Client, _, __, rc, ___=None):
+        if rc == 0:
+            self.resubscribe()
+            self._connected.set()
+        else:
+            self.logger.error(f"Connection to {self.hostname}:{self.port} refused: {rc}")
+
+    def _on_disconnect(self, client: Client, _, rc, __=None):
+        self._connected.clear()
+        if rc != 0:
+            self.logger.warning(f"Publisher disconnected from {self.hostname}:{self.port} ({rc}), reconnecting")
+
+    def _on_publish(self, client: Client, _, mid: int):
+        with self._lock:
+            handle = self._pending.pop(mid, None)
+            if handle is None:
+                # Acknowledged before publish() got to register the handle
+                self._published.add(mid)
+                return
+        handle._complete()
+
+    def connect(self, wait: bool = True):
+        """
+        Starts connecting in the background, the first time it's called
+        :param wait: Wait up to connect_timeout for the broker to accept this first connection. Without
+        waiting, QoS > 0 messages published before it's accepted are queued and QoS 0 ones fail
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.logger.debug(f"Connecting publisher to {self.hostname}:{self.port}")
+        self.client.connect_async(self.hostname, self.port, keepalive=self.keepalive)
+        self.client.loop_start()
+        if wait and not self._connected.wait(self.connect_timeout):
+            self.logger.warning(f"Could not connect to {self.hostname}:{self.port} "
+                                f"in {self.connect_timeout}s, messages will be queued")
+
+    def subscribe(self, topic_filter: str, callback: Callable, qos: int = 1):
+        """
+        Receives the messages of topic_filter through this connection, e.g. responses. The broker handles
+        the subscription before any message published afterwards through the same connection, so the
+        responses to those messages can't be missed
+        :param callback: Called from the network thread with the client, user data and message
+        """
+        self.client.message_callback_add(topic_filter, callback)
+        with self._lock:
+            self._subscriptions[topic_filter] = qos
+            started = self._started
+        if not started:
+            # Subscribes once connected
+            self.connect(wait=False)
+        else:
+            self.client.subscribe(topic_filter, qos)
+
+    def resubscribe(self):
+        """
+        Renews the subscriptions after a reconnection, it's called by the owner of a managed client
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.items())
+        if subscriptions:
+            self.client.subscribe(subscriptions)
+
+    def publish(self, topic: str, payload: Union[str, bytes], qos: int = 0, properties=None,
+                handle: PublishHandle = None) -> PublishHandle:
+        """
+        Publishes without blocking, not even for the connection, see connect.
+        :param handle: Handle to attach this publish to, a new one is created if it's None
+        :return: Handle that completes when the broker acknowledges the message
+        """
+        if handle is None:
+            handle = PublishHandle()
+        if not self._started:
+            self.connect(wait=False)
+
+        info = self.client.publish(topic, payload, qos=qos, properties=properties)
+        if info.rc != MQTT_ERR_SUCCESS and not (info.rc == MQTT_ERR_NO_CONN and qos > 0):
+            # QoS 0 messages are dropped when disconnected, QoS > 0 are queued by paho
+            handle._complete(ConnectionError(f"Publish to {topic} failed: {error_string(info.rc)}"))
+            return handle
+
+        with self._lock:
+            if info.mid in self._published:
+                self._published.discard(info.mid)
+                acknowledged = True
+            else:
+                self._pending[info.mid] = handle
+                acknowledged = False
+        if acknowledged:
+            handle._complete()
+        return handle
+
+    def close(self):
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        if self._owns_client:
+            self.client.disconnect()
+            self.client.loop_stop()
+        self._connected.clear()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._published.clear()
+        for handle in pending.values():
+            handle._complete(ConnectionError("Publisher closed before the message was acknowledged"))
+
+
+class PublisherPool:
+    """
+    Fixed size pool of publisher connections. Topics are pinned to a connection
+    so the order of the messages sent to a topic is kept.
+    """
+
+    def __init__(self, hostname: str, port: int, size: int = 1, max_inflight: int = 20,
+                 connect_timeout: float = 10, client: Client = None):
+        """
+        :param client: Publish every message through this already managed client
+        """
+        if size < 1:
+            raise ValueError("Publisher pool size must be at least 1")
+        if client is not None:
+            self.publishers: List[Publisher] = [Publisher(hostname, port, max_inflight, connect_timeout,
+                                                          client=client)]
+            return
+        self.publishers: List[Publisher] = [Publisher(hostname, port, max_inflight, connect_timeout)
+                                            for _ in range(size)]
+
+    @property
+    def inflight(self) -> int:
+        return sum(publisher.inflight for publisher in self.publishers)
+
+    def for_topic(self, topic: str) -> Publisher:
+        if len(self.publishers) == 1:
+            return self.publishers[0]
+        return self.publishers[hash(topic) % len(self.publishers)]
+
+    def close(self):
+        for publisher in self.publishers:
+            publisher.close()
@@ -0,0 +1,115 @@
+import time
+import threading
+
+from collections import OrderedDict
+from logging import getLogger
+from typing import Union, List, Hashable
+
+
+_MISSING = object()
+
+
+class _PartialMessage:
+    __slots__ = ("parts", "received", "size", "updated")
+
+    def __init__(self, total: int, now: float):
+        self.parts = [_MISSING] * total
+        self.received = 0
+        self.size = 0
+        self.updated = now
+
+
+class ReassemblyBuffer:
+    """
+    Holds the fragments of multi part messages until every fragment arrives.
+    Incomplete messages are dropped `timeout` seconds after their last fragment,
+    and the least recently updated ones are evicted when the buffer goes over
+    `max_bytes` or `max_messages`.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1000 * 1000, timeout: float = 60, max_messages: int = 1000):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_messages = max_messages
+
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+        self._messages = OrderedDict()
+        # Recently completed messages, to drop fragments redelivered after completion
+        self._completed = OrderedDict()
+        self._lock = threading.Lock()
+        self.logger = getLogger("Mqtt Reassembly")
+
+    @property
+    def pending(self) -> int:
+        return len(self._messages)
+
+    def add(self, key: Hashable, index: int, total: int, data, size: int) -> Union[None, List]:
+        """
+        :param key: Identifies the message the fragment belongs to
+        :param index: Position of the fragment
+        :param total: Number of fragments of the message
+        :param data: Fragment body
+        :param size: Bytes the fragment takes, counted against max_bytes
+        :return: Every fragment body in order once the message is complete, None before that
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            message = self._messages.get(key)
+            if message is None:
+                if key in self._completed:
+                    return None
+                message = self._messages[key] = _PartialMessage(total, now)
+            else:
+                self._messages.move_to_end(key)
+
+            if len(message.parts) != total or not 0 <= index < total:
+                self.logger.warning(f"Fragment {index}/{total} doesn't match message {key}, ignoring it")
+                return None
+            if message.parts[index] is not _MISSING:
+                # Redelivered fragment
+                return None
+
+            message.parts[index] = data
+            message.received += 1
+            message.size += size
+            message.updated = now
+            self.bytes += size
+
+            if message.received == total:
+                del self._messages[key]
+                self.bytes -= message.size
+                self._completed[key] = None
+                if len(self._completed) > self.max_messages:
+                    self._completed.popitem(last=False)
+                return message.parts
+
+            self._evict()
+        return None
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            message = self._messages.pop(key, None)
+            if message is not None:
+                self.bytes -= message.size
+
+    def _expire(self, now: float):
+        while self._messages:
+            key, message = next(iter(self._messages.items()))
+            if now - message.updated < self.timeout:
+                return
+            self.logger.warning(f"Message {key} timed out with {message.received}/{len(message.parts)} fragments")
+            del self._messages[key]
+            self.bytes -= message.size
+            self.expired += 1
+
+    def _evict(self):
+        while self._messages and (self.bytes > self.max_bytes or len(self._messages) > self.max_messages):
+            key, message = self._messages.popitem(last=False)
+            self.logger.warning(f"Reassembly buffer full, evicting message {key} "
+                                f"with {message.received}/{len(message.parts)} fragments")
+            self.bytes -= message.size
+            self.evicted += 1
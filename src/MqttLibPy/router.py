@@ -0,0 +1,180 @@
+import threading
+
+from collections import OrderedDict
+from typing import Callable, List, Tuple
+
+
+class _Node:
+    __slots__ = ("children", "routes", "multi_level")
+
+    def __init__(self):
+        self.children = {}
+        # Filters ending at this level
+        self.routes = []
+        # Filters ending with "#" at this level
+        self.multi_level = []
+
+
+class Route:
+    __slots__ = ("topic_filter", "callback", "with_wildcards", "order", "group")
+
+    def __init__(self, topic_filter: str, callback: Callable, with_wildcards: bool = False, order: int = 0,
+                 group: str = None):
+        """
+        :param with_wildcards: The callback takes the wildcard segments of the topic as a fourth argument
+        :param order: Position in which the route was registered
+        :param group: Shared subscription group the route is subscribed through, None for a plain subscription
+        """
+        self.topic_filter = topic_filter
+        self.callback = callback
+        self.with_wildcards = with_wildcards
+        self.order = order
+        self.group = group
+
+
+class TopicRouter:
+    """
+    Finds the routes whose filters match a topic. Filters are kept in a trie of their levels, so
+    the cost of a lookup depends on the depth of the topic instead of the number of routes, and
+    the routes of the most recent topics are cached.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        """
+        :param cache_size: Number of topics whose matches are kept
+        """
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+        self._root = _Node()
+        self._filters = []
+        self._groups = []
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._filters)
+
+    @property
+    def filters(self) -> List[str]:
+        """Registered filters, in registration order and without duplicates"""
+        return list(OrderedDict.fromkeys(topic_filter for topic_filter, _ in self._filters))
+
+    @property
+    def groups(self) -> List[str]:
+        """Shared subscription groups of the routes, in registration order"""
+        return list(self._groups)
+
+    def add(self, topic_filter: str, callback: Callable, with_wildcards: bool = False, group: str = None):
+        """
+        :param group: Shared subscription group, the broker delivers each message to a single member of the group
+        """
+        levels = topic_filter.split("/")
+        for position, level in enumerate(levels):
+            if level == "#" and position != len(levels) - 1:
+                raise Exception(f"Invalid topic filter {topic_filter}, # must be its last level")
+        if group is not None and (not group or any(c in group for c in "/+#")):
+            raise Exception(f"Invalid shared subscription group {group}")
+        with self._lock:
+            route = Route(topic_filter, callback, with_wildcards, len(self._filters), group)
+            node = self._root
+            for level in levels[:-1]:
+                node = node.children.setdefault(level, _Node())
+            if levels[-1] == "#":
+                node.multi_level.append(route)
+            else:
+                node.children.setdefault(levels[-1], _Node()).routes.append(route)
+            self._filters.append((topic_filter, group))
+            if group is not None and group not in self._groups:
+                self._groups.append(group)
+            self._cache.clear()
+
+    def match(self, topic: str) -> List[Tuple[Route, List[str]]]:
+        """
+        :return: The routes matching the topic, in registration order, with the topic levels matched by the
+        wildcards of their filter. The levels matched by "#" are joined in a single string
+        """
+        with self._lock:
+            matches = self._cache.get(topic)
+            if matches is not None:
+                self._cache.move_to_end(topic)
+                self.hits += 1
+                return matches
+            self.misses += 1
+            levels = topic.split("/")
+            matches = []
+            # Topics starting with $ aren't matched by filters starting with a wildcard
+            self._match(self._root, levels, 0, [], matches, not topic.startswith("$"))
+            matches.sort(key=lambda match: match[0].order)
+            self._cache[topic] = matches
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return matches
+
+    def _match(self, node: _Node, levels: List[str], depth: int, wildcards: List[str], matches: list,
+               wildcards_allowed: bool = True):
+        if wildcards_allowed:
+            for route in node.multi_level:
+                # "a/#" matches "a" too
+                matches.append((route, wildcards + ["/".join(levels[depth:])]))
+        if depth == len(levels):
+            for route in node.routes:
+                matches.append((route, wildcards))
+            return
+        child = node.children.get(levels[depth])
+        if child is not None:
+            self._match(child, levels, depth + 1, wildcards, matches)
+        child = node.children.get("+") if wildcards_allowed else None
+        if child is not None:
+            self._match(child, levels, depth + 1, wildcards + [levels[depth]], matches)
+
+    def subscriptions(self, group: str = None) -> List[str]:
+        """
+        :param group: Shared subscription group of the routes, None for the plainly subscribed ones
+        :return: The fewest filters that receive every registered route, filters covered by
+        a wider one (e.g. "company/+/orders" by "company/#") are left out
+        """
+        filters = list(OrderedDict.fromkeys(topic_filter for topic_filter, route_group in self._filters
+                                            if route_group == group))
+        return [topic_filter for position, topic_filter in enumerate(filters)
+                if not any(covers(other, topic_filter) for other in filters[:position] + filters[position + 1:]
+                           if other != topic_filter)]
+
+
+def covers(wider: str, narrower: str) -> bool:
+    """
+    :return: Whether every topic matched by the narrower filter is matched by the wider one
+    """
+    if wider.startswith("$share/") or narrower.startswith("$share/"):
+        return False
+    wider_levels = wider.split("/")
+    narrower_levels = narrower.split("/")
+    for position, level in enumerate(wider_levels):
+        if level == "#":
+            # $ topics aren't matched by leading wildcards
+            return position > 0 or not narrower.startswith("$")
+        if position >= len(narrower_levels):
+            return False
+        narrower_level = narrower_levels[position]
+        if level == "+":
+            if narrower_level == "#" or (position == 0 and narrower_level.startswith("$")):
+                return False
+        elif level != narrower_level:
+            return False
+    return len(wider_levels) == len(narrower_levels)
+
+
+def topic_wildcards(topic_filter: str, topic: str) -> List[str]:
+    """
+    :return: The levels of the topic matched by the wildcards of the filter, the levels matched by "#" are joined
+    """
+    levels = topic.split("/")
+    segments = []
+    for position, level in enumerate(topic_filter.split("/")):
+        if level == "#":
+            segments.append("/".join(levels[position:]))
+            break
+        if level == "+":
+            segments.append(levels[position])
+    return segments
@@ -0,0 +1,153 @@
+import time
+import heapq
+import uuid
+import threading
+
+from concurrent.futures import Future
+from logging import getLogger
+from typing import Dict, Tuple, Union
+
+from .metrics import MetricsExporter, NOOP, REQUEST_SECONDS, REQUEST_TIMEOUTS
+
+
+# Topic each client receives the responses to its requests on
+REPLY_TOPIC = "mqttlibpy/replies/{client_id}"
+
+
+class _Request:
+    __slots__ = ("route", "secure", "future", "start", "timeout")
+
+    def __init__(self, route: str, secure: bool, future: Future, timeout: float):
+        self.route = route
+        self.secure = secure
+        self.future = future
+        self.start = time.perf_counter()
+        self.timeout = timeout
+
+
+class PendingRequests:
+    """
+    Requests waiting for their response, by correlation data. A single thread fails the requests
+    whose timeout expires, and at most max_pending requests are in flight, callers wait for a slot.
+    The round trip of every response is observed as request_seconds.
+    """
+
+    def __init__(self, max_pending: int = 100, metrics: MetricsExporter = NOOP):
+        """
+        :param max_pending: Max number of requests waiting for a response
+        """
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self.timeouts = 0
+
+        self._requests: Dict[bytes, _Request] = {}
+        self._deadlines = []
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.logger = getLogger("Mqtt Requests")
+
+    @property
+    def pending(self) -> int:
+        return len(self._requests)
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Waits for a free slot, it's released once the request added after it completes
+        :return: False if no slot was freed in timeout seconds
+        """
+        return self._slots.acquire(timeout=timeout)
+
+    def release(self):
+        """Frees a slot acquired for a request that wasn't added"""
+        self._slots.release()
+
+    def add(self, route: str, timeout: float, secure: bool = False) -> Tuple[bytes, Future]:
+        """
+        Registers a request, acquire must have returned True before
+        :return: The correlation data of the request and the future of its response
+        """
+        correlation = uuid.uuid4().bytes
+        future = Future()
+        request = _Request(route, secure, future, timeout)
+        with self._condition:
+            if self._closed:
+                self.release()
+                raise Exception("The client is closed")
+            self._requests[correlation] = request
+            if len(self._deadlines) > 4 * len(self._requests) + 64:
+                # Drops the deadlines of the requests answered before expiring
+                self._deadlines = [entry for entry in self._deadlines if entry[1] in self._requests]
+                heapq.heapify(self._deadlines)
+            heapq.heappush(self._deadlines, (time.monotonic() + timeout, correlation))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._expire, name="mqtt-requests", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        future.add_done_callback(lambda _: self._forget(correlation))
+        return correlation, future
+
+    def get(self, correlation: bytes) -> Union[None, _Request]:
+        return self._requests.get(correlation)
+
+    def resolve(self, correlation: bytes, result=None, error: Exception = None):
+        """
+        Completes a request with its response, or with an error. Responses to unknown or expired
+        requests are ignored
+        """
+        request = self._requests.get(correlation)
+        if request is None:
+            return
+        if error is None and self.metrics.enabled:
+            self.metrics.observe(REQUEST_SECONDS, request.route, time.perf_counter() - request.start)
+        self._complete(request.future, result, error)
+
+    @staticmethod
+    def _complete(future: Future, result=None, error: Exception = None):
+        if future.done():
+            return
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except Exception:
+            # Cancelled, or completed by another thread in the meantime. It's an InvalidStateError,
+            # which only exists from Python 3.8
+            pass
+
+    def _forget(self, correlation: bytes):
+        with self._condition:
+            if self._requests.pop(correlation, None) is None:
+                return
+        self.release()
+
+    def _expire(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    # Skips the deadlines of the requests already completed
+                    while self._deadlines and self._deadlines[0][1] not in self._requests:
+                        heapq.heappop(self._deadlines)
+                    if self._deadlines and self._deadlines[0][0] <= time.monotonic():
+                        break
+                    self._condition.wait(self._deadlines[0][0] - time.monotonic() if self._deadlines else None)
+                if self._closed:
+                    return
+                _, correlation = heapq.heappop(self._deadlines)
+                request = self._requests.get(correlation)
+                self.timeouts += 1
+            self.metrics.increment(REQUEST_TIMEOUTS, request.route)
+            self._complete(request.future, error=TimeoutError(
+                f"No response to the request sent to {request.route} in {request.timeout}s"))
+
+    def close(self):
+        """Fails every pending request"""
+        with self._condition:
+            self._closed = True
+            requests = list(self._requests.values())
+            self._condition.notify()
+        for request in requests:
+            self._complete(request.future, error=ConnectionError(
+                f"The client was closed before the response to the request sent to {request.route} arrived"))
@@ -1,46 +1,99 @@
-import json
-import json as jsn
 import base64
 import re
+import time
 import hashlib
 
-from cryptography.fernet import Fernet
-from textwrap import wrap
-from typing import Union, List
+from cryptography.fernet import Fernet, InvalidToken
+from itertools import chain
+from logging import getLogger
+from uuid import uuid4
+from typing import Union, List, Hashable, Iterator, Tuple
+
+from .reassembly import ReassemblyBuffer
+from .compression import Codec, get_codec, MAX_DECOMPRESSED_SIZE
+from .jsoncodec import dumps, loads
+from .metrics import MetricsExporter, NOOP, SERIALIZE_SECONDS, DESERIALIZE_SECONDS, DECRYPT_SECONDS, \
+    DECRYPT_FAILURES, FRAGMENTS_SENT
+
+
+class RawJson(bytes):
+    """
+    Already encoded JSON value, it's embedded as is when the packet is encoded
+    """
 
 
 class Serializer:
     _MAX_MESSAGE_LENGTH_BYTES = 10 * 1000 * 1000  # 10MB
     _MAX_MESSAGE_LENGTH = 268435448
+    _COMPRESSION_SAMPLE = 64 * 1000  # 64KB
 
-    def __init__(self, uuid: str, key: bytes = None):
+    def __init__(self, uuid: str, key: bytes = None, fernet: Fernet = None, codec: Codec = None,
+                 compression_threshold: int = 1024, metrics: MetricsExporter = NOOP, route: str = None,
+                 max_decompressed_size: int = MAX_DECOMPRESSED_SIZE):
+        """
+        @param fernet: Ready built Fernet instance, takes precedence over key
+        @param codec: Compresses the fragments before they're encrypted, None doesn't compress
+        @param compression_threshold: Fragments smaller than this many bytes aren't compressed
+        @param metrics: Receives the serialization times, fragment counts and decryption failures
+        @param route: Route the measurements are labeled with
+        @param max_decompressed_size: Received packets that decompress to more bytes are rejected
+        """
         # Pasar esto a la db
         self.id = uuid
-        if key is not None:
+        if fernet is not None:
+            self.fernet = fernet
+        elif key is not None:
             self.fernet = Fernet(key)
+        self.codec = codec
+        self.compression_threshold = compression_threshold
+        self.metrics = metrics
+        self.route = route
+        self.max_decompressed_size = max_decompressed_size
+        self.reassembly = None
+        self.logger = getLogger("Mqtt Serializer")
 
     def serialize(self, message: Union[str, List[dict], bytes], encodeb64: bool = False,
                   valid_json=False, is_error=False, filename: str = "",
-                  metadata: dict = None, encrypt: bool = False) -> List[dict]:
+                  metadata: dict = None, encrypt: bool = False, pre_encoded: bool = False,
+                  first_fit_decreasing: bool = False) -> List[dict]:
+        """
+        @param pre_encoded: json fragments are returned as RawJson bytes, ready for encode_packet
+        @param first_fit_decreasing: Pack json objects in as few fragments as possible, the order
+        of the objects is only kept inside each fragment
+
+        Compressed fragments are bytes, encode_packet base64 encodes them
+        """
+        start = time.perf_counter() if self.metrics.enabled else None
+        compressed = None
         if encodeb64 and not valid_json and not isinstance(message, bytes):
-            if isinstance(message, list):
-                message = json.dumps(message)
-            message = base64.b64encode(message.encode('utf-8'))
-            if len(message) > self._MAX_MESSAGE_LENGTH:
-                fragments = wrap(message.decode('utf-8'), self._MAX_MESSAGE_LENGTH)
-            else:
-                fragments = [message.decode('utf-8')]
+            message = base64.b64encode(dumps(message) if isinstance(message, list)
+                                       else message.encode('utf-8')).decode('utf-8')
+            fragments = [message[i:i + self._MAX_MESSAGE_LENGTH]
+                         for i in range(0, len(message), self._MAX_MESSAGE_LENGTH)] or [message]
             message_type = "text"
         elif isinstance(message, bytes):
             if len(message) > self.MAX_MESSAGE_LENGTH:
-                raise Exception(f"Max payload size exceeded ({self.MAX_MESSAGE_LENGTH}B)")
+                raise Exception(f"Max payload size exceeded ({self.MAX_MESSAGE_LENGTH}B), "
+                                f"use chunked file transfers for bigger files")
             if metadata is None:
                 metadata = {}
-            metadata.update({"filename": filename or hashlib.md5(message).hexdigest()})
-            fragments = [json.dumps(metadata)]
+            md5_hash = hashlib.md5(message).hexdigest()
+            metadata.update({"filename": filename or md5_hash})
+            fragments = [dumps(metadata).decode('utf-8')]
             message_type = "file"
         elif isinstance(message, list) and valid_json:
-            fragments = self._naive_knapsack(message)
+            encoded = self._encode_objects(message)
+            sizes = self._sizes(message, encoded)
+            limit = self._compressed_limit(encoded, sizes) if self.codec is not None else None
+            groups = self._pack(sizes, first_fit_decreasing, limit)
+            if self.codec is not None:
+                compressed_groups = list(self._compress_groups(message, encoded, groups, pre_encoded or encrypt))
+                fragments = [fragment for fragment, _ in compressed_groups]
+                compressed = [is_compressed for _, is_compressed in compressed_groups]
+            elif pre_encoded or encrypt:
+                fragments = [RawJson(b"[" + b", ".join(encoded[i] for i in group) + b"]") for group in groups]
+            else:
+                fragments = [[message[i] for i in group] for group in groups]
             message_type = "json"
         elif not encodeb64 and isinstance(message, str):
             fragments = [message]
@@ -51,14 +104,19 @@ class Serializer:
             else:
                 raise RuntimeError(f"Incorrect data type for message: {type(message)}")
 
-        if encrypt and (message_type == 'file' or valid_json):
-            # Si es file es siempre un solo fragmento
-            fragments = list(map(lambda f: self.encrypt_json(f), fragments))
-        elif encrypt and not valid_json:
-            fragments = list(map(lambda f: self.encrypt_string(f), fragments))
+        if compressed is None:
+            compressed_fragments = [self._compress_text(f) for f in fragments]
+            fragments = [fragment for fragment, _ in compressed_fragments]
+            compressed = [is_compressed for _, is_compressed in compressed_fragments]
+
+        if encrypt:
+            fragments = [self.encrypt_bytes(f) if is_compressed else self._encrypt_fragment(f, message_type, valid_json)
+                         for f, is_compressed in zip(fragments, compressed)]
 
-        return [{
+        message_id = uuid4().hex
+        packets = [{
             "data": fragment,
+            "message_id": message_id,
             "current_fragment": n,
             "total_fragments": len(fragments),
             "last_fragment": n == len(fragments) - 1,
@@ -66,39 +124,237 @@ class Serializer:
             "error": is_error,
             "type": message_type,
             "encrypted": encrypt,
-            "md5_hash": "" if message_type != "file" else hashlib.md5(message).hexdigest(),
+            "encoded": encodeb64 and message_type == "text",
+            "md5_hash": "" if message_type != "file" else md5_hash,
             "from": self.id
         } for n, fragment in enumerate(fragments)]
+        for packet, is_compressed in zip(packets, compressed):
+            if is_compressed:
+                packet["compression"] = self.codec.name
+        if message_type == "file":
+            # Pairs the metadata with the body, which travels in another message
+            packets[0]["transfer_id"] = message_id
+        if start is not None:
+            self.metrics.observe(SERIALIZE_SECONDS, self.route, time.perf_counter() - start)
+            self.metrics.increment(FRAGMENTS_SENT, self.route, len(packets))
+        return packets
+
+    def _encrypt_fragment(self, fragment, message_type: str, valid_json: bool) -> str:
+        if message_type == 'json':
+            return self.encrypt_bytes(fragment)
+        elif message_type == 'file' or valid_json:
+            # Si es file es siempre un solo fragmento
+            return self.encrypt_json(fragment)
+        return self.encrypt_string(fragment)
+
+    def compress_bytes(self, data: bytes) -> Tuple[bytes, bool]:
+        if self.codec is None or len(data) < self.compression_threshold:
+            return data, False
+        compressed = self.codec.compress(data)
+        if len(compressed) >= len(data):
+            return data, False
+        return compressed, True
 
-    def deserialize(self, message: str):
+    def _compress_text(self, fragment: str) -> Tuple[Union[str, bytes], bool]:
+        if self.codec is None:
+            return fragment, False
+        data, is_compressed = self.compress_bytes(fragment.encode('utf-8'))
+        return (data, True) if is_compressed else (fragment, False)
+
+    def _compressed_limit(self, encoded: List[bytes], sizes: List[Union[None, int]]) -> int:
         """
-        Doesnt support multi part messages yet
-        @param message: raw str payload
-        @return: Parsed, usable packet body
+        Estimates how many raw bytes of json compress under MAX_MESSAGE_LENGTH by compressing
+        a sample of the objects, so compressible messages are packed in fewer fragments
         """
-        try:
-            packet = json.loads(message)
-            if packet["total_fragments"] > 1:
-                raise NotImplementedError("Multi part messages are not implemented yet")
-            if packet["encoded"]:
-                str_message = packet["data"].decode('utf-8')
-            else:
-                str_message = packet["data"]
+        sample = []
+        sample_size = 0
+        for encoded_obj, size in zip(encoded, sizes):
+            if size is None:
+                continue
+            sample.append(encoded_obj)
+            sample_size += size + 2
+            if sample_size >= self._COMPRESSION_SAMPLE:
+                break
+        if sample_size < self.compression_threshold:
+            return self.MAX_MESSAGE_LENGTH
+        sample = b"[" + b", ".join(sample) + b"]"
+        ratio = len(self.codec.compress(sample)) / len(sample)
+        # Leave room for groups that compress worse than the sample, at most 16 times the limit
+        return max(self.MAX_MESSAGE_LENGTH, int(self.MAX_MESSAGE_LENGTH * 0.8 / max(ratio, 0.05)))
 
-            if packet["is_valid_json"]:
-                parsed_message = json.loads(str_message)
+    def _compress_groups(self, objects: List[dict], encoded: List[bytes], groups: List[List[int]],
+                         pre_encoded: bool) -> Iterator[Tuple[Union[bytes, list], bool]]:
+        for group in groups:
+            raw = b"[" + b", ".join(encoded[i] for i in group) + b"]"
+            data, is_compressed = self.compress_bytes(raw)
+            if len(data) >= self.MAX_MESSAGE_LENGTH and len(group) > 1:
+                # The group compressed worse than estimated
+                half = len(group) // 2
+                yield from self._compress_groups(objects, encoded, [group[:half], group[half:]], pre_encoded)
+            elif is_compressed:
+                yield data, True
             else:
-                parsed_message = str_message
+                yield (RawJson(raw) if pre_encoded else [objects[i] for i in group]), False
+
+    def serialize_file_header(self, filename: str, transfer_id: str, size: int, total_chunks: int,
+                              chunk_size: int, metadata: dict = None, encrypt: bool = False) -> dict:
+        """
+        Metadata message of a chunked file transfer, the digest travels with the last chunk
+        since it's computed while the file is being sent.
+        """
+        data = dict(metadata or {}, filename=filename)
+        return {
+            "data": self.encrypt_json(data) if encrypt else dumps(data).decode('utf-8'),
+            "current_fragment": 0,
+            "total_fragments": 1,
+            "last_fragment": True,
+            "is_valid_json": False,
+            "error": False,
+            "type": "file",
+            "encrypted": encrypt,
+            "md5_hash": "",
+            "from": self.id,
+            "chunked": True,
+            "transfer_id": transfer_id,
+            "size": size,
+            "total_chunks": total_chunks,
+            "chunk_size": chunk_size
+        }
+
+    def serialize_batch(self, payloads: List[bytes]) -> dict:
+        """
+        Single packet carrying several encoded packets sent to the same route, see Batcher
+        @param payloads: Encoded packets, they're embedded without being encoded again
+        """
+        return {
+            "data": RawJson(b"[" + b", ".join(payloads) + b"]"),
+            "current_fragment": 0,
+            "total_fragments": 1,
+            "last_fragment": True,
+            "is_valid_json": True,
+            "error": False,
+            "type": "batch",
+            "encrypted": False,
+            "md5_hash": "",
+            "from": self.id,
+            "size": len(payloads)
+        }
+
+    def deserialize(self, message: Union[str, bytes], reassembly: ReassemblyBuffer = None):
+        """
+        @param message: raw payload, bytes or memoryview are parsed without decoding them to str
+        @param reassembly: Buffer for the fragments of multi part messages, defaults to one owned by this serializer
+        @return: Parsed, usable packet body. None while a multi part message is incomplete
+        """
+        start = time.perf_counter() if self.metrics.enabled else None
+        try:
+            packet = loads(message)
+            data = packet["data"]
+            if packet.get("compression"):
+                compressed = (self._decrypt(data.encode('utf-8')) if packet.get("encrypted")
+                              else base64.b64decode(data))
+                data = Serializer.decompress_data(packet, compressed, self.max_decompressed_size)
+            elif packet.get("encrypted"):
+                data = self._decrypt(data.encode('utf-8'))
+            if packet.get("is_valid_json") and isinstance(data, (str, bytes)):
+                # Decrypted json is parsed straight from the bytes
+                data = loads(data)
+            elif isinstance(data, bytes):
+                data = data.decode('utf-8')
 
-            return parsed_message
+            if reassembly is None:
+                if self.reassembly is None:
+                    self.reassembly = ReassemblyBuffer()
+                reassembly = self.reassembly
+            data = Serializer.assemble(packet, data, reassembly, len(message))
+            if start is not None:
+                self.metrics.observe(DESERIALIZE_SECONDS, self.route, time.perf_counter() - start)
+            return data
         except Exception as e:
-            print(f"An error has occurred during the parsing of a message {str(e)}")
+            self.logger.error(f"An error has occurred during the parsing of a message {str(e)}")
+
+    def _decrypt(self, token: bytes) -> bytes:
+        if not self.metrics.enabled:
+            return self.fernet.decrypt(token)
+        start = time.perf_counter()
+        try:
+            data = self.fernet.decrypt(token)
+        except InvalidToken:
+            self.metrics.increment(DECRYPT_FAILURES, self.route)
+            raise
+        self.metrics.observe(DECRYPT_SECONDS, self.route, time.perf_counter() - start)
+        return data
+
+    @staticmethod
+    def assemble(packet: dict, data, reassembly: ReassemblyBuffer, size: int, key: Hashable = None):
+        """
+        @param data: Decrypted and parsed body of the packet
+        @param size: Size of the raw packet
+        @param key: Identifies the message for senders that don't send a message id
+        @return: Full message body once every fragment has arrived, None before that
+        """
+        total = packet.get("total_fragments", 1)
+        if total <= 1:
+            return Serializer.join_fragments(packet, [data])
+        parts = reassembly.add((packet.get("from"), packet.get("message_id") or key),
+                               packet["current_fragment"], total, data, size)
+        if parts is None:
+            return None
+        return Serializer.join_fragments(packet, parts)
+
+    @staticmethod
+    def decompress_data(packet: dict, data: bytes, max_length: int = MAX_DECOMPRESSED_SIZE):
+        """
+        @param data: Compressed data of the packet, already decrypted
+        @param max_length: Max size of the decompressed data, bigger packets are rejected
+        @return: The decompressed data, parsed unless the packet is text
+        """
+        data = get_codec(packet["compression"]).decompress(data, max_length)
+        if packet.get("type") == "text":
+            return data.decode('utf-8')
+        return loads(data)
+
+    @staticmethod
+    def join_fragments(packet: dict, parts: list):
+        if len(parts) == 1:
+            body = parts[0]
+        elif all(isinstance(part, list) for part in parts):
+            body = list(chain.from_iterable(parts))
+        else:
+            body = "".join(parts)
+        if packet.get("encoded"):
+            body = base64.b64decode(body).decode('utf-8')
+        return body
 
     def _as_str(self, obj):
-        return jsn.dumps(obj, ensure_ascii=False)
+        return dumps(obj).decode('utf-8')
+
+    def _encode_objects(self, objects: List[dict]) -> List[bytes]:
+        return [dumps(obj) for obj in objects]
 
-    def _len(self, obj: Union[dict, List[dict]]):
-        return len(self._as_str(obj))
+    @staticmethod
+    def _sizes(objects: List[dict], encoded: List[bytes]) -> List[Union[None, int]]:
+        # Empty objects are left out of the fragments
+        return [len(encoded_obj) if obj else None for obj, encoded_obj in zip(objects, encoded)]
+
+    @staticmethod
+    def encode_packet(packet: dict) -> bytes:
+        """
+        Encodes a packet, a RawJson data field is spliced in without encoding it again. The data
+        is always the last field, so receivers can read the rest without parsing it, see decode_header
+        """
+        if 'data' not in packet:
+            return dumps(packet)
+        data = packet['data']
+        if isinstance(data, bytes) and not isinstance(data, RawJson):
+            # Compressed data
+            data = base64.b64encode(data).decode('ascii')
+        if not isinstance(data, RawJson):
+            data = dumps(data)
+        header = dumps({key: value for key, value in packet.items() if key != 'data'})
+        if header == b"{}":
+            return b'{"data": ' + data + b'}'
+        return header[:-1] + b', "data": ' + data + b'}'
 
     @property
     def MAX_MESSAGE_LENGTH(self):
@@ -113,7 +369,10 @@ class Serializer:
         return message.decode("utf-8")
 
     def encrypt_json(self, message: dict) -> str:
-        return self.encrypt_string(json.dumps(message))
+        return self.encrypt_bytes(dumps(message))
+
+    def encrypt_bytes(self, message: bytes) -> str:
+        return self.fernet.encrypt(message).decode('utf-8')
 
     def encrypt_string(self, message: str) -> str:
         encoded_str = message.encode('utf-8')
@@ -125,28 +384,55 @@ class Serializer:
 
     def _naive_knapsack(self, objects: List[dict]) -> List[List[dict]]:
         """
-        Takes a list of objects and returns a list of lists which sum of stringified
-        objects are lower than self.MAX_MESSAGE_LENGTH.
-        It's not optimized to return the best possible combinations, but it works.
-
-        @postcondition all([sum(self._len(elem) for elem) < self.MAX_MESSAGE_LENGTH in message for message in output])
-        """
-
-        messages = []
-        current_message = []
-        for i, obj in enumerate(objects):
-            if self._len([obj, *current_message]) < self.MAX_MESSAGE_LENGTH and obj:
-                current_message.append(obj)
-            elif self._len([obj, *current_message]) >= self.MAX_MESSAGE_LENGTH:
-                messages.append(current_message)
-                if self._len(obj) > self.MAX_MESSAGE_LENGTH:
-                    raise Exception("Length of object is bigger than the maximum "
-                                    "allowed by this protocol. To solve this, enable fragmentation "
-                                    "with [{\"encode\": true}]")
-                current_message = [obj]
-            if i == len(objects) - 1 and len(current_message) != 0:
-                messages.append(current_message)
-        return messages
+        Takes a list of objects and returns a list of lists which stringified
+        size is lower than self.MAX_MESSAGE_LENGTH.
+
+        @postcondition all([len(self._as_str(message).encode()) < self.MAX_MESSAGE_LENGTH for message in output])
+        """
+        encoded = self._encode_objects(objects)
+        return [[objects[i] for i in group] for group in self._pack(self._sizes(objects, encoded))]
+
+    def _pack(self, sizes: List[Union[None, int]], first_fit_decreasing: bool = False,
+              limit: int = None) -> List[List[int]]:
+        """
+        Groups objects by index so the encoded json array of each group is smaller than
+        self.MAX_MESSAGE_LENGTH bytes. Sizes are tracked incrementally, objects are never
+        encoded again.
+
+        @param sizes: Encoded size in bytes of each object, None for objects to leave out
+        @param first_fit_decreasing: Place the biggest objects first, each one in the first group
+        with enough room. Produces fewer groups but doesn't keep the order between groups
+        @param limit: Size of the groups, defaults to MAX_MESSAGE_LENGTH. Groups that will be compressed can be bigger
+        @return: Indexes of the objects in each group, in their original order
+        """
+        separator = 2  # ", "
+        brackets = 2  # "[]"
+        limit = limit or self.MAX_MESSAGE_LENGTH
+        groups = []
+        totals = []
+        indexes = [i for i, size in enumerate(sizes) if size is not None]
+        if first_fit_decreasing:
+            indexes.sort(key=lambda i: sizes[i], reverse=True)
+
+        for i in indexes:
+            if sizes[i] + brackets >= self.MAX_MESSAGE_LENGTH:
+                raise Exception("Length of object is bigger than the maximum "
+                                "allowed by this protocol. To solve this, enable fragmentation "
+                                "with [{\"encode\": true}]")
+            candidates = range(len(groups)) if first_fit_decreasing else range(max(len(groups) - 1, 0), len(groups))
+            for n in candidates:
+                if totals[n] + separator + sizes[i] < limit:
+                    groups[n].append(i)
+                    totals[n] += separator + sizes[i]
+                    break
+            else:
+                groups.append([i])
+                totals.append(brackets + sizes[i])
+
+        if first_fit_decreasing:
+            for group in groups:
+                group.sort()
+        return groups
 
     def _naive_knapsack_bytes(self, objects: List[bytes]) -> List[List[bytes]]:
         return objects
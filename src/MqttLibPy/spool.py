@@ -0,0 +1,325 @@
+import os
+import mmap
+import zlib
+import json
+import time
+import struct
+import threading
+
+from logging import getLogger
+from typing import List, Tuple, Union
+
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+# Length of the body and its crc32
+_HEADER = struct.Struct("!II")
+# Segment and offset of the first record not acknowledged yet
+_INDEX = struct.Struct("!QQ")
+_SEGMENT_SUFFIX = ".seg"
+
+Item = Tuple[str, bytes, Union[None, List[Tuple[str, str]]]]
+
+
+class Record:
+    """
+    Messages spooled together, e.g. every fragment of a serialized message
+    """
+    __slots__ = ("route", "qos", "items", "position")
+
+    def __init__(self, route: str, qos: int, items: List[Item], position: Tuple[int, int]):
+        """
+        :param route: Topic the publisher is picked by
+        :param items: Topic, payload and user properties of each message
+        :param position: Segment and offset of the next record
+        """
+        self.route = route
+        self.qos = qos
+        self.items = items
+        self.position = position
+
+
+def _encode(route: str, qos: int, items: List[Item]) -> bytes:
+    route = route.encode("utf-8")
+    parts = [struct.pack("!BH", qos, len(route)), route, struct.pack("!H", len(items))]
+    for topic, payload, user_properties in items:
+        topic = topic.encode("utf-8")
+        properties = json.dumps(user_properties).encode("utf-8") if user_properties else b""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        parts.extend([struct.pack("!H", len(topic)), topic, struct.pack("!H", len(properties)), properties,
+                      struct.pack("!I", len(payload)), payload])
+    body = b"".join(parts)
+    return _HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def _decode(buffer, offset: int, end: int) -> Tuple[str, int, List[Item]]:
+    qos, length = struct.unpack_from("!BH", buffer, offset)
+    offset += 3
+    route = bytes(buffer[offset:offset + length]).decode("utf-8")
+    offset += length
+    count, = struct.unpack_from("!H", buffer, offset)
+    offset += 2
+    items = []
+    for _ in range(count):
+        length, = struct.unpack_from("!H", buffer, offset)
+        topic = bytes(buffer[offset + 2:offset + 2 + length]).decode("utf-8")
+        offset += 2 + length
+        length, = struct.unpack_from("!H", buffer, offset)
+        properties = bytes(buffer[offset + 2:offset + 2 + length])
+        offset += 2 + length
+        length, = struct.unpack_from("!I", buffer, offset)
+        payload = bytes(buffer[offset + 4:offset + 4 + length])
+        offset += 4 + length
+        items.append((topic, payload, [tuple(pair) for pair in json.loads(properties)] if properties else None))
+    if offset != end:
+        raise Exception("Corrupted spool record")
+    return route, qos, items
+
+
+class Spool:
+    """
+    Disk backed queue of the messages published while the broker is unreachable. Records are
+    appended to segment files, read back through mmap and only dropped from the index once
+    the broker acknowledges them, so they survive restarts.
+
+    Every message of a record is spooled with a single write and a checksum, a record torn by
+    a crash is discarded as a whole when the spool is opened again.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1000 * 1000 * 1000, segment_size: int = 64 * 1000 * 1000,
+                 policy: str = DROP_OLDEST, fsync: bool = False, index_interval: float = 0.1):
+        """
+        :param max_bytes: Max disk usage of the segments
+        :param segment_size: Segments are rotated past this size, and deleted once every record is acknowledged
+        :param policy: What to do when the spool is full, "drop_oldest" deletes the oldest segment and
+        "drop_newest" rejects the new record
+        :param fsync: Flush every record to the disk before accepting it, slower but survives power losses
+        :param index_interval: Seconds between writes of the index. Records acknowledged since the last write are
+        published again after a crash
+        """
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise Exception(f"Unknown spool policy {policy}")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.policy = policy
+        self.fsync = fsync
+        self.index_interval = index_interval
+
+        # Records pending and records dropped by the policy
+        self.pending = 0
+        self.dropped = 0
+        self.bytes = 0
+
+        # Segment number: [size, records]
+        self._segments = {}
+        self._committed = (0, 0)
+        self._read = (0, 0)
+        self._writer = None
+        self._map = None
+        self._map_segment = None
+        self._index_written = 0
+        self._lock = threading.Condition()
+        self.logger = getLogger("Mqtt Spool")
+
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:020d}{_SEGMENT_SUFFIX}")
+
+    def _open(self):
+        index = os.path.join(self.directory, "index")
+        if os.path.exists(index):
+            with open(index, "rb") as f:
+                self._committed = _INDEX.unpack(f.read(_INDEX.size))
+        segments = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                          if name.endswith(_SEGMENT_SUFFIX))
+        for segment in segments:
+            if segment < self._committed[0]:
+                os.remove(self._path(segment))
+                continue
+            start = self._committed[1] if segment == self._committed[0] else 0
+            size, records = self._scan(segment, start)
+            self._segments[segment] = [size, records]
+            self.bytes += size
+            self.pending += records
+        if not self._segments:
+            self._segments[self._committed[0]] = [0, 0]
+        elif self._committed[0] not in self._segments:
+            self._committed = (min(self._segments), 0)
+        self._read = self._committed
+        last = max(self._segments)
+        self._writer = open(self._path(last), "ab", buffering=0)
+
+    def _scan(self, segment: int, start: int) -> Tuple[int, int]:
+        """
+        :return: Size of the segment once the torn tail, if any, is truncated and number of records after start
+        """
+        path = self._path(segment)
+        size = os.path.getsize(path)
+        offset, records = 0, 0
+        with open(path, "rb") as f:
+            while offset + _HEADER.size <= size:
+                f.seek(offset)
+                length, crc = _HEADER.unpack(f.read(_HEADER.size))
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break
+                offset += _HEADER.size + length
+                if offset > start:
+                    records += 1
+        if offset < size:
+            self.logger.warning(f"Discarding {size - offset} torn bytes at the end of {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        return offset, records
+
+    def append(self, route: str, qos: int, items: List[Item]):
+        """
+        Spools messages that must be published together
+        :raises: When the spool is full and the policy is drop_newest
+        """
+        record = _encode(route, qos, items)
+        with self._lock:
+            if self.bytes + len(record) > self.max_bytes:
+                self._make_room(len(record))
+            segment = max(self._segments)
+            if self._segments[segment][0] and self._segments[segment][0] + len(record) > self.segment_size:
+                segment = self._rotate()
+            self._writer.write(record)
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._segments[segment][0] += len(record)
+            self._segments[segment][1] += 1
+            self.bytes += len(record)
+            self.pending += 1
+            self._lock.notify_all()
+
+    def _rotate(self) -> int:
+        self._writer.close()
+        segment = max(self._segments) + 1
+        self._segments[segment] = [0, 0]
+        self._writer = open(self._path(segment), "ab", buffering=0)
+        return segment
+
+    def _make_room(self, size: int):
+        if self.policy == DROP_NEWEST or size > self.max_bytes:
+            raise Exception(f"The spool is full ({self.bytes} bytes), the message was dropped")
+        while self.bytes + size > self.max_bytes:
+            oldest = min(self._segments)
+            if oldest == max(self._segments):
+                self._rotate()
+            segment_size, records = self._segments[oldest]
+            if oldest == self._committed[0]:
+                # Records before the cursor were already acknowledged
+                records = self._count(oldest, self._committed[1])
+            del self._segments[oldest]
+            self._close_map(oldest)
+            os.remove(self._path(oldest))
+            self.bytes -= segment_size
+            self.pending -= records
+            self.dropped += records
+            self.logger.warning(f"Spool full, dropped {records} spooled records")
+            first = (min(self._segments), 0)
+            self._committed = max(self._committed, first)
+            self._read = max(self._read, first)
+            self._write_index()
+
+    def _count(self, segment: int, start: int) -> int:
+        buffer = self._mapped(segment)
+        offset, records = 0, 0
+        while offset < len(buffer):
+            length, _ = _HEADER.unpack_from(buffer, offset)
+            offset += _HEADER.size + length
+            if offset > start:
+                records += 1
+        return records
+
+    def _mapped(self, segment: int):
+        size = self._segments[segment][0]
+        if self._map_segment != segment or len(self._map) < size:
+            self._close_map()
+            if size == 0:
+                return b""
+            with open(self._path(segment), "rb") as f:
+                self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._map_segment = segment
+        return self._map
+
+    def _close_map(self, segment: int = None):
+        if self._map is not None and (segment is None or segment == self._map_segment):
+            self._map.close()
+            self._map = None
+            self._map_segment = None
+
+    def read(self, timeout: float = None) -> Union[None, Record]:
+        """
+        :return: The next record not read yet, None if none is spooled in timeout seconds
+        """
+        with self._lock:
+            while True:
+                segment, offset = self._read
+                if offset < self._segments[segment][0]:
+                    buffer = self._mapped(segment)
+                    length, crc = _HEADER.unpack_from(buffer, offset)
+                    start = offset + _HEADER.size
+                    route, qos, items = _decode(buffer, start, start + length)
+                    self._read = (segment, start + length)
+                    return Record(route, qos, items, self._read)
+                if segment != max(self._segments):
+                    # Every record of the segment was read
+                    self._read = (min(s for s in self._segments if s > segment), 0)
+                    continue
+                if not self._lock.wait(timeout):
+                    return None
+
+    def commit(self, record: Record):
+        """
+        Forgets every record up to this one, once the broker acknowledged them
+        """
+        with self._lock:
+            if record.position <= self._committed:
+                return
+            segment = self._committed[0]
+            self._committed = record.position
+            self.pending -= 1
+            if segment == self._committed[0] and time.monotonic() - self._index_written < self.index_interval:
+                return
+            self._write_index()
+            # Segments before the cursor are done
+            while segment < self._committed[0]:
+                if segment in self._segments:
+                    self._close_map(segment)
+                    self.bytes -= self._segments.pop(segment)[0]
+                    os.remove(self._path(segment))
+                segment += 1
+
+    def rewind(self):
+        """Reads again every record not acknowledged yet, e.g. after a disconnection"""
+        with self._lock:
+            self._read = self._committed
+
+    def _write_index(self):
+        path = os.path.join(self.directory, "index")
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(_INDEX.pack(*self._committed))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        self._index_written = time.monotonic()
+
+    def wake(self):
+        """Wakes up the readers waiting for a record"""
+        with self._lock:
+            self._lock.notify_all()
+
+    def close(self):
+        with self._lock:
+            self._write_index()
+            self._close_map()
+            self._writer.close()
+            self._lock.notify_all()
@@ -0,0 +1,111 @@
+import os
+import time
+import signal
+import threading
+import multiprocessing
+
+from logging import getLogger
+from typing import Callable, List
+
+from .client import MqttClient
+
+
+def _run_worker(factory: Callable[[], MqttClient], index: int, count: int, drain_timeout: float):
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    logger = getLogger("Mqtt Supervisor")
+
+    client = factory()
+    client.worker = (index, count)
+    logger.info(f"Worker {index} connecting to {client.hostname}:{client.port}")
+    client.client.connect(client.hostname, client.port)
+    client.client.loop_start()
+    while not stop.wait(1):
+        pass
+
+    logger.info(f"Worker {index} draining")
+    client.drain(drain_timeout)
+    client.client.loop_stop()
+
+
+class Supervisor:
+    """
+    Runs the endpoints of a client in several processes, so they aren't bound to a single core. Every
+    worker builds its own client, and connection, with the factory. Endpoints with a share_group are
+    load balanced between the workers by the broker, the others receive every message in every worker.
+
+    On SIGTERM or SIGINT the workers stop receiving messages, finish the ones they have and exit.
+    Workers that die are started again.
+    """
+
+    def __init__(self, factory: Callable[[], MqttClient], processes: int = None, drain_timeout: float = 30,
+                 restart_delay: float = 1):
+        """
+        :param factory: Builds the client and registers its endpoints, it's called in each worker process
+        :param processes: Number of workers, defaults to the number of cores
+        :param drain_timeout: Seconds a worker has to finish its messages when stopped before being killed
+        :param restart_delay: Min seconds between starts of a worker that keeps dying
+        """
+        self.factory = factory
+        self.processes = processes or os.cpu_count() or 1
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+
+        self._context = multiprocessing.get_context("fork")
+        self._workers: List[multiprocessing.Process] = [None] * self.processes
+        self._started = [0.0] * self.processes
+        self._stop = threading.Event()
+        self.logger = getLogger("Mqtt Supervisor")
+
+    @property
+    def pids(self) -> List[int]:
+        return [worker.pid for worker in self._workers if worker is not None and worker.is_alive()]
+
+    def run(self):
+        """
+        Starts the workers and keeps them running until stop is called or the process receives SIGTERM or SIGINT
+        """
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *args: self._stop.set())
+        try:
+            while not self._stop.is_set():
+                for index in range(self.processes):
+                    self._supervise(index)
+                self._stop.wait(0.1)
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        """Makes run drain the workers and return"""
+        self._stop.set()
+
+    def _supervise(self, index: int):
+        worker = self._workers[index]
+        if worker is not None:
+            if worker.is_alive():
+                return
+            self.logger.warning(f"Worker {index} exited with code {worker.exitcode}, restarting it")
+            self._workers[index] = None
+        if time.monotonic() - self._started[index] < self.restart_delay:
+            return
+        worker = self._context.Process(target=_run_worker, name=f"mqtt-worker-{index}", daemon=False,
+                                       args=(self.factory, index, self.processes, self.drain_timeout))
+        worker.start()
+        self._workers[index] = worker
+        self._started[index] = time.monotonic()
+
+    def _shutdown(self):
+        workers = [worker for worker in self._workers if worker is not None]
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        deadline = time.monotonic() + self.drain_timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                self.logger.warning(f"Worker {worker.name} didn't drain in {self.drain_timeout}s, killing it")
+                worker.kill()
+                worker.join()
+        self._workers = [None] * self.processes
@@ -0,0 +1,436 @@
+import os
+import time
+import mmap
+import uuid
+import hashlib
+import tempfile
+import threading
+
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+from collections import OrderedDict
+from logging import getLogger
+from typing import Union, Dict, Iterator, Tuple, Hashable
+
+from .crypto import SALT_SIZE
+
+
+CHUNK_SIZE = 256 * 1024  # 256KB
+# Value of the "cipher" header of chunks encrypted with StreamCipher
+STREAM_CIPHER = "aesgcm-stream"
+
+
+class FileTransfer:
+    """
+    Sender side state of a chunked file transfer. It's kept by the caller so an
+    interrupted transfer can be resumed from the last acknowledged chunk, as long as the
+    file isn't modified in between.
+    """
+
+    def __init__(self, route: str, filepath: str, chunk_size: int = CHUNK_SIZE, metadata: dict = None,
+                 secure: bool = False, streaming: bool = False):
+        """
+        :param streaming: Encrypt secure transfers with StreamCipher instead of encrypting each chunk with Fernet
+        """
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be greater than 0")
+        self.route = route
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.chunk_size = chunk_size
+        self.metadata = metadata or {}
+        self.secure = secure
+        self.transfer_id = uuid.uuid4().hex
+        stat = os.stat(filepath)
+        self.size = stat.st_size
+        # Resent chunks must be the same bytes, an encrypted stream would reuse its nonces otherwise
+        self._version = (stat.st_size, stat.st_mtime_ns)
+        self.total_chunks = max(1, -(-self.size // chunk_size))
+        # Kept so a resumed transfer is encrypted with the same key
+        self.salt = os.urandom(SALT_SIZE) if secure and streaming else None
+
+        # Number of chunks acknowledged by the broker, chunks are always acknowledged in order
+        self.acked = 0
+        self.metadata_sent = False
+        self.md5_hash = None
+        self._digest = hashlib.md5()
+        self._hashed = 0
+
+    @property
+    def done(self) -> bool:
+        return self.acked == self.total_chunks
+
+    def chunks(self, start: int = 0) -> Iterator[Tuple[int, bytes]]:
+        """
+        Reads the file chunk by chunk through a memory map, hashing each chunk the first time it's read
+        :raises: When the file was modified since the transfer started, it must be sent again as a new transfer
+        """
+        with open(self.filepath, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if (stat.st_size, stat.st_mtime_ns) != self._version:
+                raise Exception(f"{self.filepath} was modified since its transfer started, it can't be resumed")
+            if self.size == 0:
+                yield from self._hashed_chunks([b""], start)
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                chunks = (view[n * self.chunk_size:(n + 1) * self.chunk_size]
+                          for n in range(start, self.total_chunks))
+                yield from self._hashed_chunks(chunks, start)
+
+    def _hashed_chunks(self, chunks, start: int) -> Iterator[Tuple[int, bytes]]:
+        for index, chunk in enumerate(chunks, start):
+            if index == self._hashed:
+                self._digest.update(chunk)
+                self._hashed += 1
+                if self._hashed == self.total_chunks:
+                    self.md5_hash = self._digest.hexdigest()
+            yield index, chunk
+
+    def chunk_properties(self, index: int) -> Properties:
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = [
+            ("transfer_id", self.transfer_id),
+            ("chunk", str(index)),
+            ("total_chunks", str(self.total_chunks)),
+            ("chunk_size", str(self.chunk_size)),
+        ]
+        if index == self.total_chunks - 1:
+            properties.UserProperty = ("md5_hash", self.md5_hash)
+        if self.salt is not None:
+            properties.UserProperty = [("cipher", STREAM_CIPHER), ("salt", self.salt.hex())]
+        return properties
+
+
+def stream_associated_data(transfer_id: str, total_chunks: int) -> bytes:
+    """
+    Binds the chunks of an encrypted stream to their transfer and to its length
+    """
+    return f"{transfer_id}/{total_chunks}".encode("utf-8")
+
+
+def chunk_headers(properties) -> Union[None, Dict[str, str]]:
+    """
+    :return: The chunk headers carried in the user properties of a message, None if it isn't a file chunk
+    """
+    user_properties = getattr(properties, "UserProperty", None)
+    if not user_properties:
+        return None
+    headers = dict(user_properties)
+    if "transfer_id" not in headers or "chunk" not in headers:
+        return None
+    return headers
+
+
+class IncomingFile:
+    """
+    Receiver side of a chunked file transfer. Chunks are written to a temporary file
+    at their offset, so the file is never held in memory. The digest is computed as
+    chunks arrive in order, chunks that arrive out of order are hashed from disk
+    once the gap before them is filled.
+    """
+
+    def __init__(self, transfer_id: str, total_chunks: int, chunk_size: int, directory: str = None):
+        self.transfer_id = transfer_id
+        self.total_chunks = total_chunks
+        self.chunk_size = chunk_size
+        self.md5_hash = None
+        self.metadata = None
+        self.size = 0
+        # StreamCipher of encrypted streams
+        self.cipher = None
+        self.updated = time.monotonic()
+
+        fd, self.path = tempfile.mkstemp(prefix="mqtt-transfer-", dir=directory)
+        self._file = os.fdopen(fd, "r+b")
+        self._received = set()
+        self._digest = hashlib.md5()
+        self._hashed = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.metadata is not None and len(self._received) == self.total_chunks
+
+    def write_chunk(self, index: int, data: bytes):
+        if index in self._received or not 0 <= index < self.total_chunks:
+            # Resent after a resume or a QoS 1 redelivery
+            return
+        self._file.seek(index * self.chunk_size)
+        self._file.write(data)
+        self._received.add(index)
+        self.size += len(data)
+
+        if index == self._hashed:
+            self._digest.update(data)
+            self._hashed += 1
+            while self._hashed in self._received:
+                self._file.seek(self._hashed * self.chunk_size)
+                self._digest.update(self._file.read(self.chunk_size))
+                self._hashed += 1
+
+    def verify(self) -> bool:
+        self._file.flush()
+        return self._digest.hexdigest() == self.md5_hash
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class IncomingTransfers:
+    """
+    Chunked file transfers being received, by transfer id. Each one holds an open temporary file, so
+    transfers idle for `ttl` seconds (e.g. their sender died) are discarded, and the least recently
+    updated ones once there are over `max_entries`. Chunks and metadata of recently completed transfers,
+    redelivered or resent by resume_file, are dropped instead of starting a transfer that never completes.
+    """
+
+    def __init__(self, ttl: float = 300, max_entries: int = 100, directory: str = None):
+        """
+        :param directory: Where the files are written, defaults to the system temp dir
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory
+
+        self.evicted = 0
+        self.expired = 0
+
+        self._transfers = OrderedDict()
+        # Recently completed transfers, to drop chunks redelivered after completion
+        self._completed = OrderedDict()
+        self._lock = threading.Lock()
+        self.logger = getLogger("Mqtt Transfers")
+
+    def __len__(self) -> int:
+        return len(self._transfers)
+
+    def __contains__(self, transfer_id: str) -> bool:
+        return transfer_id in self._transfers
+
+    def get(self, transfer_id: str, total_chunks: int, chunk_size: int) -> Union[None, IncomingFile]:
+        """
+        :return: The transfer, started if it's the first message of it. None if it already completed
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            transfer = self._transfers.get(transfer_id)
+            if transfer is None:
+                if transfer_id in self._completed:
+                    return None
+                transfer = self._transfers[transfer_id] = IncomingFile(transfer_id, total_chunks, chunk_size,
+                                                                       self.directory)
+                self._evict()
+            else:
+                self._transfers.move_to_end(transfer_id)
+            transfer.updated = now
+            return transfer
+
+    def finish(self, transfer: IncomingFile):
+        """
+        Forgets a transfer once every chunk arrived, the caller owns its file from then on
+        """
+        with self._lock:
+            if self._transfers.pop(transfer.transfer_id, None) is None:
+                return
+            self._completed[transfer.transfer_id] = None
+            if len(self._completed) > self.max_entries:
+                self._completed.popitem(last=False)
+
+    def _expire(self, now: float):
+        while self._transfers:
+            transfer_id, transfer = next(iter(self._transfers.items()))
+            if now - transfer.updated < self.ttl:
+                return
+            self.logger.warning(f"Chunked file {transfer_id} timed out with {transfer.size} bytes received")
+            del self._transfers[transfer_id]
+            transfer.discard()
+            self.expired += 1
+
+    def _evict(self):
+        while len(self._transfers) > self.max_entries:
+            transfer_id, transfer = self._transfers.popitem(last=False)
+            self.logger.warning(f"Too many chunked files being received, discarding {transfer_id}")
+            transfer.discard()
+            self.evicted += 1
+
+    def close(self):
+        """Discards every transfer not completed yet"""
+        with self._lock:
+            transfers = list(self._transfers.values())
+            self._transfers.clear()
+        for transfer in transfers:
+            transfer.discard()
+
+
+class _PendingFile:
+    __slots__ = ("metadata", "body", "path", "size", "updated")
+
+    def __init__(self, now: float):
+        self.metadata = None
+        self.body = None
+        self.path = None
+        self.size = 0
+        self.updated = now
+
+
+class TransferStore:
+    """
+    Holds the halves of single message file transfers (metadata and body are two
+    messages) until both arrive. Entries are dropped `ttl` seconds after their
+    last message, and the least recently updated ones are evicted when the bodies held in
+    memory go over `max_bytes`, the spilled ones over `max_disk_bytes` or the entries
+    over `max_entries`. Bodies of `spill_size` bytes or more wait on disk.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1000 * 1000, ttl: float = 60, max_entries: int = 1000,
+                 spill_size: int = 1000 * 1000, max_disk_bytes: int = 1000 * 1000 * 1000, directory: str = None):
+        """
+        :param spill_size: Bodies this big are written to a temporary file, None keeps every body in memory
+        :param directory: Where spilled bodies are written, defaults to the system temp dir
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.spill_size = spill_size
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = directory
+
+        self.bytes = 0
+        self.disk_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self.spilled = 0
+
+        self._entries = OrderedDict()
+        # Recently completed transfers, to drop halves redelivered after completion
+        self._completed = OrderedDict()
+        self._lock = threading.Lock()
+        self.logger = getLogger("Mqtt Transfers")
+
+    @property
+    def pending(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def add_metadata(self, key: Hashable, metadata: dict) -> Union[None, dict]:
+        """
+        :param key: Transfer id of the file
+        :param metadata: File dict handed to the endpoint, without its bytes
+        :return: The file with its bytes if the body already arrived, None otherwise
+        """
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return None
+            entry.metadata = metadata
+            entry = self._complete(key, entry)
+        return self._file(entry)
+
+    def add_body(self, key: Hashable, body: bytes) -> Union[None, dict]:
+        """
+        :return: The file with its bytes if the metadata already arrived, None otherwise
+        """
+        path = None
+        waiting = self._entries.get(key)
+        if (self.spill_size is not None and len(body) >= self.spill_size
+                and (waiting is None or waiting.metadata is None)):
+            # Written before taking the lock, it's slow
+            fd, path = tempfile.mkstemp(prefix="mqtt-file-", dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None or entry.body is not None or entry.path is not None:
+                # Completed or redelivered
+                if path is not None:
+                    os.remove(path)
+                return None
+            entry.size = len(body)
+            if path is not None:
+                entry.path = path
+                self.disk_bytes += entry.size
+                self.spilled += 1
+            else:
+                entry.body = body
+                self.bytes += entry.size
+            completed = self._complete(key, entry)
+            if completed is None:
+                self._evict()
+        return self._file(completed)
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._release(entry)
+
+    def _entry(self, key: Hashable) -> Union[None, _PendingFile]:
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get(key)
+        if entry is None:
+            if key in self._completed:
+                return None
+            entry = self._entries[key] = _PendingFile(now)
+        else:
+            self._entries.move_to_end(key)
+            entry.updated = now
+        return entry
+
+    def _complete(self, key: Hashable, entry: _PendingFile) -> Union[None, _PendingFile]:
+        if entry.metadata is None or (entry.body is None and entry.path is None):
+            return None
+        del self._entries[key]
+        self._completed[key] = None
+        if len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+        self._release(entry, remove=False)
+        return entry
+
+    @staticmethod
+    def _file(entry: Union[None, _PendingFile]) -> Union[None, dict]:
+        if entry is None:
+            return None
+        body = entry.body
+        if entry.path is not None:
+            with open(entry.path, "rb") as f:
+                body = f.read()
+            os.remove(entry.path)
+        return dict(entry.metadata, bytes=body)
+
+    def _release(self, entry: _PendingFile, remove: bool = True):
+        if entry.path is not None:
+            self.disk_bytes -= entry.size
+            if remove and os.path.exists(entry.path):
+                os.remove(entry.path)
+        elif entry.body is not None:
+            self.bytes -= entry.size
+
+    def _expire(self, now: float):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.updated < self.ttl:
+                return
+            self.logger.warning(f"File transfer {key} timed out waiting for its "
+                                f"{'body' if entry.metadata is not None else 'metadata'}")
+            del self._entries[key]
+            self._release(entry)
+            self.expired += 1
+
+    def _evict(self):
+        while self._entries and (self.bytes > self.max_bytes or self.disk_bytes > self.max_disk_bytes
+                                 or len(self._entries) > self.max_entries):
+            key, entry = self._entries.popitem(last=False)
+            self.logger.warning(f"File transfer store full, evicting transfer {key}")
+            self._release(entry)
+            self.evicted += 1
@@ -1 +1 @@
-from . import test_serialize
+from . import test_serialize, test_publisher, test_transfer, test_reassembly, test_keycache, test_dispatcher, test_envelope, test_compression, test_integration, test_metrics, test_batcher, test_router, test_spool, test_supervisor, test_rpc, test_jsoncodec
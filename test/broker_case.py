@@ -0,0 +1,39 @@
+import threading
+import unittest
+
+from cryptography.fernet import Fernet
+from benchmarks.broker import StandInBroker
+from src.MqttLibPy.client import MqttClient
+
+
+class BrokerTestCase(unittest.TestCase):
+    """
+    Runs each test against its own in-process stand-in broker, the clients are closed afterwards
+    """
+    # Clients encrypt with self.key unless a test passes its own encryption options
+    encrypted = True
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.key = Fernet.generate_key()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.client.disconnect()
+            client.close()
+        self.broker.stop()
+
+    def client(self, **kwargs) -> MqttClient:
+        if self.encrypted:
+            kwargs.setdefault("encryption_key", self.key)
+        client = MqttClient("127.0.0.1", self.broker.port, publish_timeout=10, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def listen(self, client: MqttClient):
+        subscribed = threading.Event()
+        # Every route is subscribed to in a single packet
+        client.client.on_subscribe = lambda *args: subscribed.set()
+        threading.Thread(target=client.listen, daemon=True).start()
+        self.assertTrue(subscribed.wait(5))
@@ -0,0 +1,120 @@
+import json
+import time
+import threading
+import unittest
+
+from paho.mqtt.client import MQTTMessage
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from src.MqttLibPy.batcher import Batcher, BATCH_PROPERTY, is_batch, unbatch
+from src.MqttLibPy.publisher import PublishHandle
+from src.MqttLibPy.serializer import Serializer
+from .broker_case import BrokerTestCase
+
+
+class TestBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.published = []
+        self.handles = []
+
+    def publish(self, topic, payloads):
+        self.published.append((topic, list(payloads)))
+        handle = PublishHandle()
+        self.handles.append(handle)
+        return handle
+
+    def test_linger(self):
+        batcher = Batcher(self.publish, linger=0.05)
+        self.addCleanup(batcher.close)
+        first = batcher.add("a", b"1")
+        self.assertIs(batcher.add("a", b"2"), first)
+        batcher.add("b", b"3")
+        self.assertEqual(self.published, [])
+        self.assertEqual(batcher.pending, 3)
+
+        time.sleep(0.2)
+        self.assertEqual(self.published, [("a", [b"1", b"2"]), ("b", [b"3"])])
+        self.assertFalse(first.done())
+        self.handles[0]._complete()
+        self.assertTrue(first.wait(0))
+
+    def test_limits(self):
+        batcher = Batcher(self.publish, linger=10, max_bytes=10, max_messages=3)
+        self.addCleanup(batcher.close)
+        for payload in [b"1", b"2", b"3", b"4"]:
+            batcher.add("a", payload)
+        # Full by number of messages
+        self.assertEqual(self.published, [("a", [b"1", b"2", b"3"])])
+
+        # "[4, 123456]" would take 11 bytes, the pending batch is published first
+        batcher.add("a", b"123456")
+        self.assertEqual(self.published[1], ("a", [b"4"]))
+        batcher.flush()
+        self.assertEqual(self.published[2], ("a", [b"123456"]))
+
+    def test_errors(self):
+        def publish(topic, payloads):
+            raise ConnectionError("Disconnected")
+
+        batcher = Batcher(publish, linger=10)
+        handle = batcher.add("a", b"1")
+        batcher.close()
+        self.assertIsInstance(handle.exception(), ConnectionError)
+        with self.assertRaises(Exception):
+            batcher.add("a", b"2")
+
+    def test_unbatch(self):
+        packets = [{"data": [{"n": n}]} for n in range(3)]
+        packet = Serializer("sender").serialize_batch([Serializer.encode_packet(p) for p in packets])
+        message = MQTTMessage(1, b"route")
+        message.payload = Serializer.encode_packet(packet)
+        self.assertFalse(is_batch(message))
+        message.properties = Properties(PacketTypes.PUBLISH)
+        message.properties.UserProperty = (BATCH_PROPERTY, "3")
+        self.assertTrue(is_batch(message))
+        self.assertEqual([json.loads(item.payload) for item in unbatch(message)], packets)
+        self.assertEqual({item.topic for item in unbatch(message)}, {"route"})
+
+
+class TestLinger(BrokerTestCase):
+
+    def test_endpoints(self):
+        received = {"json": [], "batch": [], "raw": []}
+        done = threading.Event()
+        receiver = self.client()
+
+        def received_all():
+            if len(received["json"]) == 100 and sum(map(len, received["batch"])) == 100 and \
+                    len(received["raw"]) == 100:
+                done.set()
+
+        @receiver.endpoint("linger/json", force_json=True, secure=True)
+        def json_route(client, user_data, message):
+            received["json"].append(message[0]["n"])
+            received_all()
+
+        @receiver.endpoint("linger/batch", force_json=True, batch=True)
+        def batch_route(client, user_data, messages):
+            received["batch"].append([message[0]["n"] for message in messages])
+            received_all()
+
+        @receiver.endpoint("linger/raw")
+        def raw_route(client, user_data, message):
+            received["raw"].append(json.loads(message.payload)["n"])
+            received_all()
+
+        self.listen(receiver)
+        sender = self.client(linger_ms=20)
+        handles = []
+        for n in range(100):
+            handles.append(sender.send_message_serialized([{"n": n}], "linger/json", valid_json=True, secure=True))
+            handles.append(sender.send_message_serialized([{"n": n}], "linger/batch", valid_json=True))
+            handles.append(sender.send_message("linger/raw", {"n": n}))
+        self.assertTrue(all(handle.wait(5) for handle in handles))
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received["json"], list(range(100)))
+        self.assertEqual(received["raw"], list(range(100)))
+        self.assertEqual(sum(received["batch"], []), list(range(100)))
+        self.assertLess(len(received["batch"]), 100)
@@ -0,0 +1,103 @@
+import os
+import base64
+import unittest
+
+from cryptography.fernet import Fernet
+from src.MqttLibPy.compression import ZlibCodec, register_codec, get_codec
+from src.MqttLibPy.envelope import encode_envelope, decode_envelope
+from src.MqttLibPy.reassembly import ReassemblyBuffer
+from src.MqttLibPy.serializer import Serializer
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [{"id": n, "name": f"Product {n}", "category": "Office supplies", "price": n * 1.5}
+                     for n in range(5000)]
+
+    def serializer(self, codec=ZlibCodec(), **kwargs) -> Serializer:
+        serializer = Serializer("sender", codec=codec, **kwargs)
+        serializer.MAX_MESSAGE_LENGTH = 16000
+        return serializer
+
+    def receive(self, serializer: Serializer, packets) -> list:
+        reassembly = ReassemblyBuffer()
+        results = [serializer.deserialize(Serializer.encode_packet(packet), reassembly) for packet in packets]
+        return [result for result in results if result is not None]
+
+    def test_json(self):
+        serializer = self.serializer()
+        packets = serializer.serialize(self.rows, valid_json=True, pre_encoded=True)
+        uncompressed = self.serializer(codec=None).serialize(self.rows, valid_json=True, pre_encoded=True)
+
+        # Packing accounts for the compressed size
+        self.assertLess(len(packets), len(uncompressed) / 3)
+        self.assertTrue(all(packet["compression"] == "zlib" for packet in packets))
+        self.assertTrue(all(len(Serializer.encode_packet(packet)) < 2 * serializer.MAX_MESSAGE_LENGTH
+                            for packet in packets))
+        self.assertEqual(self.receive(serializer, packets), [self.rows])
+
+    def test_encrypted(self):
+        key = Fernet.generate_key()
+        serializer = self.serializer(key=key)
+        packets = serializer.serialize(self.rows, valid_json=True, encrypt=True)
+        self.assertEqual(self.receive(serializer, packets), [self.rows])
+
+        text = "hola " * 1000
+        packets = serializer.serialize(text, encrypt=True)
+        self.assertEqual(packets[0]["compression"], "zlib")
+        self.assertEqual(self.receive(serializer, packets), [text])
+
+    def test_incompressible_groups_are_split(self):
+        # The sample compresses well, the rest of the rows don't
+        rows = self.rows[:1000] + [{"id": n, "blob": base64.b64encode(os.urandom(600)).decode()}
+                                   for n in range(200)]
+        serializer = self.serializer()
+        packets = serializer.serialize(rows, valid_json=True, pre_encoded=True)
+        for packet in packets:
+            data = packet["data"]
+            self.assertLess(len(data), serializer.MAX_MESSAGE_LENGTH)
+        self.assertEqual(self.receive(serializer, packets), [rows])
+
+    def test_threshold(self):
+        serializer = self.serializer(compression_threshold=1024)
+        packet = serializer.serialize(self.rows[:2], valid_json=True, pre_encoded=True)[0]
+        self.assertNotIn("compression", packet)
+        self.assertEqual(self.receive(serializer, [packet]), [self.rows[:2]])
+
+    def test_shared_dictionary(self):
+        sample = Serializer.encode_packet({"data": self.rows[:20]})
+        codec = register_codec(ZlibCodec(zdict=sample))
+        self.assertIs(get_codec(codec.name), codec)
+
+        row = b'{"id": 7, "name": "Product 7", "category": "Office supplies", "price": 10.5}'
+        self.assertLess(len(codec.compress(row)), len(ZlibCodec().compress(row)))
+        self.assertEqual(codec.decompress(codec.compress(row)), row)
+        with self.assertRaises(Exception):
+            register_codec(ZlibCodec(zdict=b"other", name=codec.name))
+
+    def test_envelope(self):
+        serializer = self.serializer()
+        packets = serializer.serialize(self.rows, valid_json=True, pre_encoded=True)
+        body = []
+        for packet in packets:
+            body.extend(decode_envelope(encode_envelope(packet))["data"])
+        self.assertEqual(body, self.rows)
+
+    def test_decompression_limit(self):
+        data = b"[" + b" " * 1000 * 1000 + b"]"
+        for codec in (ZlibCodec(), register_codec(ZlibCodec(zdict=b"[ ]"))):
+            compressed = codec.compress(data)
+            self.assertEqual(codec.decompress(compressed, len(data)), data)
+            with self.assertRaises(Exception):
+                codec.decompress(compressed, len(data) - 1)
+
+        # A small packet that decompresses to a lot more than any sender packs is rejected
+        packet = {"data": ZlibCodec().compress(data), "compression": "zlib", "type": "json", "is_valid_json": True,
+                  "from": "sender"}
+        receiver = Serializer("receiver", max_decompressed_size=1000)
+        with self.assertLogs("Mqtt Serializer", "ERROR"):
+            self.assertIsNone(receiver.deserialize(Serializer.encode_packet(packet)))
+        with self.assertRaises(Exception):
+            decode_envelope(encode_envelope(packet), max_decompressed_size=1000)
+        self.assertEqual(decode_envelope(encode_envelope(packet))["data"], [])
@@ -0,0 +1,54 @@
+import time
+import threading
+import unittest
+
+from src.MqttLibPy.dispatcher import Dispatcher, DROP_NEWEST, DROP_OLDEST
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_order_per_key(self):
+        dispatcher = Dispatcher(workers=4)
+        handled = {}
+
+        def handler(key, n):
+            time.sleep(0.0005 * (n % 3))
+            handled.setdefault(key, []).append(n)
+
+        for n in range(200):
+            key = f"company/{n % 5}/orders"
+            dispatcher.submit(key, handler, key, n)
+        dispatcher.stop()
+
+        self.assertEqual(sum(len(values) for values in handled.values()), 200)
+        for values in handled.values():
+            self.assertEqual(values, sorted(values))
+
+    def _blocked_dispatcher(self, backpressure: str):
+        dispatcher = Dispatcher(workers=1, queue_size=2, backpressure=backpressure)
+        release = threading.Event()
+        started = threading.Event()
+        handled = []
+
+        def handler(n):
+            started.set()
+            release.wait()
+            handled.append(n)
+
+        dispatcher.submit("key", handler, 0)
+        started.wait()
+        for n in range(1, 5):
+            dispatcher.submit("key", handler, n)
+        release.set()
+        dispatcher.stop()
+        return dispatcher, handled
+
+    def test_drop_newest(self):
+        dispatcher, handled = self._blocked_dispatcher(DROP_NEWEST)
+        self.assertEqual(handled, [0, 1, 2])
+        self.assertEqual(dispatcher.dropped, 2)
+
+    def test_drop_oldest(self):
+        dispatcher, handled = self._blocked_dispatcher(DROP_OLDEST)
+        self.assertEqual(handled, [0, 3, 4])
+        self.assertEqual(dispatcher.dropped, 2)
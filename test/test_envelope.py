@@ -0,0 +1,72 @@
+import json
+import unittest
+
+from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from paho.mqtt.client import MQTTMessage
+from src.MqttLibPy.client import MqttClient
+from src.MqttLibPy.crypto import AeadCipher
+from src.MqttLibPy.envelope import encode_envelope, decode_envelope, is_envelope
+from src.MqttLibPy.serializer import Serializer
+
+
+class TestEnvelope(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = Serializer("sender")
+        self.serializer.MAX_MESSAGE_LENGTH = 16000
+        self.rows = [{"id": n, "name": f"Row {n}", "price": n * 1.5} for n in range(2000)]
+
+    def test_round_trip(self):
+        packets = self.serializer.serialize(self.rows, valid_json=True, pre_encoded=True)
+        self.assertGreater(len(packets), 1)
+        body = []
+        for packet in packets:
+            payload = encode_envelope(packet)
+            self.assertTrue(is_envelope(payload))
+            decoded = decode_envelope(payload)
+            self.assertEqual(decoded["message_id"], packet["message_id"])
+            self.assertEqual(decoded["from"], "sender")
+            self.assertEqual(decoded["total_fragments"], len(packets))
+            body.extend(decoded["data"])
+        self.assertEqual(body, self.rows)
+
+        # Smaller than the json packets
+        self.assertLess(len(encode_envelope(packets[0])), len(Serializer.encode_packet(packets[0])))
+
+    def test_encrypted(self):
+        cipher = AeadCipher(Fernet.generate_key())
+        packet = self.serializer.serialize("hola", pre_encoded=True)[0]
+        payload = encode_envelope(packet, cipher)
+        self.assertNotIn(b"hola", payload)
+
+        decoded = decode_envelope(payload, cipher)
+        self.assertEqual(decoded["data"], "hola")
+        self.assertTrue(decoded["encrypted"])
+
+        with self.assertRaises(ValueError):
+            decode_envelope(payload)
+        # The header is authenticated along with the body
+        tampered = bytearray(payload)
+        tampered[4] ^= 1
+        with self.assertRaises(InvalidTag):
+            decode_envelope(bytes(tampered), cipher)
+
+    def test_client_decodes_both_formats(self):
+        key = Fernet.generate_key()
+        client = MqttClient("localhost", 1883, encryption_key=key)
+        message = MQTTMessage(topic=b"orders")
+        packet = client._serializer("orders", False).serialize(self.rows[:10], valid_json=True, pre_encoded=True)[0]
+
+        message.payload = encode_envelope(packet, client._get_cipher("orders"))
+        self.assertEqual(client._decode_packet(message, True)["data"], self.rows[:10])
+
+        message.payload = Serializer.encode_packet(
+            client._serializer("orders", True).serialize(self.rows[:10], valid_json=True, encrypt=True)[0])
+        self.assertEqual(client._decode_packet(message, True)["data"], self.rows[:10])
+
+        # Secure endpoints don't accept unencrypted envelopes
+        message.payload = encode_envelope(packet)
+        self.assertEqual(json.loads(json.dumps(client._decode_packet(message, False)["data"])), self.rows[:10])
+        with self.assertRaises(Exception):
+            client._decode_packet(message, True)
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import tempfile
+import threading
+
+from random import randbytes
+from unittest import mock
+from benchmarks.broker import StandInBroker
+from benchmarks.run import Benchmark
+from src.MqttLibPy.aio import AsyncMqttClient
+from .broker_case import BrokerTestCase
+
+
+class TestIntegration(BrokerTestCase):
+    """
+    End to end tests against the in-process stand-in broker
+    """
+    encrypted = False
+
+    def test_key_callback(self):
+        db = {'mycompany': self.key}
+        received = []
+        done = threading.Event()
+        client = self.client(encryption_callback=lambda topic: db[topic.split('/')[1]])
+
+        @client.endpoint('company/+/test_route', force_json=True, secure=True)
+        def test_route(client, user_data, message):
+            received.append(message)
+            done.set()
+
+        self.listen(client)
+        sender = self.client(encryption_key=self.key)
+        sender.send_message_serialized([{"message": "hola"}], "company/mycompany/test_route", valid_json=True,
+                                       secure=True)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, [[{"message": "hola"}]])
+
+    def test_secure_files(self):
+        content = randbytes(300 * 1000)
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+
+        received = {}
+        done = threading.Event()
+        client = self.client(encryption_key=self.key)
+
+        @client.endpoint("test_bytes", is_file=True, secure=True)
+        def get_file(client, user_data, file):
+            if file['bytes'] is None:
+                with open(file['path'], 'rb') as f:
+                    file['bytes'] = f.read()
+            received[file['data'].get('n')] = file['bytes']
+            if len(received) == 3:
+                done.set()
+
+        self.listen(client)
+        sender = self.client(encryption_key=self.key)
+        sender.send_file("test_bytes", path, {"n": 1}, secure=True)
+        sender.send_file_chunked("test_bytes", path, {"n": 2}, secure=True, chunk_size=64 * 1000)
+        # Encrypted as a single AES-GCM stream
+        sender.send_file_chunked("test_bytes", path, {"n": 3}, secure=True, chunk_size=64 * 1000,
+                                 wire_format="binary")
+        self.assertTrue(done.wait(10))
+        self.assertEqual(received, {1: content, 2: content, 3: content})
+
+    def test_async_client(self):
+        async def main():
+            client = AsyncMqttClient("127.0.0.1", self.broker.port, encryption_key=self.key)
+            received = asyncio.Queue()
+
+            @client.endpoint("async_route", force_json=True, secure=True)
+            async def route(mqtt_client, user_data, message):
+                await received.put(message)
+
+            listener = asyncio.create_task(client.listen())
+            await client.connect()
+            await asyncio.sleep(0.2)
+            await client.send_message_serialized([{"n": 1}], "async_route", valid_json=True, secure=True)
+            message = await asyncio.wait_for(received.get(), 5)
+            await client.close()
+            await listener
+            return message
+
+        self.assertEqual(asyncio.run(main()), [{"n": 1}])
+
+    def test_async_drain(self):
+        async def main():
+            client = AsyncMqttClient("127.0.0.1", self.broker.port)
+            received = asyncio.Queue()
+
+            @client.endpoint("async_drain", force_json=True)
+            async def route(mqtt_client, user_data, message):
+                await received.put(message)
+
+            listener = asyncio.create_task(client.listen())
+            await client.connect()
+            await asyncio.sleep(0.2)
+            await client.send_message_serialized([{"n": 1}], "async_drain", valid_json=True)
+            message = await asyncio.wait_for(received.get(), 5)
+            await client.drain(5)
+            await asyncio.wait_for(listener, 5)
+            return message
+
+        with mock.patch.object(StandInBroker, "unsubscribe", autospec=True,
+                               side_effect=StandInBroker.unsubscribe) as unsubscribe:
+            self.assertEqual(asyncio.run(main()), [{"n": 1}])
+        self.assertEqual([call.args[2] for call in unsubscribe.call_args_list], [b"async_drain"])
+
+    def test_benchmark(self):
+        benchmark = Benchmark(self.broker.port, messages=5)
+        self.addCleanup(os.rmdir, benchmark.directory)
+        result = benchmark.run("json_secure", 1000)
+        self.assertEqual(result["received"], 5)
+        self.assertGreater(result["publish_rate"], 0)
+        self.assertIsNotNone(result["latency_ms"]["p99"])
@@ -0,0 +1,72 @@
+import json
+import math
+import uuid
+import datetime
+import unittest
+
+from cryptography.fernet import Fernet
+from src.MqttLibPy import jsoncodec
+from src.MqttLibPy.jsoncodec import JsonCodec, OrjsonCodec, decode_header, set_json_codec, get_json_codec
+from src.MqttLibPy.serializer import Serializer
+
+
+class TestJsonCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(set_json_codec, get_json_codec())
+        self.rows = [{"id": n, "name": f"ñandú {n}", "price": n * 1.5, "ok": n % 2 == 0} for n in range(50)]
+
+    def test_codecs(self):
+        for codec in (JsonCodec(), OrjsonCodec()):
+            encoded = codec.dumps(self.rows)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(json.loads(encoded), self.rows)
+            for data in (encoded, bytearray(encoded), memoryview(encoded)[0:], encoded.decode("utf-8")):
+                self.assertEqual(codec.loads(data), self.rows)
+            # What orjson doesn't support goes through the standard library
+            self.assertEqual(codec.loads(codec.dumps({1: 2 ** 70})), {"1": 2 ** 70})
+            # Not finite floats aren't written as null
+            encoded = codec.dumps([{"v": float("nan")}, None, float("inf"), -float("inf")])
+            self.assertEqual(json.loads(encoded)[1:], [None, math.inf, -math.inf])
+            self.assertTrue(math.isnan(codec.loads(encoded)[0]["v"]))
+            identifier = uuid.uuid4()
+            self.assertEqual(codec.loads(codec.dumps({"id": identifier})), {"id": str(identifier)})
+            with self.assertRaises(TypeError):
+                codec.dumps({"at": datetime.date.today()})
+        with self.assertRaises(Exception):
+            set_json_codec("yaml")
+
+    def test_interoperable(self):
+        key = Fernet.generate_key()
+        for sender, receiver in (("json", "orjson"), ("orjson", "json")):
+            set_json_codec(sender)
+            packets = Serializer("sender", key).serialize(self.rows, valid_json=True, encrypt=True)
+            payloads = [Serializer.encode_packet(packet) for packet in packets]
+            set_json_codec(receiver)
+            self.assertEqual(Serializer("receiver", key).deserialize(payloads[0]), self.rows)
+
+    def test_decode_header(self):
+        packet = Serializer("sender").serialize(b"content", filename="a.bin")[0]
+        payload = Serializer.encode_packet(packet)
+        self.assertTrue(payload.endswith(b"}"))
+        header = decode_header(payload)
+        self.assertEqual(header["md5_hash"], packet["md5_hash"])
+        self.assertEqual(header["from"], "sender")
+        self.assertNotIn("data", header)
+        # The data isn't parsed at all
+        header = decode_header(payload[:payload.index(b'"data":') + 8] + b"not json")
+        self.assertEqual(header["type"], "file")
+        # Quotes inside the header values are escaped
+        payload = json.dumps({"from": 'x", "data": 1', "type": "text", "data": "a"}).encode("utf-8")
+        self.assertEqual(decode_header(payload), {"from": 'x", "data": 1', "type": "text"})
+
+        # Packets with the data elsewhere are parsed in full
+        for payload in (json.dumps(packet).encode("utf-8"),
+                        json.dumps({"type": "text", "meta": {"data": 1}, "data": "a"}).encode("utf-8")):
+            self.assertEqual(decode_header(memoryview(payload)), json.loads(payload))
+
+    def test_default(self):
+        set_json_codec("json")
+        self.assertEqual(jsoncodec.dumps({"a": [1]}), b'{"a": [1]}')
+        set_json_codec("orjson")
+        self.assertEqual(jsoncodec.dumps({"a": [1]}), b'{"a":[1]}')
@@ -0,0 +1,52 @@
+import time
+import unittest
+
+from cryptography.fernet import Fernet
+from src.MqttLibPy.client import MqttClient
+from src.MqttLibPy.keycache import KeyCache
+
+
+class TestKeyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.db = {'company_a': Fernet.generate_key(), 'company_b': Fernet.generate_key()}
+        self.lookups = []
+
+    def callback_key(self, topic: str):
+        self.lookups.append(topic)
+        return self.db[topic.split('/')[1]]
+
+    def test_cache_per_tenant(self):
+        keys = KeyCache(self.callback_key, cache_key=lambda topic: topic.split('/')[1])
+        fernet = keys.get_fernet('company/company_a/orders')
+        self.assertIs(keys.get_fernet('company/company_a/invoices'), fernet)
+        keys.get_fernet('company/company_b/orders')
+
+        self.assertEqual(len(self.lookups), 2)
+        self.assertEqual((keys.hits, keys.misses), (1, 2))
+
+        # Key rotation
+        self.db['company_a'] = Fernet.generate_key()
+        keys.invalidate('company/company_a/orders')
+        self.assertEqual(keys.get_key('company/company_a/orders'), self.db['company_a'])
+        self.assertEqual(len(self.lookups), 3)
+
+    def test_ttl_and_size(self):
+        keys = KeyCache(self.callback_key, max_size=1, ttl=0.01)
+        keys.get_key('company/company_a/orders')
+        keys.get_key('company/company_b/orders')
+        self.assertEqual(len(keys), 1)
+
+        keys.get_key('company/company_b/orders')
+        time.sleep(0.02)
+        keys.get_key('company/company_b/orders')
+        self.assertEqual(keys.misses, 3)
+        self.assertEqual(keys.hits, 1)
+
+    def test_client_serializer(self):
+        client = MqttClient("localhost", 1883, encryption_callback=self.callback_key)
+        token = client._serializer('company/company_a/orders', True).encrypt_string("hola")
+        self.assertEqual(Fernet(self.db['company_a']).decrypt(token.encode()), b"hola")
+        client._serializer('company/company_a/orders', True)
+        client._serializer('company/company_a/orders', False)
+        self.assertEqual(len(self.lookups), 1)
@@ -0,0 +1,78 @@
+import threading
+import unittest
+
+from cryptography.fernet import Fernet
+from benchmarks.broker import StandInBroker
+from src.MqttLibPy.client import MqttClient
+from src.MqttLibPy.metrics import InMemoryExporter, Histogram, NOOP
+from src.MqttLibPy.serializer import Serializer
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(0.5))
+        for _ in range(90):
+            histogram.observe(0.0007)
+        for _ in range(10):
+            histogram.observe(0.3)
+        self.assertEqual(histogram.percentile(0.5), 0.001)
+        self.assertEqual(histogram.percentile(0.99), 0.5)
+        self.assertEqual(histogram.count, 100)
+
+    def test_serializer(self):
+        metrics = InMemoryExporter()
+        key = Fernet.generate_key()
+        serializer = Serializer("sender", key=key, metrics=metrics, route="orders")
+        serializer.MAX_MESSAGE_LENGTH = 100
+        packets = serializer.serialize([{"n": n} for n in range(50)], valid_json=True, encrypt=True)
+        for packet in packets:
+            serializer.deserialize(Serializer.encode_packet(packet))
+        Serializer("sender", key=Fernet.generate_key(), metrics=metrics, route="orders") \
+            .deserialize(Serializer.encode_packet(packets[0]))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["fragments_sent"]["orders"], len(packets))
+        self.assertEqual(snapshot["counters"]["decrypt_failures"]["orders"], 1)
+        self.assertEqual(snapshot["histograms"]["decrypt_seconds"]["orders"]["count"], len(packets))
+        self.assertEqual(snapshot["histograms"]["deserialize_seconds"]["orders"]["count"], len(packets))
+
+    def test_client(self):
+        broker = StandInBroker().start()
+        self.addCleanup(broker.stop)
+        key = Fernet.generate_key()
+        metrics = InMemoryExporter()
+        receiver = MqttClient("127.0.0.1", broker.port, encryption_key=key, metrics=metrics, metrics_interval=None)
+        sender = MqttClient("127.0.0.1", broker.port, encryption_key=key, metrics=metrics, metrics_interval=None)
+        self.addCleanup(sender.close)
+        self.addCleanup(receiver.close)
+        self.addCleanup(receiver.client.disconnect)
+        self.assertIs(MqttClient("127.0.0.1", broker.port).metrics, NOOP)
+
+        done = threading.Event()
+        subscribed = threading.Event()
+        receiver.client.on_subscribe = lambda *args: subscribed.set()
+
+        @receiver.endpoint("orders", force_json=True, secure=True, concurrency=2)
+        def orders(client, user_data, message):
+            if message[0]["n"] == 1:
+                raise ValueError("Unexpected order")
+            done.set()
+
+        threading.Thread(target=receiver.listen, daemon=True).start()
+        self.assertTrue(subscribed.wait(5))
+        sender.send_message_serialized([{"n": 1}], "orders", valid_json=True, secure=True)
+        sender.send_message_serialized([{"n": 2}], "orders", valid_json=True, secure=True)
+        self.assertTrue(done.wait(5))
+        receiver.dispatchers[0].stop()
+        receiver.report_metrics()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["messages_sent"]["orders"], 2)
+        self.assertEqual(snapshot["counters"]["messages_received"]["orders"], 2)
+        self.assertEqual(snapshot["counters"]["errors"]["orders"], 1)
+        self.assertEqual(snapshot["histograms"]["handler_seconds"]["orders"]["count"], 2)
+        self.assertEqual(snapshot["histograms"]["decrypt_seconds"]["orders"]["count"], 2)
+        self.assertEqual(snapshot["gauges"]["pending_files"][None], 0)
+        self.assertEqual(snapshot["gauges"]["dispatcher_queued"]["orders"], 0)
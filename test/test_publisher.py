@@ -0,0 +1,57 @@
+import socket
+import time
+import unittest
+
+from benchmarks.broker import StandInBroker
+from src.MqttLibPy.publisher import PublishHandle, Publisher, PublisherPool
+
+
+class TestPublisher(unittest.TestCase):
+
+    def test_handle_waits_for_every_publish(self):
+        handle = PublishHandle(3)
+        completed = []
+        handle.add_done_callback(completed.append)
+
+        handle._complete()
+        handle._complete()
+        self.assertFalse(handle.done())
+        self.assertFalse(handle.wait(0.01))
+
+        handle._complete()
+        self.assertTrue(handle.done())
+        self.assertTrue(handle.wait(0))
+        self.assertEqual(completed, [handle])
+
+    def test_handle_error(self):
+        handle = PublishHandle(2)
+        handle._complete(ConnectionError("broker down"))
+        self.assertTrue(handle.done())
+        self.assertIsInstance(handle.exception(), ConnectionError)
+        with self.assertRaises(ConnectionError):
+            handle.wait()
+
+    def test_pool_pins_topics(self):
+        pool = PublisherPool("localhost", 1883, size=4)
+        self.assertIs(pool.for_topic("a/b"), pool.for_topic("a/b"))
+        with self.assertRaises(ValueError):
+            PublisherPool("localhost", 1883, size=0)
+
+    def test_publish_doesnt_wait_for_connection(self):
+        with socket.socket() as listener:
+            # Accepts the connection but never answers with a CONNACK
+            listener.bind(("127.0.0.1", 0))
+            listener.listen()
+            publisher = Publisher("127.0.0.1", listener.getsockname()[1], connect_timeout=5)
+            self.addCleanup(publisher.close)
+            start = time.monotonic()
+            handle = publisher.publish("a/b", b"payload", qos=1)
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertFalse(handle.done())
+
+        broker = StandInBroker().start()
+        self.addCleanup(broker.stop)
+        publisher = Publisher("127.0.0.1", broker.port)
+        self.addCleanup(publisher.close)
+        # Queued until the broker accepts the connection
+        self.assertTrue(publisher.publish("a/b", b"payload", qos=1).wait(5))
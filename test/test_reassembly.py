@@ -0,0 +1,57 @@
+import json
+import time
+import unittest
+
+from cryptography.fernet import Fernet
+from src.MqttLibPy.serializer import Serializer
+from src.MqttLibPy.reassembly import ReassemblyBuffer
+
+
+class TestReassembly(unittest.TestCase):
+
+    def test_deserialize_multi_part_json(self):
+        key = Fernet.generate_key()
+        sender = Serializer("sender", key)
+        sender.MAX_MESSAGE_LENGTH = 100
+        objects = [{"n": n, "text": "x" * 20} for n in range(30)]
+        packets = sender.serialize(objects, valid_json=True, encrypt=True)
+        self.assertGreater(len(packets), 2)
+
+        receiver = Serializer("receiver", key)
+        payloads = [Serializer.encode_packet(packet) for packet in packets]
+        # Out of order and with a redelivered fragment
+        payloads = [payloads[-1], *payloads[:-1], payloads[0]]
+        results = [receiver.deserialize(payload) for payload in payloads]
+
+        self.assertEqual([r for r in results if r is not None], [objects])
+        self.assertEqual(receiver.reassembly.pending, 0)
+        self.assertEqual(receiver.reassembly.bytes, 0)
+
+    def test_deserialize_encoded_text(self):
+        serializer = Serializer("sender")
+        serializer._MAX_MESSAGE_LENGTH = 10
+        packets = serializer.serialize("hola mundo, ñandú", encodeb64=True)
+        self.assertGreater(len(packets), 1)
+
+        receiver = Serializer("receiver")
+        results = [receiver.deserialize(json.dumps(packet)) for packet in packets]
+        self.assertEqual(results[-1], "hola mundo, ñandú")
+
+    def test_eviction(self):
+        buffer = ReassemblyBuffer(max_bytes=100, timeout=60)
+        self.assertIsNone(buffer.add("a", 0, 2, "a0", 60))
+        self.assertIsNone(buffer.add("b", 0, 2, "b0", 60))
+        # "a" was the least recently updated message
+        self.assertEqual(buffer.evicted, 1)
+        self.assertEqual(buffer.add("b", 1, 2, "b1", 10), ["b0", "b1"])
+        self.assertIsNone(buffer.add("a", 1, 2, "a1", 10))
+        self.assertEqual(buffer.pending, 1)
+
+    def test_timeout(self):
+        buffer = ReassemblyBuffer(timeout=0.01)
+        buffer.add("a", 0, 2, "a0", 10)
+        time.sleep(0.02)
+        self.assertIsNone(buffer.add("b", 0, 2, "b0", 10))
+        self.assertEqual(buffer.expired, 1)
+        self.assertEqual(buffer.pending, 1)
+        self.assertEqual(buffer.bytes, 10)
@@ -0,0 +1,148 @@
+import threading
+import unittest
+
+from cryptography.fernet import Fernet
+from benchmarks.broker import StandInBroker
+from src.MqttLibPy.client import MqttClient
+from src.MqttLibPy.keycache import KeyCache
+from src.MqttLibPy.router import TopicRouter, covers, topic_wildcards
+
+
+class TestTopicRouter(unittest.TestCase):
+
+    def match(self, router: TopicRouter, topic: str):
+        return [(route.topic_filter, segments) for route, segments in router.match(topic)]
+
+    def test_match(self):
+        router = TopicRouter()
+        for topic_filter in ["company/+/orders", "company/#", "company/a/orders", "#", "+/+/invoices", "company/a"]:
+            router.add(topic_filter, None)
+
+        self.assertEqual(self.match(router, "company/a/orders"), [
+            ("company/+/orders", ["a"]), ("company/#", ["a/orders"]), ("company/a/orders", []),
+            ("#", ["company/a/orders"])
+        ])
+        # "#" matches the parent level too
+        self.assertEqual(self.match(router, "company"), [("company/#", [""]), ("#", ["company"])])
+        self.assertEqual(self.match(router, "company/b/invoices"), [
+            ("company/#", ["b/invoices"]), ("#", ["company/b/invoices"]), ("+/+/invoices", ["company", "b"])
+        ])
+        # $ topics only match filters starting with the same level
+        self.assertEqual(self.match(router, "$SYS/a/invoices"), [])
+        with self.assertRaises(Exception):
+            router.add("company/#/orders", None)
+
+    def test_cache(self):
+        router = TopicRouter(cache_size=2)
+        router.add("company/+/orders", None)
+        router.match("company/a/orders")
+        router.match("company/a/orders")
+        router.match("company/b/orders")
+        router.match("company/c/orders")
+        router.match("company/a/orders")
+        self.assertEqual((router.hits, router.misses), (1, 4))
+
+        # New routes invalidate the cache
+        router.add("company/a/#", None)
+        self.assertEqual(len(router.match("company/a/orders")), 2)
+
+    def test_subscriptions(self):
+        router = TopicRouter()
+        for topic_filter in ["company/+/orders", "company/a/orders", "company/+/orders", "$SYS/#", "status",
+                             "company/#"]:
+            router.add(topic_filter, None)
+        self.assertEqual(router.subscriptions(), ["$SYS/#", "status", "company/#"])
+        self.assertEqual(len(router), 6)
+
+        # Shared routes are subscribed apart, a plain filter doesn't cover them
+        router.add("company/+/invoices", None, group="workers")
+        router.add("company/a/invoices", None, group="workers")
+        self.assertEqual(router.groups, ["workers"])
+        self.assertEqual(router.subscriptions("workers"), ["company/+/invoices"])
+        self.assertEqual(router.subscriptions(), ["$SYS/#", "status", "company/#"])
+        self.assertEqual([route.group for route, _ in router.match("company/a/invoices")],
+                         [None, "workers", "workers"])
+        with self.assertRaises(Exception):
+            router.add("company", None, group="a/b")
+
+        self.assertTrue(covers("company/+/orders", "company/a/orders"))
+        self.assertTrue(covers("company/#", "company"))
+        self.assertFalse(covers("company/+", "company/a/orders"))
+        self.assertFalse(covers("+/a", "$SYS/a"))
+        self.assertFalse(covers("company/a", "company/+"))
+        self.assertEqual(topic_wildcards("company/+/orders/#", "company/a/orders/2024/05"), ["a", "2024/05"])
+
+    def test_key_cache(self):
+        db = {"a": Fernet.generate_key()}
+        lookups = []
+
+        def callback(topic, segments):
+            lookups.append((topic, segments))
+            return db[segments[0]]
+
+        keys = KeyCache(callback, wildcards=lambda topic: topic_wildcards("company/+/+/orders", topic))
+        fernet = keys.get_fernet("company/a/1/orders")
+        self.assertIs(keys.get_fernet("company/a/1/orders"), fernet)
+        keys.get_fernet("company/a/2/orders")
+        self.assertEqual(lookups, [("company/a/1/orders", ["a", "1"]), ("company/a/2/orders", ["a", "2"])])
+
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.key = Fernet.generate_key()
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def test_wildcards(self):
+        received = []
+        topics = []
+        lookups = []
+        done = threading.Event()
+        db = {"mycompany": self.key}
+        client = MqttClient("127.0.0.1", self.broker.port, prefix="tenants/", publish_timeout=10)
+
+        def key(topic, segments):
+            lookups.append(segments)
+            return db[segments[0]]
+
+        @client.endpoint("company/+/orders", force_json=True, secure=True, wildcards=True,
+                         endpoint_encryption_callback=key)
+        def orders(client, user_data, message, segments):
+            received.append((segments, message))
+
+        @client.endpoint("company/#")
+        def everything(client, user_data, message):
+            # Called after orders, routes are matched in registration order
+            topics.append(message.topic)
+            if len(topics) == 2:
+                done.set()
+
+        subscribes = []
+        subscribed = threading.Event()
+
+        def _on_subscribe(client, user_data, mid, granted, properties=None):
+            subscribes.append(granted)
+            subscribed.set()
+
+        client.client.on_subscribe = _on_subscribe
+        threading.Thread(target=client.listen, daemon=True).start()
+        self.assertTrue(subscribed.wait(5))
+
+        sender = MqttClient("127.0.0.1", self.broker.port, encryption_key=self.key, publish_timeout=10)
+        for n in range(2):
+            sender.send_message_serialized([{"n": n}], "tenants/company/mycompany/orders", valid_json=True,
+                                           secure=True)
+        self.assertTrue(done.wait(5))
+        sender.close()
+        client.client.disconnect()
+        client.close()
+
+        # tenants/company/# covers the orders route
+        self.assertEqual(len(subscribes), 1)
+        self.assertEqual(len(subscribes[0]), 1)
+        self.assertEqual(topics, ["tenants/company/mycompany/orders"] * 2)
+        self.assertEqual(received, [(["mycompany"], [{"n": 0}]), (["mycompany"], [{"n": 1}])])
+        self.assertEqual(lookups, [["mycompany"]])
@@ -0,0 +1,121 @@
+import json
+import time
+import asyncio
+import unittest
+
+from src.MqttLibPy.aio import AsyncMqttClient
+from src.MqttLibPy.metrics import InMemoryExporter
+from src.MqttLibPy.rpc import PendingRequests
+from .broker_case import BrokerTestCase
+
+
+class TestPendingRequests(unittest.TestCase):
+
+    def test_timeouts_and_slots(self):
+        metrics = InMemoryExporter()
+        requests = PendingRequests(max_pending=2, metrics=metrics)
+        self.addCleanup(requests.close)
+
+        self.assertTrue(requests.acquire(0))
+        slow, slow_future = requests.add("slow", 0.05)
+        self.assertTrue(requests.acquire(0))
+        fast, fast_future = requests.add("fast", 10)
+        # Every slot is taken
+        self.assertFalse(requests.acquire(0))
+
+        requests.resolve(fast, [{"n": 1}])
+        self.assertEqual(fast_future.result(0), [{"n": 1}])
+        with self.assertRaises(TimeoutError):
+            slow_future.result(1)
+        # Late responses are ignored
+        requests.resolve(slow, [{"n": 2}])
+        self.assertEqual(requests.pending, 0)
+        self.assertTrue(requests.acquire(0))
+        self.assertTrue(requests.acquire(0))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["request_timeouts"], {"slow": 1})
+        self.assertEqual(snapshot["histograms"]["request_seconds"]["fast"]["count"], 1)
+
+    def test_close(self):
+        requests = PendingRequests()
+        requests.acquire()
+        _, future = requests.add("route", 10)
+        requests.close()
+        self.assertIsInstance(future.exception(0), ConnectionError)
+        requests.acquire()
+        with self.assertRaises(Exception):
+            requests.add("route", 10)
+
+
+class TestRequests(BrokerTestCase):
+
+    def test_request(self):
+        server = self.client()
+
+        @server.endpoint("rpc/sum", force_json=True, concurrency=2)
+        def total(client, user_data, message):
+            return {"sum": sum(row["n"] for row in message)}
+
+        @server.endpoint("rpc/secure", force_json=True, secure=True)
+        def secure(client, user_data, message):
+            return message + [{"seen": True}]
+
+        @server.endpoint("rpc/echo")
+        def echo(client, user_data, message):
+            return message.payload.decode("utf-8")
+
+        @server.endpoint("rpc/fail", force_json=True)
+        def fail(client, user_data, message):
+            raise ValueError("Out of stock")
+
+        @server.endpoint("rpc/silent", force_json=True)
+        def silent(client, user_data, message):
+            pass
+
+        self.listen(server)
+        metrics = InMemoryExporter()
+        caller = self.client(metrics=metrics, metrics_interval=None)
+        futures = [caller.request("rpc/sum", [{"n": n}, {"n": 1}], timeout=5) for n in range(20)]
+        self.assertEqual([future.result(5) for future in futures], [[{"sum": n + 1}] for n in range(20)])
+        self.assertEqual(caller.request("rpc/secure", [{"n": 1}], secure=True, wire_format="binary").result(5),
+                         [{"n": 1}, {"seen": True}])
+        self.assertEqual(caller.request("rpc/secure", [{"n": 2}], secure=True).result(5),
+                         [{"n": 2}, {"seen": True}])
+        self.assertEqual(json.loads(caller.request("rpc/echo", [{"n": 3}]).result(5))["data"], [{"n": 3}])
+        self.assertEqual(caller.request("rpc/silent", [{"n": 4}]).result(5), "")
+        with self.assertRaisesRegex(Exception, "Out of stock"):
+            caller.request("rpc/fail", [{"n": 5}]).result(5)
+
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            caller.request("rpc/nobody", [{"n": 6}], timeout=0.2).result(5)
+        self.assertLess(time.monotonic() - start, 2)
+
+        self.assertEqual(caller.requests.pending, 0)
+        self.assertEqual(metrics.snapshot()["histograms"]["request_seconds"]["rpc/sum"]["count"], 20)
+        # A single reply subscription for every request
+        reply_subscriptions = [topic for session in self.broker._sessions for topic in session.subscriptions
+                               if topic.decode("utf-8") == caller.reply_topic]
+        self.assertEqual(len(reply_subscriptions), 1)
+
+    def test_async_request(self):
+        async def main():
+            client = AsyncMqttClient("127.0.0.1", self.broker.port, encryption_key=self.key, publish_timeout=10)
+
+            @client.endpoint("rpc/async", force_json=True)
+            async def double(client, user_data, message):
+                await asyncio.sleep(0.01)
+                return [{"n": row["n"] * 2} for row in message]
+
+            subscribed = asyncio.Event()
+            client.client.on_subscribe = lambda *args: client.loop.call_soon_threadsafe(subscribed.set)
+            listener = asyncio.create_task(client.listen())
+            await asyncio.wait_for(subscribed.wait(), 5)
+            try:
+                return await asyncio.gather(*(client.request("rpc/async", [{"n": n}], timeout=5) for n in range(10)))
+            finally:
+                await client.close()
+                await listener
+
+        self.assertEqual(asyncio.run(main()), [[{"n": n * 2}] for n in range(10)])
@@ -1,3 +1,4 @@
+import json
 import time
 import unittest
 import threading
@@ -5,6 +6,7 @@ import threading
 from cryptography.fernet import Fernet
 from random import randbytes
 from src.MqttLibPy.client import MqttClient
+from src.MqttLibPy.serializer import Serializer
 
 
 class TestSerialize(unittest.TestCase):
@@ -89,5 +91,31 @@ class TestSerialize(unittest.TestCase):
         time.sleep(20)
         sender_client.send_file("company/mycompany/test_bytes", self.FILE_PATH, secure=True)
 
+    def test_knapsack_byte_sizes(self):
+        serializer = Serializer("sender")
+        serializer.MAX_MESSAGE_LENGTH = 100
+        objects = [{"name": "ñandú" * (n % 4), "n": n} for n in range(50)]
+
+        packets = serializer.serialize(objects, valid_json=True, pre_encoded=True)
+        self.assertGreater(len(packets), 1)
+        for packet in packets:
+            self.assertLess(len(packet['data']), serializer.MAX_MESSAGE_LENGTH)
+            self.assertEqual(json.loads(packet['data']), json.loads(Serializer.encode_packet(packet))['data'])
+        self.assertEqual([obj for packet in packets for obj in json.loads(packet['data'])], objects)
+
+        fragments = serializer._naive_knapsack(objects)
+        self.assertEqual(len(fragments), len(packets))
+        self.assertTrue(all(len(serializer._as_str(f).encode()) < 100 for f in fragments))
+
+    def test_knapsack_first_fit_decreasing(self):
+        serializer = Serializer("sender")
+        serializer.MAX_MESSAGE_LENGTH = 100
+        objects = [{"v": "x" * (60 if n % 2 else 20)} for n in range(10)]
+
+        sequential = serializer._naive_knapsack(objects)
+        packed = serializer.serialize(objects, valid_json=True, first_fit_decreasing=True)
+        self.assertLess(len(packed), len(sequential))
+        self.assertCountEqual([obj for packet in packed for obj in packet['data']], objects)
+
     def _get_n_mb(self, mbs: int):
         return randbytes(mbs * 1000 * 1000)
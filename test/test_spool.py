@@ -0,0 +1,164 @@
+import os
+import time
+import asyncio
+import shutil
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+from benchmarks.broker import StandInBroker
+from src.MqttLibPy.aio import AsyncMqttClient
+from src.MqttLibPy.client import MqttClient
+from src.MqttLibPy.serializer import Serializer
+from src.MqttLibPy.spool import Spool, DROP_NEWEST
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="mqtt-spool-")
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def items(self, n: int, size: int = 10):
+        return [(f"route/{n}", bytes([n]) * size, [("transfer_id", str(n))] if n % 2 else None)]
+
+    def test_replay_after_restart(self):
+        spool = Spool(self.directory, segment_size=200)
+        for n in range(5):
+            spool.append("route", 1, self.items(n, 40))
+        self.assertEqual(spool.pending, 5)
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+        first, second = spool.read(0), spool.read(0)
+        self.assertEqual((first.route, first.qos, first.items), ("route", 1, self.items(0, 40)))
+        spool.commit(first)
+        # A record that wasn't acknowledged is read again
+        spool.rewind()
+        self.assertEqual(spool.read(0).items, second.items)
+        spool.commit(second)
+        spool.close()
+
+        spool = Spool(self.directory, segment_size=200)
+        self.assertEqual(spool.pending, 3)
+        records = [spool.read(0) for _ in range(3)]
+        self.assertEqual([record.items for record in records], [self.items(n, 40) for n in range(2, 5)])
+        self.assertIsNone(spool.read(0))
+        for record in records:
+            spool.commit(record)
+        self.assertEqual(spool.pending, 0)
+        # Acknowledged segments are deleted
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".seg")]), 1)
+        spool.close()
+
+    def test_torn_record(self):
+        spool = Spool(self.directory)
+        spool.append("route", 1, self.items(1))
+        spool.append("route", 1, self.items(2))
+        spool.close()
+        path = os.path.join(self.directory, "00000000000000000000.seg")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 3)
+
+        spool = Spool(self.directory)
+        self.assertEqual(spool.pending, 1)
+        self.assertEqual(spool.read(0).items, self.items(1))
+        self.assertIsNone(spool.read(0))
+        spool.append("route", 1, self.items(3))
+        self.assertEqual(spool.read(0).items, self.items(3))
+        spool.close()
+
+    def test_policies(self):
+        spool = Spool(self.directory, max_bytes=300, segment_size=200)
+        for n in range(10):
+            spool.append("route", 1, self.items(n, 40))
+        self.assertLessEqual(spool.bytes, 300)
+        self.assertEqual(spool.dropped + spool.pending, 10)
+        self.assertEqual(spool.read(0).items, self.items(10 - spool.pending, 40))
+        spool.close()
+
+        shutil.rmtree(self.directory)
+        spool = Spool(self.directory, max_bytes=100, policy=DROP_NEWEST)
+        spool.append("route", 1, self.items(1, 40))
+        with self.assertRaises(Exception):
+            spool.append("route", 1, self.items(2, 40))
+        self.assertEqual(spool.pending, 1)
+        spool.close()
+
+
+class TestOfflinePublish(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="mqtt-spool-")
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.broker = StandInBroker().start()
+        self.addCleanup(self.broker.stop)
+
+    def test_replay_on_reconnect(self):
+        received = []
+        done = threading.Event()
+
+        def receive():
+            receiver = MqttClient("127.0.0.1", self.broker.port)
+            subscribed = threading.Event()
+
+            @receiver.endpoint("offline", force_json=True)
+            def offline(client, user_data, message):
+                received.extend(row["n"] for row in message)
+                if len(received) == 21:
+                    done.set()
+
+            receiver.client.on_subscribe = lambda *args: subscribed.set()
+            threading.Thread(target=receiver.listen, daemon=True).start()
+            self.assertTrue(subscribed.wait(5))
+            self.addCleanup(receiver.close)
+            self.addCleanup(receiver.client.disconnect)
+            return receiver
+
+        first = receive()
+        sender = MqttClient("127.0.0.1", self.broker.port, spool_dir=self.directory, spool_rate=1000,
+                            publish_timeout=10)
+        sender.send_message_serialized([{"n": 0}], "offline", valid_json=True)
+        while sender.spool.pending or not sender.publishers.publishers[0].connected:
+            time.sleep(0.01)
+
+        first.client.disconnect()
+        self.broker.stop()
+        while sender.publishers.publishers[0].connected:
+            time.sleep(0.01)
+        # Accepted right away, a multi fragment message is spooled as a whole
+        with mock.patch.object(Serializer, "_MAX_MESSAGE_LENGTH_BYTES", 100):
+            sender.send_message_serialized([{"n": n, "padding": "x" * 50} for n in range(1, 11)], "offline",
+                                           valid_json=True)
+        for n in range(11, 21):
+            sender.send_message_serialized([{"n": n}], "offline", valid_json=True)
+        self.assertEqual(sender.spool.pending, 11)
+
+        self.broker.start()
+        receive()
+        self.assertTrue(done.wait(10))
+        self.assertEqual(received, list(range(21)))
+        while sender.spool.pending:
+            time.sleep(0.01)
+        sender.close()
+
+    def test_async_client(self):
+        def paho_threads():
+            return [thread for thread in threading.enumerate() if "_thread_main" in thread.name]
+
+        before = len(paho_threads())
+
+        async def main():
+            client = AsyncMqttClient("127.0.0.1", self.broker.port, spool_dir=self.directory, publish_timeout=10)
+            # The spool publishes through the connection of the event loop
+            self.assertEqual([publisher.client for publisher in client.publishers.publishers], [client.client])
+            listener = asyncio.create_task(client.listen())
+            await client.send_message_serialized([{"n": 1}], "offline", valid_json=True)
+            while client.spool.pending:
+                await asyncio.sleep(0.01)
+            await client.close()
+            await listener
+
+        asyncio.run(main())
+        self.assertEqual(len(paho_threads()), before)
+        self.assertEqual(len(self.broker._sessions), 0)
@@ -0,0 +1,182 @@
+import os
+import queue
+import tempfile
+import threading
+import unittest
+import multiprocessing
+
+from random import randbytes
+from benchmarks.broker import StandInBroker
+from paho.mqtt.client import MQTTMessage
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from src.MqttLibPy.client import MqttClient, FORWARDED_PROPERTY
+from src.MqttLibPy.serializer import Serializer
+from src.MqttLibPy.supervisor import Supervisor
+from .broker_case import BrokerTestCase
+
+
+class TestSharedRoutes(BrokerTestCase):
+
+    def test_load_balanced(self):
+        received = []
+        files = []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def check():
+            if len(received) == 20 and len(files) == 7 and sum(len(r) for r in plain) == 74:
+                done.set()
+
+        plain = []
+        for index in range(2):
+            worker = self.client()
+            worker.worker = (index, 2)
+            seen = []
+            plain.append(seen)
+
+            @worker.endpoint("shared/orders", force_json=True, share_group="workers")
+            def orders(client, user_data, message, index=index):
+                with lock:
+                    received.append((index, message[0]["n"]))
+                    check()
+
+            @worker.endpoint("shared/#")
+            def everything(client, user_data, message, seen=seen):
+                # Plain routes overlapping the shared ones still receive every message, once
+                with lock:
+                    seen.append(message.topic)
+                    check()
+
+            @worker.endpoint("shared/files", is_file=True, secure=True, share_group="workers")
+            def get_file(client, user_data, file, index=index):
+                if file['bytes'] is None:
+                    with open(file['path'], 'rb') as f:
+                        file['bytes'] = f.read()
+                with lock:
+                    files.append((index, file['data']['n'], file['bytes']))
+                    check()
+
+            subscribed = threading.Semaphore(0)
+            worker.client.on_subscribe = lambda *args, subscribed=subscribed: subscribed.release()
+            threading.Thread(target=worker.listen, daemon=True).start()
+            # Plain routes and inbox, then the shared group
+            self.assertTrue(subscribed.acquire(timeout=5))
+            self.assertTrue(subscribed.acquire(timeout=5))
+
+        sender = self.client()
+        for n in range(20):
+            sender.send_message_serialized([{"n": n}], "shared/orders", valid_json=True)
+        contents = [randbytes(1000) for _ in range(3)]
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents[0])
+        self.addCleanup(os.remove, path)
+        # Every chunk goes to the worker with the metadata, and the deliveries of each route are no longer even
+        sender.send_file_chunked("shared/files", path, {"n": 6}, secure=True, chunk_size=300)
+        for n, content in enumerate(contents):
+            sender.send_bytes(content, "shared/files", f"{n}.bin", {"n": n}, secure=True)
+            sender.send_bytes(content, "shared/files", f"{n}.bin", {"n": n + 3}, secure=True, wire_format="binary")
+        self.assertTrue(done.wait(10))
+
+        self.assertEqual(sorted(n for _, n in received), list(range(20)))
+        self.assertEqual({index for index, _ in received}, {0, 1})
+        self.assertEqual(plain[0], plain[1])
+        self.assertEqual(sorted(n for _, n, _ in files), list(range(7)))
+        for _, n, content in files:
+            self.assertEqual(content, contents[n % 3])
+
+    def test_without_subscription_identifiers(self):
+        self.broker.subscription_identifiers = False
+        received = []
+        done = threading.Event()
+        for index in range(2):
+            worker = self.client()
+            worker.worker = (index, 2)
+
+            @worker.endpoint("shared/orders", force_json=True, share_group="workers")
+            def orders(client, user_data, message, index=index):
+                received.append((index, message[0]["n"]))
+                if len(received) == 10:
+                    done.set()
+
+            subscribed = threading.Semaphore(0)
+            worker.client.on_subscribe = lambda *args, subscribed=subscribed: subscribed.release()
+            with self.assertLogs("Mqtt Client", "WARNING"):
+                threading.Thread(target=worker.listen, daemon=True).start()
+                self.assertTrue(subscribed.acquire(timeout=5))
+                self.assertTrue(subscribed.acquire(timeout=5))
+
+        sender = self.client()
+        for n in range(10):
+            sender.send_message_serialized([{"n": n}], "shared/orders", valid_json=True)
+        self.assertTrue(done.wait(10))
+        self.assertEqual(sorted(n for _, n in received), list(range(10)))
+        self.assertEqual({index for index, _ in received}, {0, 1})
+
+    def test_inbox_without_topic(self):
+        received = []
+        worker = self.client()
+        worker.worker = (0, 2)
+
+        @worker.endpoint("shared/orders", force_json=True, share_group="workers")
+        def orders(client, user_data, message):
+            received.append(message)
+
+        for user_properties in (None, [("transfer_id", "abc")]):
+            message = MQTTMessage(1, b"mqttlibpy/workers/workers/0")
+            message.payload = Serializer.encode_packet(Serializer("sender").serialize([{"n": 1}], valid_json=True)[0])
+            message.properties = Properties(PacketTypes.PUBLISH)
+            if user_properties:
+                message.properties.UserProperty = user_properties
+            # Dropped instead of raising on the network thread
+            with self.assertLogs("Mqtt Client", "WARNING"):
+                worker._on_message(worker.client, None, message)
+        self.assertEqual(received, [])
+
+        message.properties.UserProperty = (FORWARDED_PROPERTY, "shared/orders")
+        worker._on_message(worker.client, None, message)
+        self.assertEqual(received, [[{"n": 1}]])
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.addCleanup(self.broker.stop)
+
+    def test_workers(self):
+        port = self.broker.port
+        results = multiprocessing.get_context("fork").Queue()
+
+        def factory() -> MqttClient:
+            client = MqttClient("127.0.0.1", port)
+
+            @client.endpoint("jobs", force_json=True, share_group="jobs", concurrency=1)
+            def jobs(client, user_data, message):
+                results.put((os.getpid(), message[0]["n"]))
+
+            client.client.on_subscribe = lambda *args: results.put(("subscribed", os.getpid()))
+            return client
+
+        supervisor = Supervisor(factory, processes=2, drain_timeout=10)
+        thread = threading.Thread(target=supervisor.run, daemon=True)
+        thread.start()
+        self.assertEqual({results.get(timeout=10)[0] for _ in range(4)}, {"subscribed"})
+        pids = supervisor.pids
+        self.assertEqual(len(pids), 2)
+
+        sender = MqttClient("127.0.0.1", port, publish_timeout=10)
+        for n in range(10):
+            sender.send_message_serialized([{"n": n}], "jobs", valid_json=True)
+        sender.close()
+        received = [results.get(timeout=10) for _ in range(10)]
+        self.assertEqual(sorted(n for _, n in received), list(range(10)))
+        self.assertEqual({pid for pid, _ in received}, set(pids))
+
+        supervisor.stop()
+        thread.join(15)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(supervisor.pids, [])
+        with self.assertRaises(queue.Empty):
+            results.get(timeout=0.1)
@@ -0,0 +1,169 @@
+import os
+import time
+import hashlib
+import tempfile
+import unittest
+
+from random import randbytes
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from src.MqttLibPy.crypto import StreamCipher
+from src.MqttLibPy.transfer import FileTransfer, IncomingFile, IncomingTransfers, TransferStore, chunk_headers, \
+    stream_associated_data
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        self.content = randbytes(10 * 1000 + 7)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_chunks_hash_in_one_pass(self):
+        transfer = FileTransfer("route", self.path, chunk_size=1000)
+        self.assertEqual(transfer.total_chunks, 11)
+
+        chunks = list(transfer.chunks())
+        self.assertEqual(b"".join(chunk for _, chunk in chunks), self.content)
+        self.assertEqual(transfer.md5_hash, hashlib.md5(self.content).hexdigest())
+
+        # Resending acknowledged chunks doesn't hash them again
+        transfer.acked = 5
+        resent = list(transfer.chunks(transfer.acked))
+        self.assertEqual(resent[0][0], 5)
+        self.assertEqual(transfer.md5_hash, hashlib.md5(self.content).hexdigest())
+
+        headers = chunk_headers(transfer.chunk_properties(10))
+        self.assertEqual(headers["chunk"], "10")
+        self.assertEqual(headers["md5_hash"], transfer.md5_hash)
+
+        # Same size, other content
+        with open(self.path, "r+b") as f:
+            f.write(b"modified")
+        os.utime(self.path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        with self.assertRaises(Exception):
+            next(transfer.chunks(transfer.acked))
+
+    def test_stream_cipher(self):
+        key = Fernet.generate_key()
+        transfer = FileTransfer("route", self.path, chunk_size=1000, secure=True, streaming=True)
+        associated_data = stream_associated_data(transfer.transfer_id, transfer.total_chunks)
+        sender = StreamCipher(key, transfer.salt, associated_data)
+        chunks = [sender.encrypt(index, chunk, index == transfer.total_chunks - 1)
+                  for index, chunk in transfer.chunks()]
+        self.assertEqual(len(chunks[0]), 1000 + 16)
+
+        headers = chunk_headers(transfer.chunk_properties(0))
+        receiver = StreamCipher(key, bytes.fromhex(headers["salt"]), associated_data)
+        # Chunks decrypt on their own, in any order
+        plain = {index: receiver.decrypt(index, chunks[index], index == len(chunks) - 1)
+                 for index in reversed(range(len(chunks)))}
+        self.assertEqual(b"".join(plain[index] for index in range(len(chunks))), self.content)
+
+        with self.assertRaises(InvalidTag):
+            receiver.decrypt(1, chunks[0], False)
+        with self.assertRaises(InvalidTag):
+            # Truncated stream
+            receiver.decrypt(9, chunks[9], True)
+        with self.assertRaises(InvalidTag):
+            StreamCipher(key, transfer.salt, b"other/11").decrypt(0, chunks[0], False)
+
+    def test_reassemble_out_of_order(self):
+        transfer = FileTransfer("route", self.path, chunk_size=1000)
+        chunks = list(transfer.chunks())
+
+        incoming = IncomingFile(transfer.transfer_id, transfer.total_chunks, transfer.chunk_size)
+        incoming.md5_hash = transfer.md5_hash
+        incoming.metadata = {}
+        try:
+            for index, chunk in [*reversed(chunks[5:]), *chunks[:5]]:
+                self.assertFalse(incoming.complete)
+                incoming.write_chunk(index, chunk)
+            # Duplicated chunk after a resume
+            incoming.write_chunk(*chunks[3])
+            self.assertTrue(incoming.complete)
+            self.assertTrue(incoming.verify())
+            incoming.close()
+            with open(incoming.path, "rb") as f:
+                self.assertEqual(f.read(), self.content)
+        finally:
+            incoming.discard()
+        self.assertFalse(os.path.exists(incoming.path))
+
+    def test_incoming_transfers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        transfers = IncomingTransfers(ttl=0.05, max_entries=2, directory=directory)
+        done = transfers.get("done", 1, 10)
+        done.write_chunk(0, b"chunk")
+        transfers.finish(done)
+        done.discard()
+        # Redelivered after completion
+        self.assertIsNone(transfers.get("done", 1, 10))
+
+        for transfer_id in ("a", "b", "c"):
+            transfers.get(transfer_id, 2, 10).write_chunk(0, b"chunk")
+        self.assertNotIn("a", transfers)
+        self.assertEqual((len(transfers), transfers.evicted), (2, 1))
+
+        time.sleep(0.06)
+        transfers.get("d", 2, 10)
+        self.assertEqual((len(transfers), transfers.expired), (1, 2))
+        transfers.close()
+        self.assertEqual(os.listdir(directory), [])
+
+
+class TestTransferStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.rmdir(self.directory)
+
+    def test_pairs_by_transfer_id(self):
+        store = TransferStore(directory=self.directory)
+        # Same content in flight twice
+        self.assertIsNone(store.add_body("a", b"same"))
+        self.assertIsNone(store.add_body("b", b"same"))
+        self.assertEqual(store.bytes, 8)
+
+        self.assertEqual(store.add_metadata("b", {"filename": "b.txt"}), {"filename": "b.txt", "bytes": b"same"})
+        self.assertEqual(store.add_metadata("a", {"filename": "a.txt"}), {"filename": "a.txt", "bytes": b"same"})
+        self.assertEqual((store.pending, store.bytes), (0, 0))
+
+        # Redelivered after completion
+        self.assertIsNone(store.add_body("a", b"same"))
+        self.assertEqual(store.pending, 0)
+
+    def test_spill_to_disk(self):
+        store = TransferStore(spill_size=100, directory=self.directory)
+        body = randbytes(1000)
+        self.assertIsNone(store.add_body("a", body))
+        self.assertEqual((store.bytes, store.disk_bytes, store.spilled), (0, 1000, 1))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        self.assertEqual(store.add_metadata("a", {})["bytes"], body)
+        self.assertEqual(store.disk_bytes, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        # The metadata arrived first, no need to spill
+        store.add_metadata("b", {})
+        self.assertEqual(store.add_body("b", body)["bytes"], body)
+        self.assertEqual(store.spilled, 1)
+
+    def test_budget_and_ttl(self):
+        store = TransferStore(max_bytes=1500, ttl=0.05, spill_size=None, directory=self.directory)
+        store.add_body("a", bytes(1000))
+        store.add_body("b", bytes(1000))
+        self.assertNotIn("a", store)
+        self.assertEqual((store.evicted, store.bytes), (1, 1000))
+
+        store.add_metadata("c", {})
+        time.sleep(0.06)
+        store.add_metadata("d", {})
+        self.assertEqual((store.pending, store.expired, store.bytes), (1, 2, 0))